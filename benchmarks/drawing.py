@@ -0,0 +1,75 @@
+""" Time and flux error of the galsim drawing methods of `Lensing_frame`.
+
+Run as `python benchmarks/drawing.py`. Fluxes are compared to real space drawing, the default
+method.
+"""
+import time
+import numpy as np
+import galsim
+
+from desclamp.lens_sources import Lensing_frame
+
+
+PROFILES = {'Spergel': (0.5, {'half_light_radius': 0.4}),
+            'Sersic': (4, {'half_light_radius': 0.4}),
+            'Exponential': ((), {'half_light_radius': 0.4})}
+
+
+def benchmark_drawing(methods=('real_space', 'fft', 'phot', 'auto'), profiles=PROFILES,
+                      hr_factors=(1, 2, 4), shape=(50, 50), pix=0.2, dtype=np.float64, n_repeat=3):
+    """ Times the drawing of parametric sources for each method, profile and hr_factor.
+    Parameters
+    ----------
+    methods: `tuple`
+        galsim drawing methods
+    profiles: `dict`
+        profile name: (index, keyword arguments) passed to `Lensing_frame.from_galsim_parametric`
+    hr_factors: `tuple`
+        high resolution factors
+    shape, pix, dtype:
+        geometry and data type of the frames
+    n_repeat: `int`
+        number of draws, the fastest is reported
+
+    Returns
+    -------
+    rows: `list`
+        one dictionary per (profile, hr_factor, method) with the time of a draw in seconds, the
+        relative flux error and the largest residual relative to the peak of the real space image.
+    """
+    rows = []
+    for profile, (index, kwargs) in profiles.items():
+        args = index if isinstance(index, tuple) else (index,)
+        for hr_factor in hr_factors:
+            reference = None
+            for method in ('real_space',) + tuple(m for m in methods if m != 'real_space'):
+                draw_kwargs = None
+                if method == 'phot':
+                    draw_kwargs = {'rng': galsim.BaseDeviate(1), 'n_photons': 1e6}
+                frame = Lensing_frame(shape=shape, pix=pix, hr_factor=hr_factor, method=method,
+                                      dtype=dtype, reuse_buffer=True, draw_kwargs=draw_kwargs)
+                times = []
+                for _ in range(n_repeat):
+                    start = time.perf_counter()
+                    frame.from_galsim_parametric(*args, profile=profile, **kwargs)
+                    times.append(time.perf_counter() - start)
+                source = frame.source.astype(np.float64)
+                if reference is None:
+                    reference = source.copy()
+                if method not in methods:
+                    continue
+                flux = np.sum(reference)
+                rows.append({'profile': profile, 'hr_factor': hr_factor, 'method': method,
+                             'time': min(times),
+                             'flux_error': abs(np.sum(source) - flux) / flux,
+                             'max_residual': (np.max(np.abs(source - reference))
+                                              / np.max(reference))})
+    return rows
+
+
+if __name__ == '__main__':
+    print(f"{'profile':<12}{'hr_factor':>10}{'method':>12}{'time [ms]':>12}{'flux error':>12}"
+          f"{'residual':>12}")
+    for row in benchmark_drawing():
+        print(f"{row['profile']:<12}{row['hr_factor']:>10}{row['method']:>12}"
+              f"{row['time'] * 1e3:>12.2f}{row['flux_error']:>12.2e}{row['max_residual']:>12.2e}")
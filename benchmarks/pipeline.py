@@ -0,0 +1,237 @@
+""" Time and peak memory of the stages of the source -> lens -> inject -> stamp pipeline.
+
+Run as `python benchmarks/pipeline.py` to print the measurements and compare them to
+`benchmarks/baseline.json`. The command exits with an error if a stage is slower or uses more memory
+than the baseline by more than the tolerances. `--update` overwrites the baseline with the new
+measurements.
+
+Stages run against the local stand-ins of the catalog and butler of `tests/mocks.py`, without the
+LSST stack. Stages whose optional dependencies are not installed are reported as skipped.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+# The repository root for desclamp, and tests for the mocks, when run as a script
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [ROOT, os.path.join(ROOT, "tests")]
+from desclamp.lens_sources import DeflectionCache, Lensing_frame  # noqa: E402
+from desclamp.injection import FFTInjector  # noqa: E402
+from mocks import MockButler, MockCatalog  # noqa: E402
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+LENS_MODELS = ['SIE', 'SHEAR']
+
+
+def lens_args(theta_E=1.):
+    return [{'theta_E': theta_E, 'e1': 0.1, 'e2': -0.05, 'center_x': 0.05, 'center_y': 0},
+            {'gamma1': 0.02, 'gamma2': 0.01, 'ra_0': 0, 'dec_0': 0}]
+
+
+def measure(function, n_repeat=5):
+    """ Time and peak memory of a function.
+    Parameters
+    ----------
+    function: callable
+        function without arguments. It is called once to warm up caches and imports, once to measure
+        the memory, then `n_repeat` times.
+    n_repeat: `int`
+        number of timed calls, the fastest is reported
+
+    Returns
+    -------
+    measurement: `dict`
+        "time" in seconds and "peak_memory" allocated by python objects in bytes
+    """
+    function()
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times = []
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'time': min(times), 'peak_memory': peak}
+
+
+def draw_stage(shape=(100, 100), hr_factor=2):
+    frame = Lensing_frame(shape=shape, pix=0.2, hr_factor=hr_factor)
+    return lambda: frame.from_galsim_parametric(1., profile='Spergel', half_light_radius=0.4,
+                                                shift=(0.1, 0.))
+
+
+def lens_stage(shape, hr_factor, cached=False, kernel='lenstronomy', supersampling='uniform'):
+    """ Lensing of a source by a new lens at each call, or by the same lens with `cached`."""
+    frame = Lensing_frame(shape=shape, pix=0.2, hr_factor=hr_factor, kernel=kernel,
+                          supersampling=supersampling, method='fft')
+    frame.deflection_cache = DeflectionCache(maxbytes=2 ** 28 if cached else 0)
+    frame.from_galsim_parametric(1., profile='Spergel', half_light_radius=0.4, shift=(0.1, 0.))
+    rng = np.random.default_rng(0)
+
+    def lens():
+        if not cached:
+            Lensing_frame.mask_cache.clear()
+        frame.lens_source(LENS_MODELS, lens_args(1. if cached else rng.uniform(0.8, 1.2)))
+    return lens
+
+
+def inject_stage(size=100, n_bands=3):
+    """ Injection of a lensed source in a stack of cutouts with the numpy engine of
+    `Cutout.inject`."""
+    y, x = np.mgrid[:21, :21] - 10
+    psfs = [np.exp(-(x ** 2 + y ** 2) / (2 * s ** 2)) for s in (1.5, 2., 2.5)][:n_bands]
+    injector = FFTInjector(psfs, (size, size), pix=0.2)
+    frame = Lensing_frame(shape=(100, 100), pix=0.2, hr_factor=4)
+    frame.from_galsim_parametric(1., profile='Spergel', half_light_radius=0.4)
+    lensed = frame.lens_source(LENS_MODELS, lens_args())
+    images = np.zeros((n_bands, size, size), dtype=np.float32)
+    return lambda: injector.inject(images, lensed, (100, 200, 300)[:n_bands], scale=0.05,
+                                   center=(49.3, 50.1))
+
+
+def stamps_stage(n_threads=1, by_patch=False):
+    from desclamp import postage
+    candidates = postage.Candidates("mock", cat=MockCatalog(), butler=MockButler())
+    objects = candidates.catalog_query(("clean",), tracts=[4639])
+    return lambda: candidates.make_postage_stamps(objects, cutout_size=100, n_threads=n_threads,
+                                                  by_patch=by_patch)
+
+
+def train_set_stage(prefetch=2):
+    """ Iteration over a training set, injection excluded (see the inject stage)."""
+    from desclamp.train_set import TrainSet
+    train = TrainSet("mock", n_samples=64, batchsize=16, lens_fraction=0, prefetch=prefetch,
+                     cutout_size=100, cat=MockCatalog(), butler=MockButler())
+    train.catalog_query(("clean",), tracts=[4639])
+    return lambda: list(train)
+
+
+def stages():
+    """ Benchmarked stages, as name: function building the callable to measure."""
+    stages = {'draw[100x100,hr=2]': lambda: draw_stage()}
+    for shape in [(50, 50), (100, 100), (100, 50)]:
+        for hr_factor in (1, 2, 4):
+            name = f"lens[{shape[0]}x{shape[1]},hr={hr_factor}]"
+            stages[name] = lambda shape=shape, hr_factor=hr_factor: lens_stage(shape, hr_factor)
+    stages['relens[100x100,hr=2]'] = lambda: lens_stage((100, 100), 2, cached=True)
+    for hr_factor in (2, 4):
+        stages[f"lens[100x100,hr={hr_factor},numba]"] = lambda hr_factor=hr_factor: lens_stage(
+            (100, 100), hr_factor, kernel='numba')
+    stages['relens[100x100,hr=2,numba]'] = lambda: lens_stage((100, 100), 2, cached=True,
+                                                              kernel='numba')
+    stages['lens[100x100,hr=8]'] = lambda: lens_stage((100, 100), 8)
+    for hr_factor in (4, 8):
+        stages[f"lens[100x100,hr={hr_factor},adaptive]"] = lambda hr_factor=hr_factor: lens_stage(
+            (100, 100), hr_factor, supersampling='adaptive')
+    stages['inject[3x100x100]'] = lambda: inject_stage()
+    stages['make_postage_stamps[20]'] = lambda: stamps_stage()
+    stages['make_postage_stamps[20,by_patch]'] = lambda: stamps_stage(by_patch=True)
+    stages['train_set[64]'] = lambda: train_set_stage()
+    return stages
+
+
+def run_benchmarks(names=None, n_repeat=5):
+    """ Measures the stages.
+    Parameters
+    ----------
+    names: `list`
+        names of the stages to run, all of them if None
+    n_repeat: `int`
+        number of timed calls per stage
+
+    Returns
+    -------
+    results: `dict`
+        measurement of each stage, see `measure`, or the reason why it was skipped
+    """
+    results = {}
+    for name, build in stages().items():
+        if names is not None and name not in names:
+            continue
+        try:
+            function = build()
+        except ImportError as error:
+            results[name] = {'skipped': str(error)}
+            continue
+        results[name] = measure(function, n_repeat=n_repeat)
+    return results
+
+
+def compare(results, baseline, time_tolerance=1.5, memory_tolerance=1.2):
+    """ Stages that regressed with respect to a baseline.
+    Parameters
+    ----------
+    results, baseline: `dict`
+        measurements, see `run_benchmarks`
+    time_tolerance, memory_tolerance: `float`
+        largest accepted ratios of the time and peak memory to the baseline
+
+    Returns
+    -------
+    regressions: `list`
+        (stage, metric, ratio to the baseline) of each regression
+    """
+    tolerances = {'time': time_tolerance, 'peak_memory': memory_tolerance}
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name, {})
+        for metric, tolerance in tolerances.items():
+            if metric in result and reference.get(metric):
+                ratio = result[metric] / reference[metric]
+                if ratio > tolerance:
+                    regressions.append((name, metric, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="json file of the baseline measurements")
+    parser.add_argument("--update", action="store_true",
+                        help="overwrite the baseline with the new measurements")
+    parser.add_argument("--stages", nargs="+", help="stages to run, all of them by default")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed calls per stage")
+    parser.add_argument("--time-tolerance", type=float, default=1.5)
+    parser.add_argument("--memory-tolerance", type=float, default=1.2)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.stages, n_repeat=args.repeat)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print(f"{'stage':<36}{'time [ms]':>12}{'baseline':>12}{'memory [MB]':>14}{'baseline':>12}")
+    for name, result in results.items():
+        if 'skipped' in result:
+            print(f"{name:<36}  skipped: {result['skipped']}")
+            continue
+        reference = baseline.get(name, {})
+        print(f"{name:<36}{result['time'] * 1e3:>12.2f}"
+              f"{reference.get('time', np.nan) * 1e3:>12.2f}"
+              f"{result['peak_memory'] / 2 ** 20:>14.2f}"
+              f"{reference.get('peak_memory', np.nan) / 2 ** 20:>12.2f}")
+
+    if args.update:
+        baseline.update({name: result for name, result in results.items()
+                         if 'skipped' not in result})
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        return
+
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+    for name, metric, ratio in regressions:
+        print(f"Regression: {name} {metric} is {ratio:.2f} times the baseline")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
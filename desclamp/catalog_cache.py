@@ -0,0 +1,188 @@
+import ast
+import os
+import tempfile
+import numpy as np
+
+# Functions that can be used in the cuts of a query, as in the numexpr expressions of a GCRQuery
+FUNCTIONS = {name: getattr(np, name)
+             for name in ("abs", "sqrt", "exp", "log", "log10", "sin", "cos", "tan", "arcsin",
+                          "arccos", "arctan", "arctan2", "where", "isfinite", "isnan")}
+
+
+def query_quantities(query):
+    """ Quantities used by the cuts of a query.
+
+    Parameters
+    ----------
+    query: tuple
+        cuts combined with AND, as given to `Candidates.catalog_query`: expressions of quantities
+        such as "mag_r_cModel < 22.5", or tuples (function, quantity, ...) of a function returning a
+        boolean array.
+    """
+    quantities = set()
+    for cut in query:
+        if isinstance(cut, str):
+            tree = ast.parse(cut, mode="eval")
+            quantities |= {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+            quantities -= set(FUNCTIONS)
+        else:
+            quantities |= set(cut[1:])
+    return sorted(quantities)
+
+
+def query_mask(query, table):
+    """ Objects of a table that pass all the cuts of a query, see `query_quantities`.
+
+    Parameters
+    ----------
+    query: tuple
+        cuts of the query
+    table: dict
+        arrays of the quantities used by the cuts
+
+    Returns
+    -------
+    mask: array
+        boolean mask of the selected objects
+    """
+    n = len(next(iter(table.values()))) if len(table) > 0 else 0
+    mask = np.ones(n, dtype=bool)
+    for cut in query:
+        if isinstance(cut, str):
+            selected = eval(compile(cut, "<query>", "eval"), {"__builtins__": {}, **FUNCTIONS},
+                            dict(table))
+        else:
+            selected = cut[0](*[table[q] for q in cut[1:]])
+        mask &= np.broadcast_to(np.asarray(selected, dtype=bool), n)
+    return mask
+
+
+def _align(reference, ids):
+    """ Indices that put `ids` in the order of `reference`, or None if they are not the same
+    objects."""
+    if np.array_equal(reference, ids):
+        return slice(None)
+    sorter = np.argsort(ids, kind="stable")
+    position = np.clip(np.searchsorted(ids, reference, sorter=sorter), 0, max(len(ids) - 1, 0))
+    order = sorter[position]
+    if len(ids) != len(reference) or not np.array_equal(ids[order], reference):
+        return None
+    return order
+
+
+class CatalogCache:
+    """ Local columnar copy of the quantities of an object catalog, split by tract.
+
+    Each column of each tract is stored as its own .npy file, so that reading a selection of tracts
+    and quantities only touches the files of these tracts and quantities. Columns are written once
+    per tract and memory mapped when read, selection cuts are then evaluated on the local arrays
+    instead of the catalog.
+    """
+    def __init__(self, root, data_version):
+        """
+        Parameters
+        ----------
+        root: str
+            directory of the cache
+        data_version: str
+            data version of the catalog
+        """
+        self.path = os.path.join(root, str(data_version))
+        self.data_version = data_version
+        os.makedirs(self.path, exist_ok=True)
+
+    def _tract_path(self, tract):
+        return os.path.join(self.path, f"tract{int(tract)}")
+
+    def tracts(self):
+        """ Tracts with at least one cached column.
+        """
+        return sorted(int(d[len("tract"):]) for d in os.listdir(self.path) if d.startswith("tract"))
+
+    def columns(self, tract):
+        """ Quantities cached for a tract.
+        """
+        path = self._tract_path(tract)
+        if not os.path.isdir(path):
+            return []
+        return sorted(f[:-len(".npy")] for f in os.listdir(path)
+                      if f.endswith(".npy") and not f.endswith(".tmp.npy"))
+
+    def missing(self, tracts, columns):
+        """ Quantities that are not cached for each tract.
+
+        Returns
+        -------
+        missing: dict
+            missing quantities of each tract that lacks some of `columns`
+        """
+        missing = {}
+        for tract in tracts:
+            cached = set(self.columns(tract))
+            lacking = [c for c in columns if c not in cached]
+            if len(lacking) > 0:
+                missing[int(tract)] = lacking
+        return missing
+
+    def write(self, tract, data):
+        """ Stores columns of a tract. Columns already cached are overwritten.
+        Columns added to a tract must have the rows of the columns already cached. If `data` has an
+        "objectId" column and the tract has one cached, the rows of `data` are put in the cached
+        order of the objects.
+
+        Parameters
+        ----------
+        tract: int
+            tract number
+        data: dict
+            arrays of the quantities of all the objects of the tract, with the same length
+        """
+        path = self._tract_path(tract)
+        os.makedirs(path, exist_ok=True)
+        data = {column: np.asarray(values) for column, values in data.items()}
+        lengths = {len(values) for values in data.values()}
+        assert len(lengths) <= 1, "All the columns of a tract should have the same length."
+        cached = self.columns(tract)
+        if len(cached) > 0 and len(data) > 0:
+            n = len(np.load(os.path.join(path, f"{cached[0]}.npy"), mmap_mode="r"))
+            assert lengths == {n}, \
+                f"Tract {tract} has {n} objects cached, got columns of {lengths.pop()}."
+            if "objectId" in data and "objectId" in cached:
+                order = _align(np.load(os.path.join(path, "objectId.npy")), data["objectId"])
+                assert order is not None, \
+                    f"The objects of tract {tract} differ from the cached ones."
+                data = {column: values[order] for column, values in data.items()}
+        for column, values in data.items():
+            # Strings are stored with a fixed width so that they can be memory mapped
+            if values.dtype == object:
+                values = values.astype(str)
+            # Written under a temporary name unique to this writer, so that readers never see a
+            # partial column
+            descriptor, temporary = tempfile.mkstemp(suffix=".tmp.npy", dir=path)
+            with os.fdopen(descriptor, "wb") as f:
+                np.save(f, values)
+            os.replace(temporary, os.path.join(path, f"{column}.npy"))
+
+    def read(self, tracts, columns):
+        """ Reads cached quantities of a set of tracts.
+
+        Parameters
+        ----------
+        tracts: list
+            tract numbers. They all need to have `columns` cached.
+        columns: list
+            quantities to read
+
+        Returns
+        -------
+        data: dict
+            arrays of the quantities of the objects of all `tracts`, in the order of `tracts`
+        """
+        missing = self.missing(tracts, columns)
+        assert len(missing) == 0, f"Quantities missing from the cache: {missing}"
+        data = {}
+        for column in columns:
+            arrays = [np.load(os.path.join(self._tract_path(t), f"{column}.npy"), mmap_mode="r")
+                      for t in tracts]
+            data[column] = np.concatenate(arrays) if len(arrays) > 0 else np.array([])
+        return data
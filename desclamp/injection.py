@@ -0,0 +1,167 @@
+import numpy as np
+from scipy import fft
+
+
+class FFTInjector:
+    """ Injection of lensed sources in multi-band stacks of cutouts with plain arrays.
+
+    The lensed source is drawn once at high resolution, rebinned to the pixels of the cutouts and
+    convolved with the PSF of each band by FFT. The FFTs of the PSFs are computed once per injector,
+    so that many sources can be injected with the same PSFs at the cost of one forward and one
+    inverse FFT per band.
+    """
+    def __init__(self, psfs, shape, pix=0.2):
+        """
+        Parameters
+        ----------
+        psfs: `array`
+            images of the PSF in each band, with shape (bands, py, px) and centered on pixel (py//2,
+            px//2). They are normalised to unit sum.
+        shape: `tuple`
+            shape (ny, nx) of the cutouts
+        pix: `float`
+            pixel size of the cutouts in arcseconds
+        """
+        psfs = np.asarray(psfs, dtype=np.float64)
+        assert psfs.ndim == 3, "psfs should have shape (bands, py, px)."
+        self.psfs = psfs / np.sum(psfs, axis=(1, 2), keepdims=True)
+        self.shape = tuple(shape)
+        self.pix = pix
+
+        # Padding that avoids wrapping the PSF wings around the cutout
+        ny, nx = self.shape
+        _, py, px = self.psfs.shape
+        self.fft_shape = (fft.next_fast_len(ny + py - 1, real=True),
+                          fft.next_fast_len(nx + px - 1, real=True))
+        padded = np.zeros((len(self.psfs),) + self.fft_shape)
+        padded[:, :py, :px] = self.psfs
+        # The PSF center is rolled to the origin so that convolution does not shift the source
+        padded = np.roll(padded, (-(py // 2), -(px // 2)), axis=(1, 2))
+        self.psf_fft = fft.rfft2(padded)
+
+        fy = fft.fftfreq(self.fft_shape[0])
+        fx = fft.rfftfreq(self.fft_shape[1])
+        self._fy = fy[:, None]
+        self._fx = fx[None, :]
+
+    @property
+    def n_bands(self):
+        return self.psfs.shape[0]
+
+    def rebin(self, lensed_source, scale):
+        """ Rebins a high resolution image of a source to the pixels of the cutouts, conserving
+        flux. The image is padded with zeros to a multiple of the resolution factor, keeping its
+        center in place.
+
+        Parameters
+        ----------
+        lensed_source: `array`
+            image of the lensed source
+        scale: `float`
+            pixel size of `lensed_source` in arcseconds. `pix` has to be a multiple of it.
+
+        Returns
+        -------
+        image: `array`
+            image at the resolution of the cutouts
+        center: `tuple`
+            position (x, y) of the center of `lensed_source` in the pixels of `image`
+        """
+        factor = self.pix / scale
+        assert np.isclose(factor, np.round(factor)), \
+            "The pixel size of the cutouts should be a multiple of scale."
+        factor = int(np.round(factor))
+        image = np.asarray(lensed_source, dtype=np.float64)
+        sy, sx = image.shape
+        if factor == 1:
+            return image, ((sx - 1) / 2., (sy - 1) / 2.)
+        ny, nx = -(-sy // factor) * factor, -(-sx // factor) * factor
+        # Padding on both sides, so that the center stays at the center of a rebinned pixel when
+        # possible
+        oy, ox = (ny - sy) // 2, (nx - sx) // 2
+        padded = np.zeros((ny, nx))
+        padded[oy:oy + sy, ox:ox + sx] = image
+        center = ((ox + sx / 2.) / factor - 0.5, (oy + sy / 2.) / factor - 0.5)
+        return padded.reshape(ny // factor, factor, nx // factor, factor).sum(axis=(1, 3)), center
+
+    def render(self, lensed_source, spectra, scale=0.05, center=None):
+        """ Images of a lensed source as seen in each band of the cutouts.
+
+        Parameters
+        ----------
+        lensed_source: `array`
+            high resolution image of the lensed source, or cube of images with shape (bands, sy, sx)
+            for a source with a different morphology in each band, e.g. from
+            `Lensing_frame.lens_cube`.
+        spectra: `list`
+            flux of the source in each band
+        scale: `float`
+            pixel size of `lensed_source` in arcseconds
+        center: `tuple`
+            position (x, y) of the center of the source in the pixels of the cutouts. Defaults to
+            the center of the cutouts. Sub-pixel positions are applied as a phase shift in Fourier
+            space.
+
+        Returns
+        -------
+        images: `array`
+            images of the source with shape (bands, ny, nx)
+        """
+        assert len(spectra) == self.n_bands, "Please provide one flux per band."
+        if np.ndim(lensed_source) == 3:
+            assert len(lensed_source) == self.n_bands, \
+                "Please provide one image of the source per band."
+            rebinned = [self.rebin(band, scale) for band in lensed_source]
+            source_center = rebinned[0][1]
+            image = np.array([band for band, _ in rebinned])
+        else:
+            image, source_center = self.rebin(lensed_source, scale)
+            image = image[None]
+        # Sources with no flux are not normalised, and add nothing to the cutouts
+        total = np.sum(image, axis=(1, 2), keepdims=True)
+        image = np.divide(image, total, out=np.zeros_like(image), where=total > 0)
+
+        ny, nx = self.shape
+        if center is None:
+            center = ((nx - 1) / 2., (ny - 1) / 2.)
+        sy, sx = image.shape[1:]
+        # Lower corner of the source in the cutout, split into integer and sub-pixel shifts
+        x0 = center[0] - source_center[0]
+        y0 = center[1] - source_center[1]
+        ix, iy = int(np.floor(x0)), int(np.floor(y0))
+        dx, dy = x0 - ix, y0 - iy
+
+        # Source placed on the padded canvas, cropped to the cutout
+        canvas = np.zeros((len(image),) + self.fft_shape)
+        cy = slice(max(iy, 0), min(iy + sy, ny))
+        cx = slice(max(ix, 0), min(ix + sx, nx))
+        canvas[:, cy, cx] = image[:, cy.start - iy:cy.stop - iy, cx.start - ix:cx.stop - ix]
+
+        source_fft = fft.rfft2(canvas, axes=(1, 2))
+        if dx != 0 or dy != 0:
+            source_fft = source_fft * np.exp(-2j * np.pi * (self._fx * dx + self._fy * dy))
+        images = fft.irfft2(source_fft * self.psf_fft, s=self.fft_shape, axes=(1, 2))[:, :ny, :nx]
+        return images * np.asarray(spectra, dtype=np.float64)[:, None, None]
+
+    def inject(self, images, lensed_source, spectra, scale=0.05, center=None, inplace=False):
+        """ Adds a lensed source to a stack of cutouts.
+
+        Parameters
+        ----------
+        images: `array`
+            cutouts with shape (bands, ny, nx)
+        lensed_source, spectra, scale, center:
+            see `render`
+        inplace: bool
+            if True, the source is added to `images`. Otherwise a new array is returned.
+
+        Returns
+        -------
+        images: `array`
+            cutouts with the injected source
+        """
+        lensed = self.render(lensed_source, spectra, scale=scale, center=center)
+        if inplace:
+            images += lensed.astype(images.dtype)
+            return images
+        return images + lensed
@@ -0,0 +1,192 @@
+""" Timers and counters of the stages of desclamp.
+
+Functions decorated with `timed` record their number of calls, wall time, the bytes they read and,
+optionally, the memory they allocate, while a `profile` context is active. Outside of a context, a
+decorated function costs one global lookup per call::
+
+    with instrumentation.profile() as report:
+        train = TrainSet(...)
+        batches = list(train)
+    print(report.summary())
+    report.to_json("run.json")
+
+Times are inclusive: a stage that calls another one, e.g. `Lensing_frame.lens_source` and
+`Lensing_frame.lens_cube`, counts the time of both.
+
+Memory is measured with `tracemalloc`, whose traces are global to the process: tracing is restarted
+at the start of each stage, so memory measurements are only meaningful when a single thread runs
+stages, e.g. a `TrainSet` with `prefetch=0`, and they discard the traces of other users of
+`tracemalloc`.
+"""
+import functools
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Report collecting the measurements, None when instrumentation is disabled
+_report = None
+
+
+class Report:
+    """ Measurements of the stages run during a `profile` context."""
+    fields = ("calls", "seconds", "bytes_read", "allocated_bytes", "peak_bytes")
+
+    def __init__(self, memory=False):
+        """
+        Parameters
+        ----------
+        memory: bool
+            if True, memory allocations are traced with `tracemalloc`, which slows down the stages.
+            The measurements are only meaningful when a single thread runs stages.
+        """
+        self.memory = memory
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def record(self, name, seconds, bytes_read=0, allocated_bytes=0, peak_bytes=0):
+        """ Adds a call of a stage."""
+        with self._lock:
+            stage = self.stats.setdefault(name, dict.fromkeys(self.fields, 0))
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+            stage["bytes_read"] += bytes_read
+            stage["allocated_bytes"] += allocated_bytes
+            stage["peak_bytes"] = max(stage["peak_bytes"], peak_bytes)
+
+    def _enter(self):
+        """ Starts the memory measurement of a call.
+        The peak is reset by restarting the tracing, as `tracemalloc.reset_peak` needs Python 3.9.
+        The memory traced so far is carried over in the [allocated, peak] entries of the enclosing
+        calls on the stack. Memory freed by a call but allocated before it started is not
+        subtracted.
+        """
+        stack = self._local.__dict__.setdefault("stack", [])
+        current, peak = tracemalloc.get_traced_memory()
+        for entry in stack:
+            entry[1] = max(entry[1], entry[0] + peak)
+            entry[0] += current
+        frames = tracemalloc.get_traceback_limit()
+        tracemalloc.stop()
+        tracemalloc.start(frames)
+        stack.append([0, 0])
+
+    def _exit(self):
+        """ Memory allocated and kept by a call, and largest memory allocated during the call."""
+        allocated, peak = self._local.stack.pop()
+        current, traced_peak = tracemalloc.get_traced_memory()
+        return allocated + current, max(peak, allocated + traced_peak)
+
+    def summary(self):
+        """ Table of the stages, sorted by decreasing time."""
+        lines = [f"{'stage':<40}{'calls':>8}{'time [s]':>12}{'read [MB]':>12}{'alloc [MB]':>12}"
+                 f"{'peak [MB]':>12}"]
+        for name, stage in sorted(self.stats.items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"{name:<40}{stage['calls']:>8}{stage['seconds']:>12.3f}"
+                         f"{stage['bytes_read'] / 2 ** 20:>12.2f}"
+                         f"{stage['allocated_bytes'] / 2 ** 20:>12.2f}"
+                         f"{stage['peak_bytes'] / 2 ** 20:>12.2f}")
+        return "\n".join(lines)
+
+    def to_json(self, path=None):
+        """ Measurements as a json string, also written to `path` if given."""
+        text = json.dumps(self.stats, indent=2, sort_keys=True)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+    def to_prometheus(self, prefix="desclamp", labels=None):
+        """ Measurements in the Prometheus text exposition format.
+
+        Parameters
+        ----------
+        prefix: str
+            prefix of the metric names
+        labels: dict
+            labels added to every sample, e.g. {"run": "dr6_train"}
+        """
+        metrics = {"calls": ("calls_total", "counter", "Number of calls of the stage."),
+                   "seconds": ("seconds_total", "counter", "Wall time spent in the stage."),
+                   "bytes_read": ("read_bytes_total", "counter",
+                                  "Bytes of pixels read by the stage."),
+                   "allocated_bytes": ("allocated_bytes_total", "counter",
+                                       "Bytes allocated and kept by the stage."),
+                   "peak_bytes": ("peak_bytes", "gauge",
+                                  "Largest memory allocated during a call of the stage.")}
+        extra = "".join(f',{key}="{value}"' for key, value in (labels or {}).items())
+        lines = []
+        for field, (metric, kind, description) in metrics.items():
+            lines.append(f"# HELP {prefix}_{metric} {description}")
+            lines.append(f"# TYPE {prefix}_{metric} {kind}")
+            for name, stage in sorted(self.stats.items()):
+                lines.append(f'{prefix}_{metric}{{stage="{name}"{extra}}} {stage[field]}')
+        return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def profile(memory=False):
+    """ Enables the instrumentation and collects the measurements of the stages run in the context.
+
+    Parameters
+    ----------
+    memory: bool
+        if True, memory allocations are traced with `tracemalloc`.
+
+    Returns
+    -------
+    report: `Report`
+        measurements of the stages, filled in as they run
+    """
+    global _report
+    previous = _report
+    report = Report(memory=memory)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _report = report
+    try:
+        yield report
+    finally:
+        _report = previous
+        if started:
+            tracemalloc.stop()
+
+
+def enabled():
+    """ True if a `profile` context is active."""
+    return _report is not None
+
+
+def timed(name, nbytes=None):
+    """ Decorator recording the calls of a function in the active `Report`.
+
+    Parameters
+    ----------
+    name: str
+        name of the stage
+    nbytes: callable
+        function of the result of the function that returns the number of bytes it read
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            report = _report
+            if report is None:
+                return function(*args, **kwargs)
+            memory = report.memory and tracemalloc.is_tracing()
+            if memory:
+                report._enter()
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                allocated, peak = report._exit() if memory else (0, 0)
+            report.record(name, seconds, bytes_read=nbytes(result) if nbytes is not None else 0,
+                          allocated_bytes=max(allocated, 0), peak_bytes=peak)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,195 @@
+""" Compiled ray-shooting and source interpolation for the most common lens models.
+
+The SIS, SIE and external SHEAR models of lenstronomy are evaluated by a multi-threaded Numba kernel
+instead of the Python dispatch of `lenstronomy.LensModel.LensModel`, with the same parameter
+conventions, and sources are interpolated and rebinned to the frame resolution in a single pass.
+Results agree with lenstronomy to rounding errors. Kernels are compiled on first use and cached on
+disk.
+
+The number of threads is the one of Numba, set with the NUMBA_NUM_THREADS environment variable or
+`numba.set_num_threads`. Set it to 1 in pool workers that already use all the cpus.
+
+Numba is an optional dependency, installed with `pip install desclamp[numba]`.
+"""
+import numpy as np
+import numba
+
+SIS, SIE, SHEAR = 0, 1, 2
+# Lens models evaluated by the kernels
+SUPPORTED = {"SIS": SIS, "SIE": SIE, "SHEAR": SHEAR}
+# Core radius of lenstronomy's SIE, which is a NIE with a negligible core
+SIE_S_SCALE = 1e-10
+
+
+def supported(lens_models):
+    """ True if all the lens models are evaluated by the kernels."""
+    return all(model in SUPPORTED for model in lens_models)
+
+
+def lens_parameters(lens_models, lens_args):
+    """ Parameters of the lens models, in the form used by the kernel.
+
+    Parameters
+    ----------
+    lens_models: list
+        list of lens model names, see `SUPPORTED`
+    lens_args: list
+        list of keyword arguments of the lens models, with the conventions of lenstronomy
+
+    Returns
+    -------
+    types: array
+        type of each model
+    params: array
+        (n_models, 8) parameters of each model: centre, then the SIS Einstein radius, the SIE
+        critical radius, core, axis ratio, orientation and sqrt(1 - q^2), or the two shear
+        components.
+    """
+    types = np.array([SUPPORTED[model] for model in lens_models], dtype=np.int64)
+    params = np.zeros((len(lens_models), 8))
+    for k, (model, args) in enumerate(zip(lens_models, lens_args)):
+        if model == "SIS":
+            params[k, :3] = args.get("center_x", 0), args.get("center_y", 0), args["theta_E"]
+        elif model == "SIE":
+            # Conversion of lenstronomy's NIE to the major axis critical radius and smoothing scale
+            phi = np.arctan2(args["e2"], args["e1"]) / 2
+            c = min(np.sqrt(args["e1"] ** 2 + args["e2"] ** 2), 0.9999)
+            q = (1 - c) / (1 + c)
+            b = args["theta_E"] / np.sqrt((1. + q ** 2) / (2. * q)) * np.sqrt((1 + q ** 2) / 2)
+            s = SIE_S_SCALE / np.sqrt(q)
+            q = min(q, 0.99999999)
+            params[k] = (args.get("center_x", 0), args.get("center_y", 0), b, s, q, np.cos(phi),
+                         np.sin(phi), np.sqrt(1. - q ** 2))
+        else:
+            params[k, :4] = (args.get("ra_0", 0), args.get("dec_0", 0), args["gamma1"],
+                             args["gamma2"])
+    return types, params
+
+
+@numba.njit(parallel=True, cache=True)
+def _ray_shoot(x, y, types, params, beta_x, beta_y):
+    for i in numba.prange(x.size):
+        alpha_x = 0.
+        alpha_y = 0.
+        for k in range(types.size):
+            dx = x[i] - params[k, 0]
+            dy = y[i] - params[k, 1]
+            if types[k] == SIS:
+                r = np.sqrt(dx * dx + dy * dy)
+                if r > 0:
+                    alpha_x += params[k, 2] / r * dx
+                    alpha_y += params[k, 2] / r * dy
+            elif types[k] == SIE:
+                b, s, q, cos, sin, e = (params[k, 2], params[k, 3], params[k, 4], params[k, 5],
+                                        params[k, 6], params[k, 7])
+                # Major axis frame of the lens
+                u = dx * cos + dy * sin
+                v = -dx * sin + dy * cos
+                psi = np.sqrt(q ** 2 * (s ** 2 + u ** 2) + v ** 2)
+                f_u = b / e * np.arctan(e * u / (psi + s))
+                f_v = b / e * np.arctanh(e * v / (psi + q ** 2 * s))
+                alpha_x += f_u * cos - f_v * sin
+                alpha_y += f_u * sin + f_v * cos
+            else:
+                alpha_x += params[k, 2] * dx + params[k, 3] * dy
+                alpha_y += params[k, 3] * dx - params[k, 2] * dy
+        beta_x[i] = x[i] - alpha_x
+        beta_y[i] = y[i] - alpha_y
+
+
+def ray_shoot(x, y, lens_models, lens_args):
+    """ Source plane positions of image plane positions, as
+    `lenstronomy.LensModel.LensModel.ray_shooting`.
+
+    Parameters
+    ----------
+    x, y: array
+        image plane coordinates in arcseconds
+    lens_models: list
+        list of lens model names, see `SUPPORTED`
+    lens_args: list
+        list of keyword arguments of the lens models
+
+    Returns
+    -------
+    beta_x, beta_y: array
+        source plane coordinates in arcseconds
+    """
+    types, params = lens_parameters(lens_models, lens_args)
+    x = np.ascontiguousarray(x, dtype=np.float64).ravel()
+    y = np.ascontiguousarray(y, dtype=np.float64).ravel()
+    beta_x = np.empty_like(x)
+    beta_y = np.empty_like(y)
+    _ray_shoot(x, y, types, params, beta_x, beta_y)
+    return beta_x, beta_y
+
+
+class RayShooter:
+    """ Drop-in for the `ray_shooting` of a lenstronomy `LensModel` of supported models, e.g. in a
+    `DeflectionCache`.
+    """
+    def __init__(self, lens_models):
+        assert supported(lens_models), \
+            f"Lens models {lens_models} are not all in {list(SUPPORTED)}."
+        self.lens_model_list = list(lens_models)
+
+    def ray_shooting(self, x, y, kwargs):
+        return ray_shoot(x, y, self.lens_model_list, kwargs)
+
+
+@numba.njit(parallel=True, cache=True)
+def _interpolate_rebin(sources, beta_x, beta_y, nx, ny, hr_factor, out):
+    n, sy, sx = sources.shape
+    width = nx * hr_factor
+    for j in numba.prange(ny):
+        for i in range(nx):
+            for u in range(hr_factor):
+                for v in range(hr_factor):
+                    p = (j * hr_factor + u) * width + i * hr_factor + v
+                    # Indices in the source padded with a frame of zeros, clamped to its border
+                    row = min(max(beta_y[p] + (sy + 1) / 2., 0.), sy + 1.)
+                    col = min(max(beta_x[p] + (sx + 1) / 2., 0.), sx + 1.)
+                    row0 = min(int(np.floor(row)), sy)
+                    col0 = min(int(np.floor(col)), sx)
+                    dr = row - row0
+                    dc = col - col0
+                    weights = ((1 - dr) * (1 - dc), (1 - dr) * dc, dr * (1 - dc), dr * dc)
+                    for corner in range(4):
+                        r = row0 + corner // 2 - 1
+                        c = col0 + corner % 2 - 1
+                        if 0 <= r < sy and 0 <= c < sx:
+                            for band in range(n):
+                                out[band, j, i] += sources[band, r, c] * weights[corner]
+            for band in range(n):
+                out[band, j, i] /= hr_factor * hr_factor
+
+
+def interpolate_rebin(sources, beta_x, beta_y, shape, hr_factor):
+    """ Bilinear interpolation of a stack of sources averaged over the supersampled pixels of a
+    frame. Same as `desclamp.lens_sources.interpolate_sources` followed by the rebinning of
+    `Lensing_frame`, without the supersampled images.
+
+    Parameters
+    ----------
+    sources: array
+        stack of source images with shape (N, ny, nx)
+    beta_x, beta_y: array
+        pixel coordinates in the sources, relative to their centre, of the (ny * hr_factor, nx *
+        hr_factor) supersampled pixels of the frame in row-major order, shared by all sources.
+    shape: tuple
+        shape (nx, ny) of the frame
+    hr_factor: int
+        supersampling factor of the frame
+
+    Returns
+    -------
+    images: array
+        mean of the interpolated sources in each pixel of the frame, with shape (N, ny, nx)
+    """
+    nx, ny = int(shape[0]), int(shape[1])
+    sources = np.ascontiguousarray(sources, dtype=np.float64)
+    out = np.zeros((sources.shape[0], ny, nx))
+    _interpolate_rebin(sources, np.ascontiguousarray(beta_x, dtype=np.float64).ravel(),
+                       np.ascontiguousarray(beta_y, dtype=np.float64).ravel(), nx, ny,
+                       int(hr_factor), out)
+    return out
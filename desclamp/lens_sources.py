@@ -1,36 +1,375 @@
 # standard python imports
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
 import numpy as np
-import matplotlib.pyplot as plt
 
-# lenstronomy utility functions
-import lenstronomy.Util.util as util
-import lenstronomy.Util.image_util as image_util
-from lenstronomy.ImSim.image_model import ImageModel
-from lenstronomy.LensModel.lens_model import LensModel
-from lenstronomy.LightModel.light_model import LightModel
-from lenstronomy.Data.imaging_data import ImageData
-import lenstronomy.Util.simulation_util as sim_util
-from lenstronomy.Data.psf import PSF
+# lenstronomy and galsim are imported by the methods that need them, so that importing this module
+# stays fast
 
-import galsim
+from .instrumentation import timed
+
+
+class FrameCache:
+    """ LRU cache of the supersampled pixel coordinates of frame geometries and of the lenstronomy
+    `LensModel` of lens model lists.
+
+    Neither depends on the lens or source parameters, so that they are shared by all frames with the
+    same geometry and lens model list, from which `Lensing_frame` ray-traces square and rectangular
+    frames alike. Coordinates and lens models are held in a single LRU bound, and the hits and
+    misses count the lookups of both.
+    """
+    def __init__(self, maxsize=16):
+        """
+        Parameters
+        ----------
+        maxsize: `int`
+            maximum number of coordinate grids and lens models kept in memory. The least recently
+            used entry is evicted first.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(shape, pix, hr_factor):
+        """ Hashable key identifying a frame geometry: (shape, pixel size, high resolution factor)
+        """
+        return (tuple(int(s) for s in shape), float(pix), int(hr_factor))
+
+    def _get(self, key, build):
+        """ Entry of the cache, built with `build()` if it is not in the cache."""
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        entry = build()
+        self._entries[key] = entry
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def coordinates(self, shape, pix, hr_factor):
+        """ Coordinates of the supersampled pixels of a frame, computed once per geometry.
+        They are the coordinates at which lenstronomy evaluates the light of a supersampled
+        `ImageModel`, for square and rectangular frames.
+        Parameters
+        ----------
+        shape: `tuple`
+            Shape (nx, ny) of the image patch
+        pix: `float`
+            pixel size in arcseconds.
+        hr_factor: `int`
+            supersampling factor of the lens plane
+
+        Returns
+        -------
+        ra, dec: `array`
+            flattened coordinates in arcseconds of the (ny * hr_factor, nx * hr_factor) grid, in
+            row-major order.
+        """
+        key = self.key(shape, pix, hr_factor)
+
+        def build():
+            nx, ny = key[0][0] * key[2], key[0][1] * key[2]
+            scale = pix / hr_factor
+            dec, ra = np.mgrid[:ny, :nx] * scale
+            return (ra - (nx - 1) / 2. * scale).ravel(), (dec - (ny - 1) / 2. * scale).ravel()
+
+        return self._get(('coordinates',) + key, build)
+
+    def lens_model(self, lens_models):
+        """ lenstronomy `LensModel` of a lens model list, built once.
+        """
+        from lenstronomy.LensModel.lens_model import LensModel
+        return self._get(('lens_model', tuple(lens_models)), lambda: LensModel(list(lens_models)))
+
+    def clear(self):
+        """ Empties the cache and resets the hit/miss counters.
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def info(self):
+        """ Dictionary with the cache statistics.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self),
+                'maxsize': self.maxsize}
+
+
+class DeflectionCache:
+    """ LRU cache of ray-traced source plane coordinates, bounded in bytes.
+
+    For a given frame geometry and lens, the positions in the source plane of the supersampled
+    pixels of the frame do not depend on the source. Sources put behind the same lens are then
+    lensed at the cost of one interpolation. Maps can be persisted to a directory as .npy files that
+    are memory mapped by later runs.
+    """
+    def __init__(self, maxbytes=2 ** 28, path=None):
+        """
+        Parameters
+        ----------
+        maxbytes: `int`
+            maximum size in bytes of the maps kept in memory. The least recently used maps are
+            evicted first. With 0 and no `path`, the cache is disabled and maps are ray-traced at
+            each call without being hashed.
+        path: `str`
+            directory where maps are saved when computed and read from when not in memory. Maps are
+            not persisted if None.
+        """
+        self.maxbytes = maxbytes
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._maps = OrderedDict()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __len__(self):
+        return len(self._maps)
+
+    @staticmethod
+    def key(shape, pix, hr_factor, lens_models, lens_args):
+        """ Hash of the frame geometry, the lens model list and the lens keyword arguments.
+        Arguments are hashed by value, scalars and arrays alike, e.g. the coefficients of a
+        SHAPELETS_CART lens.
+        """
+        description = {'grid': FrameCache.key(shape, pix, hr_factor),
+                       'lens_models': list(lens_models),
+                       'lens_args': [{k: np.asarray(v, dtype=np.float64).tolist()
+                                      for k, v in sorted(args.items())} for args in lens_args]}
+        return hashlib.sha1(json.dumps(description).encode()).hexdigest()
+
+    def get(self, lensModel, coordinates, shape, pix, hr_factor, lens_args):
+        """ Source plane coordinates of the supersampled pixels of a frame, ray-traced if needed.
+        Parameters
+        ----------
+        lensModel: `LensModel`
+            lenstronomy lens model, or `desclamp.kernels.RayShooter`
+        coordinates: `tuple`
+            coordinates (ra, dec) of the supersampled pixels of the frame, see
+            `FrameCache.coordinates`
+        shape, pix, hr_factor:
+            geometry of the frame
+        lens_args: `list`
+            list of keyword arguments of the lens models
+
+        Returns
+        -------
+        beta: `array`
+            source plane coordinates (x, y) in arcseconds with shape (2, M). Arrays read from disk
+            are read only.
+        """
+        if self.maxbytes == 0 and self.path is None:
+            self.misses += 1
+            return np.array(lensModel.ray_shooting(*coordinates, lens_args))
+
+        key = self.key(shape, pix, hr_factor, lensModel.lens_model_list, lens_args)
+        if key in self._maps:
+            self.hits += 1
+            self._maps.move_to_end(key)
+            return self._maps[key]
+
+        self.misses += 1
+        file = None if self.path is None else os.path.join(self.path, key + ".npy")
+        if file is not None and os.path.exists(file):
+            beta = np.load(file, mmap_mode="r")
+        else:
+            beta = np.array(lensModel.ray_shooting(*coordinates, lens_args))
+            if file is not None:
+                # Written under a temporary name unique to this writer, so that concurrent runs
+                # never read or write a partial map
+                descriptor, temporary = tempfile.mkstemp(suffix=".tmp.npy", dir=self.path)
+                with os.fdopen(descriptor, "wb") as f:
+                    np.save(f, beta)
+                os.replace(temporary, file)
+
+        if beta.nbytes <= self.maxbytes:
+            self._maps[key] = beta
+            self.nbytes += beta.nbytes
+            while self.nbytes > self.maxbytes:
+                _, evicted = self._maps.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return beta
+
+    def clear(self):
+        """ Empties the in-memory cache and resets the hit/miss counters. Maps on disk are kept.
+        """
+        self._maps.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def info(self):
+        """ Dictionary with the cache statistics.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._maps),
+                'nbytes': self.nbytes, 'maxbytes': self.maxbytes}
+
+
+class MaskCache:
+    """ LRU cache of the magnification masks of adaptive frames.
+
+    The pixels of a frame that are strongly magnified depend on the frame geometry and the lens but
+    not on the source, so that the mask is computed once per lens configuration.
+    """
+    def __init__(self, maxsize=1024):
+        """
+        Parameters
+        ----------
+        maxsize: `int`
+            maximum number of masks kept in memory. The least recently used mask is evicted first.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._masks = OrderedDict()
+
+    def __len__(self):
+        return len(self._masks)
+
+    def get(self, key, compute):
+        """ Mask of a lens configuration, computed with `compute()` if it is not in the cache.
+        """
+        if key in self._masks:
+            self.hits += 1
+            self._masks.move_to_end(key)
+            return self._masks[key]
+
+        self.misses += 1
+        mask = compute()
+        self._masks[key] = mask
+        while len(self._masks) > self.maxsize:
+            self._masks.popitem(last=False)
+        return mask
+
+    def clear(self):
+        """ Empties the cache and resets the hit/miss counters.
+        """
+        self._masks.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def info(self):
+        """ Dictionary with the cache statistics.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._masks),
+                'maxsize': self.maxsize}
+
+
+def interpolate_sources(sources, x, y):
+    """ Bilinear interpolation of a stack of source images at pixel coordinates.
+    Reproduces lenstronomy's INTERPOL light profile: sources are padded with a frame of zeros and
+    coordinates falling outside of the padded image are clamped to its border.
+    Parameters
+    ----------
+    sources: `array`
+        stack of source images with shape (N, ny, nx)
+    x, y: `array`
+        pixel coordinates, relative to the centre of the source images, with shape (N, M).
+
+    Returns
+    -------
+    values: `array`
+        interpolated values with shape (N, M)
+    """
+    n, ny, nx = sources.shape
+    padded = np.zeros((n, ny + 2, nx + 2))
+    padded[:, 1:-1, 1:-1] = sources
+    padded = padded.reshape(n, -1)
+
+    # pixel coordinates to array indices of the padded images
+    row = np.clip(y + (ny + 1) / 2., 0, ny + 1)
+    col = np.clip(x + (nx + 1) / 2., 0, nx + 1)
+    row0 = np.minimum(np.floor(row).astype(int), ny)
+    col0 = np.minimum(np.floor(col).astype(int), nx)
+    dr = row - row0
+    dc = col - col0
+
+    index = row0 * (nx + 2) + col0
+    values = np.take_along_axis(padded, index, axis=1) * (1 - dr) * (1 - dc)
+    values += np.take_along_axis(padded, index + 1, axis=1) * (1 - dr) * dc
+    values += np.take_along_axis(padded, index + nx + 2, axis=1) * dr * (1 - dc)
+    values += np.take_along_axis(padded, index + nx + 3, axis=1) * dr * dc
+    return values
 
 
 class Lensing_frame:
     """ Object to described lensed sources"""
-    def __init__(self, shape=(100,100), pix = 0.2, wcs = None, hr_factor=1):
+    # pixel coordinates and lens models shared by all frames with the same geometry
+    frame_cache = FrameCache()
+    # ray-traced coordinates shared by all frames with the same geometry and lens. Disabled by
+    # default, as random lenses are never seen twice: set it to a `DeflectionCache()` to reuse them.
+    deflection_cache = DeflectionCache(maxbytes=0)
+    # magnification masks of adaptive frames, shared by all frames with the same geometry and lens
+    mask_cache = MaskCache()
+
+    def __init__(self, shape=(100,100), pix = 0.2, wcs = None, hr_factor=1, method='real_space',
+                 dtype=np.float64, reuse_buffer=False, draw_kwargs=None, kernel='lenstronomy',
+                 supersampling='uniform', flux_threshold=0.01, magnification_threshold=5.):
         """
         Source object that carries source and lens information and generates lensed source images for injection.
         Parameters
         ----------
         shape: `tuple`
-            Shape of the image patch
+            Shape (nx, ny) of the image patch. Images are arrays with shape (ny, nx).
         pix: `float`
             pixel size in arcseconds. Default is Rubin's pixel.
         wcs: WCS
             wcs information for the source patch.  
         hr_factor: `float`
             the high resolution factor between source and lens plane
+        method: `str`
+            galsim drawing method of the sources: 'real_space', 'fft', 'phot' (photon shooting) or
+            'auto' to let galsim choose between fft and real space convolution by the pixel.
+        dtype: type
+            data type of the source images. np.float32 halves their memory.
+        reuse_buffer: `bool`
+            if True, sources are drawn in place into one image allocated by the frame. `source` is
+            then overwritten by the next source drawn, and should be copied by callers that keep it.
+        draw_kwargs: `dict`
+            extra arguments of `galsim.GSObject.drawImage`, e.g. `rng` and `n_photons` for photon
+            shooting.
+        kernel: `str`
+            ray-shooting and interpolation of the lensed sources: 'lenstronomy', 'numba' for the
+            compiled kernels of `desclamp.kernels` or 'auto' to use them when Numba is installed.
+            The kernels only handle SIS, SIE and SHEAR lenses, other lens models fall back to
+            lenstronomy.
+        supersampling: `str`
+            'uniform' ray-traces every pixel on a hr_factor x hr_factor grid. 'adaptive' only
+            supersamples the pixels that are magnified by more than `magnification_threshold` or
+            brighter than `flux_threshold` times the peak of the lensed source in one of its bands,
+            and their neighbours. Other pixels are sampled at their centre. With the default
+            thresholds, the flux of the lensed source is within 1e-3 of uniform supersampling and
+            pixels are within 1e-3 of its peak, for a fraction of the cost at hr_factor=4 and above.
+        flux_threshold: `float`
+            fraction of the peak of the lensed source above which pixels are supersampled in
+            adaptive mode
+        magnification_threshold: `float`
+            absolute magnification above which pixels are supersampled in adaptive mode
         """
+        assert kernel in ('lenstronomy', 'numba', 'auto'), \
+            "kernel should be 'lenstronomy', 'numba' or 'auto'."
+        assert supersampling in ('uniform', 'adaptive'), \
+            "supersampling should be 'uniform' or 'adaptive'."
         if pix is None: 
             assert wcs is not None
             try:
@@ -44,26 +383,239 @@ class Lensing_frame:
         self.shape = shape
         self._source = None # An image of the source
         self.source_args = None # source arguments dictionary
+        self.method = method
+        self.dtype = dtype
+        self.reuse_buffer = reuse_buffer
+        self.draw_kwargs = draw_kwargs or {}
+        self._buffer = None
+        if kernel == 'auto':
+            kernel = 'numba' if importlib.util.find_spec('numba') is not None else 'lenstronomy'
+        self.kernel = kernel
+        self.supersampling = supersampling
+        self.flux_threshold = flux_threshold
+        self.magnification_threshold = magnification_threshold
     
+    @timed("Lensing_frame.lens_source")
     def lens_source(self, lens_models, lens_args):
+        """ Lenses the source with a given lens model.
+        The source plane coordinates of the frame are fetched from `deflection_cache`, so that only
+        the interpolation of the source is computed for a lens that has already been seen when the
+        cache is enabled. The result matches the image of lenstronomy's INTERPOL light profile.
+        Parameters
+        ----------
+        lens_models: `list`
+            list of lenstronomy lens model names
+        lens_args: `list`
+            list of keyword arguments of the lens models
+
+        Returns
+        -------
+        lensed_image: `array`
+            image of the lensed source with shape (shape[1], shape[0]), or cube of images with shape
+            (bands, shape[1], shape[0]) for a multi-band source, see `lens_cube`.
+        """
         assert self.source is not None, "Please provide a source image."
+        if np.ndim(self.source) == 3:
+            return self.lens_cube(self.source, lens_models, lens_args)
+        return self.lens_cube(self.source[None], lens_models, lens_args)[0]
+
+    @timed("Lensing_frame.lens_batch")
+    def lens_batch(self, sources, lens_models, lens_args):
+        """ Lenses a stack of sources, each with its own set of lens parameters.
+        Deflections are computed over the full supersampled grid for each set of lens parameters,
+        sources are then interpolated at the ray-traced positions and rebinned to the frame
+        resolution all at once. The result matches `lens_source` applied to each source in turn.
+        Parameters
+        ----------
+        sources: `array`
+            stack of source images with shape (N, ny, nx), drawn with the same geometry as `source`.
+        lens_models: `list`
+            list of lenstronomy lens model names, shared by all the lenses
+        lens_args: `list`
+            list of N lists of keyword arguments of the lens models
+
+        Returns
+        -------
+        lensed_images: `array`
+            images of the lensed sources with shape (N, shape[1], shape[0])
+        """
+        sources = np.asarray(sources, dtype=np.float64)
+        assert sources.ndim == 3, "sources should be a stack of images with shape (N, ny, nx)."
+        assert len(lens_args) == sources.shape[0], \
+            "Please provide one set of lens arguments per source."
+
+        if self.supersampling == 'adaptive':
+            return np.concatenate([self._lens_adaptive(source[None], lens_models, args)
+                                   for source, args in zip(sources, lens_args)])
+        kernels = self._kernels(lens_models)
+        if kernels is not None:
+            lensed = [kernels.interpolate_rebin(source[None], *self._ray_shoot(lens_models, args),
+                                                self.shape, self.hr_factor)
+                      for source, args in zip(sources, lens_args)]
+            return np.concatenate(lensed) * self.pix ** 2
+        beta = np.array([self._ray_shoot(lens_models, args) for args in lens_args])
+        lensed = interpolate_sources(sources, beta[:, 0], beta[:, 1])
+        return self._rebin(lensed)
+
+    @timed("Lensing_frame.lens_cube")
+    def lens_cube(self, cube, lens_models, lens_args):
+        """ Lenses a multi-band source, e.g. one with colour gradients, in one pass.
+        Rays are shot once through the lens and all the bands are interpolated at the same source
+        plane positions, so that the cost is close to the one of a single band. Each band matches
+        `lens_source` on that band alone.
+        Parameters
+        ----------
+        cube: `array`
+            images of the source in each band with shape (bands, ny, nx), drawn with the same
+            geometry as `source`.
+        lens_models: `list`
+            list of lenstronomy lens model names
+        lens_args: `list`
+            list of keyword arguments of the lens models
+
+        Returns
+        -------
+        lensed_cube: `array`
+            images of the lensed source in each band with shape (bands, shape[1], shape[0])
+        """
+        cube = np.asarray(cube, dtype=np.float64)
+        assert cube.ndim == 3, "cube should have shape (bands, ny, nx)."
+        if self.supersampling == 'adaptive':
+            return self._lens_adaptive(cube, lens_models, lens_args)
+
+        beta_x, beta_y = self._ray_shoot(lens_models, lens_args)
+        kernels = self._kernels(lens_models)
+        if kernels is not None:
+            lensed = kernels.interpolate_rebin(cube, beta_x, beta_y, self.shape, self.hr_factor)
+            return lensed * self.pix ** 2
+        n_bands = cube.shape[0]
+        lensed = interpolate_sources(cube, np.broadcast_to(beta_x, (n_bands, beta_x.size)),
+                                     np.broadcast_to(beta_y, (n_bands, beta_y.size)))
+        return self._rebin(lensed)
+
+    def _ray_shoot(self, lens_models, lens_args):
+        """ Source plane positions of the supersampled pixels of the frame, in pixels of the source
+        images.
+        """
+        lensModel = self._lens_model(lens_models)
+        coordinates = self.frame_cache.coordinates(self.shape, self.pix, self.hr_factor)
+        beta_x, beta_y = self.deflection_cache.get(lensModel, coordinates, self.shape, self.pix,
+                                                   self.hr_factor, lens_args)
+        scale = self.pix / self.hr_factor
+        return beta_x / scale, beta_y / scale
+
+    def _lens_model(self, lens_models):
+        """ Ray-shooting model of the lens, compiled if the frame uses the kernels.
+        """
+        kernels = self._kernels(lens_models)
+        if kernels is not None:
+            return kernels.RayShooter(lens_models)
+        return self.frame_cache.lens_model(lens_models)
+
+    def magnification_mask(self, lens_models, lens_args):
+        """ Pixels of the frame magnified by more than `magnification_threshold`, computed once per
+        lens. The magnification is estimated from the source plane positions of the pixel centres by
+        finite differences.
+
+        Returns
+        -------
+        mask: `array`
+            boolean mask with shape (shape[1], shape[0])
+        """
+        nx, ny = int(self.shape[0]), int(self.shape[1])
+        key = (DeflectionCache.key(self.shape, self.pix, 1, lens_models, lens_args),
+               float(self.magnification_threshold))
+
+        def compute():
+            lensModel = self._lens_model(lens_models)
+            coordinates = self.frame_cache.coordinates(self.shape, self.pix, 1)
+            beta_x, beta_y = self.deflection_cache.get(lensModel, coordinates, self.shape, self.pix,
+                                                       1, lens_args)
+            dxdy, dxdx = np.gradient(np.reshape(beta_x, (ny, nx)), self.pix)
+            dydy, dydx = np.gradient(np.reshape(beta_y, (ny, nx)), self.pix)
+            # |magnification| = 1 / |det(A)| with A the jacobian of the lens equation
+            return np.abs(dxdx * dydy - dxdy * dydx) * self.magnification_threshold < 1
+
+        return self.mask_cache.get(key, compute)
+
+    def _lens_adaptive(self, cube, lens_models, lens_args):
+        """ Lenses a stack of sources, supersampling the pixels selected by `magnification_mask` or
+        by their flux.
+        """
+        from scipy import ndimage
+        nx, ny = int(self.shape[0]), int(self.shape[1])
+        hr_factor = self.hr_factor
+        scale = self.pix / hr_factor
+        n_bands = cube.shape[0]
+        lensModel = self._lens_model(lens_models)
+
+        # Lensed sources sampled at the pixel centres
+        ra, dec = self.frame_cache.coordinates(self.shape, self.pix, 1)
+        beta_x, beta_y = self.deflection_cache.get(lensModel, (ra, dec), self.shape, self.pix, 1,
+                                                   lens_args)
+        lensed = interpolate_sources(cube, np.broadcast_to(beta_x / scale, (n_bands, beta_x.size)),
+                                     np.broadcast_to(beta_y / scale, (n_bands, beta_y.size)))
+
+        peak = np.max(lensed, axis=1, keepdims=True)
+        bright = np.any(lensed > self.flux_threshold * peak, axis=0)
+        mask = bright.reshape(ny, nx) | self.magnification_mask(lens_models, lens_args)
+        index = np.flatnonzero(ndimage.binary_dilation(mask))
+        if len(index) == 0 or hr_factor == 1:
+            return lensed.reshape(n_bands, ny, nx) * self.pix ** 2
+
+        # Supersampled positions of the selected pixels, as in `FrameCache.coordinates`
+        offsets = (np.arange(hr_factor) - (hr_factor - 1) / 2.) * scale
+        x = (ra[index, None] + np.tile(offsets, hr_factor)).ravel()
+        y = (dec[index, None] + np.repeat(offsets, hr_factor)).ravel()
+        fine_x, fine_y = lensModel.ray_shooting(x, y, lens_args)
+        fine = interpolate_sources(cube,
+                                   np.broadcast_to(np.asarray(fine_x) / scale, (n_bands, x.size)),
+                                   np.broadcast_to(np.asarray(fine_y) / scale, (n_bands, y.size)))
+        lensed[:, index] = fine.reshape(n_bands, len(index), hr_factor ** 2).mean(axis=2)
+        return lensed.reshape(n_bands, ny, nx) * self.pix ** 2
+
+    def _kernels(self, lens_models):
+        """ The `desclamp.kernels` module if the frame uses it for these lens models, None
+        otherwise.
+        """
+        if self.kernel == 'lenstronomy':
+            return None
+        from . import kernels
+        return kernels if kernels.supported(lens_models) else None
+
+    def _rebin(self, lensed):
+        """ Averages a stack of supersampled images down to the frame resolution, in units of flux
+        per pixel.
+        """
+        nx, ny = int(self.shape[0]), int(self.shape[1])
+        lensed = lensed.reshape(-1, ny, self.hr_factor, nx, self.hr_factor).mean(axis=(2, 4))
+        return lensed * self.pix ** 2
+
+    @timed("Lensing_frame.from_gsobjects")
+    def from_gsobjects(self, gsobjects, smooth=0):
+        """ Creates a multi-band Lensed source from one galsim object per band.
+        Parameters
+        ----------
+        gsobjects: list of Galsim Objects
+            images of the galaxy in each band, e.g. the bulge and disk of a galaxy with different
+            colours.
+        smooth: bool
+            Value of the sigma for a gaussian smoothing kernel, see `from_gsobject`.
+
+        Returns
+        -------
+        A `Lensed_source` object whose source is a cube with shape (bands, ny, nx).
+        """
+        import galsim
+        cube = []
+        for gso in gsobjects:
+            if smooth > 0:
+                gso = galsim.Convolve(gso, galsim.Gaussian(sigma=smooth))
+            # Copies, the buffer of the frame is reused by each band
+            cube.append(np.array(self.draw_galsim(gso)))
+        self.source = np.array(cube)
+        return self
 
-        kwargs_image = sim_util.data_configure_simple(int(self.shape[0]),  # Issue with rectangle shapes
-                                                              self.pix)
-        image = ImageData(**kwargs_image)
-        
-        lensModel = LensModel(lens_models)
-        lightModel = LightModel(light_model_list=['INTERPOL'])
-        
-        imageModel = ImageModel(data_class=image, 
-                                         lens_model_class=lensModel, 
-                                         source_model_class=lightModel,
-                                         psf_class=PSF(psf_type='NONE'),
-                                         kwargs_numerics = {'supersampling_factor': self.hr_factor, 
-                                                            'supersampling_convolution': False})
-        lensed_image = imageModel.image(lens_args, self.source_args)
-        return lensed_image
-    
     def draw_source(self):
         """ Draws a soource no a grid specified by the parameters of the __init__
         """
@@ -82,6 +634,7 @@ class Lensing_frame:
         self._source = source
         self.source_args = self.draw_source()
     
+    @timed("Lensing_frame.from_gsobject")
     def from_gsobject(self, gsobject, smooth=0):
         """ Creates a Lensed source from a galsim object.
         Parameters
@@ -91,22 +644,80 @@ class Lensing_frame:
         smooth: bool
             Value of the sigma for a gaussian smoothing kernel. Useful to apply if the input image is noisy or contains sharp features.
         """
+        import galsim
+        gso = gsobject
         if smooth > 0:
             gso = galsim.Convolve(gsobject, galsim.Gaussian(sigma=smooth))
+        self.source = self.draw_galsim(gso)
+        return self
+
+    def draw_galsim(self, gso, method=None):
+        """ Draws a galsim object on the grid of the source.
+        Parameters
+        ----------
+        gso: Galsim Object
+            object to draw
+        method: `str`
+            drawing method, overrides the method of the frame.
+
+        Returns
+        -------
+        source: `array`
+            image of the object
+        """
+        import galsim
+        method = method or self.method
+        nx, ny = self.shape[0]*self.hr_factor, self.shape[1]*self.hr_factor
+        if self.reuse_buffer:
+            if self._buffer is None or self._buffer.array.shape != (ny, nx):
+                self._buffer = galsim.Image(nx, ny, scale=self.pix/self.hr_factor, dtype=self.dtype)
+            # Draws in place, the buffer is overwritten
+            gso.drawImage(image=self._buffer,
+                use_true_center = True,
+                method=method,
+                **self.draw_kwargs)
+            return self._buffer.array
+
         #Draws the galsim object on a grid    
-        source = gso.drawImage(nx=self.shape[0]*self.hr_factor,
-            ny=self.shape[1]*self.hr_factor,
+        return gso.drawImage(nx=nx,
+            ny=ny,
             use_true_center = True,
-            method='real_space',
+            method=method,
             scale=self.pix/self.hr_factor,
-            dtype=np.float64).array
-        self.source = source
-        return self
+            dtype=self.dtype,
+            **self.draw_kwargs).array
         
+    @timed("Lensing_frame.from_lenstronomy")
     def from_lenstronomy(self, kwargs):
         """TO DO"""
         pass
     
+    @timed("Lensing_frame.from_library")
+    def from_library(self, library, index, half_light_radius, shift=(0,0), shear=(0,0)):
+        """ Creates a Lensed source object from the pre-rendered profiles of a `SourceLibrary`.
+        This is a fast approximation of `from_galsim_parametric`, see `SourceLibrary.accuracy`.
+        Parameters
+        ----------
+        library: `desclamp.source_library.SourceLibrary`
+            library built for the shape, pixel size and hr_factor of this frame
+        index: `float`
+            Sersic n or Spergel nu, depending on the profile of the library
+        half_light_radius: `float`
+            half-light radius in arcseconds
+        shift, shear: `tuple`
+            shift in arcseconds and reduced shear of the source
+
+        Returns
+        -------
+        A `Lensed_source` object.
+        """
+        library_frame = (tuple(library.shape), library.pix, library.hr_factor)
+        assert library_frame == (tuple(self.shape), self.pix, self.hr_factor), \
+            "The library was built for a different frame."
+        self.source = library.draw(index, half_light_radius, shift=shift, shear=shear)
+        return self
+
+    @timed("Lensing_frame.from_galsim_parametric")
     def from_galsim_parametric(self, *args, profile='Spergel', shift=(0,0), shear=(0,0), **kwargs):
         """ Creates a Lensed source object from a source described as a parametric profile.
         Parameters
@@ -122,6 +733,7 @@ class Lensing_frame:
         """
         
         assert profile in ['Sersic', 'Exponential', 'DeVeaucouleurs', 'Spergel'], "Not a valid profile. Please use 'Sersic', 'Exponential' or 'DeVeaucouleurs'."
+        import galsim
         
         if profile == 'Sersic':
             assert len(args)==1
@@ -130,24 +742,137 @@ class Lensing_frame:
             assert len(args)==1
             gso = galsim.Spergel(nu= args[0], **kwargs)
         elif profile == 'Exponential':
-            gso = galsim.Exponential(*args, *kwargs)
+            gso = galsim.Exponential(*args, **kwargs)
         else:
-            gso = galsim.DeVeaucouleurs(*args, *kwargs)
+            gso = galsim.DeVeaucouleurs(*args, **kwargs)
             
         gso = gso.shear(g1=shear[0],g2=shear[1])
         gso = gso.shift(dx=shift[0],dy=shift[1])
         
-        #Draws the galsim object on a grid    
-        source = gso.drawImage(nx=self.shape[0]*self.hr_factor,
-            ny=self.shape[1]*self.hr_factor,
-            use_true_center = True,
-            method='real_space',
-            scale=self.pix/self.hr_factor,
-            dtype=np.float64).array
-        self.source = source
+        self.source = self.draw_galsim(gso)
         return self
-    
-    
-    
-    
-    
\ No newline at end of file
+
+
+# Lensing frame owned by each worker process of a `LensedSourceGenerator`
+_worker_frame = None
+
+
+def _init_worker(shape, pix, hr_factor, kernel='lenstronomy', n_threads=None, cache_bytes=0):
+    global _worker_frame
+    _worker_frame = Lensing_frame(shape=shape, pix=pix, hr_factor=hr_factor, kernel=kernel)
+    # Deflection cache of the worker, in place of the one shared by the frames of the process
+    _worker_frame.deflection_cache = DeflectionCache(maxbytes=cache_bytes)
+    if n_threads is not None and _worker_frame.kernel == 'numba':
+        import numba
+        numba.set_num_threads(n_threads)
+
+
+def _lens_one(sampler, seed):
+    """ Draws and lenses one source in the current worker, from a seed specific to the item.
+    """
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    source_args, source_kwargs, lens_models, lens_args = sampler(rng)
+    _worker_frame.from_galsim_parametric(*source_args, **source_kwargs)
+    lensed = _worker_frame.lens_source(lens_models, lens_args)
+    params = {'source_args': source_args, 'source_kwargs': source_kwargs,
+              'lens_models': lens_models, 'lens_args': lens_args}
+    return lensed, params, os.getpid(), time.perf_counter() - start
+
+
+class LensedSourceGenerator:
+    """ Draws and lenses parametric sources in parallel over a pool of processes.
+    Each worker holds its own `Lensing_frame`. Every item gets a seed derived from the master seed
+    and its position, so that the generated set does not depend on the number of workers.
+    """
+    def __init__(self, shape=(100, 100), pix=0.2, hr_factor=1, n_workers=None, seed=0,
+                 kernel='lenstronomy', cache_bytes=0):
+        """
+        Parameters
+        ----------
+        shape: `tuple`
+            Shape of the image patch
+        pix: `float`
+            pixel size in arcseconds.
+        hr_factor: `int`
+            the high resolution factor between source and lens plane
+        n_workers: `int`
+            number of worker processes. Defaults to the number of cpus. With one worker, sources are
+            generated in the calling process.
+        seed: `int`
+            master seed from which the seeds of the individual items are derived.
+        kernel: `str`
+            lensing kernel of the frames of the workers, see `Lensing_frame`
+        cache_bytes: `int`
+            size of the `DeflectionCache` of each worker. Randomly drawn lenses are rarely seen
+            twice, so the cache is disabled by default.
+        """
+        self.shape = shape
+        self.pix = pix
+        self.hr_factor = hr_factor
+        self.n_workers = n_workers or os.cpu_count()
+        self.seed = seed
+        self.kernel = kernel
+        self.cache_bytes = cache_bytes
+        self.stats = {}
+
+    def seeds(self, n):
+        """ Seeds of the first `n` items.
+        """
+        return np.random.SeedSequence(self.seed).spawn(n)
+
+    def generate(self, sampler, n, chunksize=None):
+        """ Generates `n` lensed sources.
+        Parameters
+        ----------
+        sampler: callable
+            picklable function that takes a `numpy.random.Generator` and returns a tuple
+            (source_args, source_kwargs, lens_models, lens_args). `source_args` and `source_kwargs`
+            are passed to `Lensing_frame.from_galsim_parametric`, `lens_models` and `lens_args` to
+            `Lensing_frame.lens_source`.
+        n: `int`
+            number of lensed sources to generate
+        chunksize: `int`
+            number of items sent at once to a worker. Defaults to an even split of the items over 4
+            chunks per worker.
+
+        Returns
+        -------
+        images: `array`
+            lensed sources with shape (n, ny, nx), in the order of the items
+        params: `list`
+            parameters used for each item
+        """
+        seeds = self.seeds(n)
+        samplers = [sampler] * n
+        start = time.perf_counter()
+        if self.n_workers == 1:
+            _init_worker(self.shape, self.pix, self.hr_factor, self.kernel,
+                         cache_bytes=self.cache_bytes)
+            results = list(map(_lens_one, samplers, seeds))
+        else:
+            if chunksize is None:
+                chunksize = max(1, n // (4 * self.n_workers))
+            # Processes forked after the threads of the compiled kernels have started hang, workers
+            # are then started from a fresh server process. Each worker runs the kernels on one
+            # thread.
+            method = 'forkserver' if 'desclamp.kernels' in sys.modules else None
+            context = multiprocessing.get_context(method)
+            with ProcessPoolExecutor(max_workers=self.n_workers, mp_context=context,
+                                     initializer=_init_worker,
+                                     initargs=(self.shape, self.pix, self.hr_factor, self.kernel, 1,
+                                               self.cache_bytes)) as executor:
+                results = list(executor.map(_lens_one, samplers, seeds, chunksize=chunksize))
+        wall = time.perf_counter() - start
+
+        self.stats = {'n_images': n, 'wall_time': wall, 'images_per_sec': n / wall, 'workers': {}}
+        for _, _, pid, elapsed in results:
+            worker = self.stats['workers'].setdefault(pid, {'n_images': 0, 'time': 0.})
+            worker['n_images'] += 1
+            worker['time'] += elapsed
+        for worker in self.stats['workers'].values():
+            worker['images_per_sec'] = worker['n_images'] / worker['time']
+
+        images = np.array([r[0] for r in results])
+        params = [r[1] for r in results]
+        return images, params
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+
+
+def asinh_rgb(images, minimum=0, data_range=2, q=8):
+    """ Lupton et al. (2004) asinh RGB stretch of a stack of 3-band images, as in
+    `lsst.afw.display.rgb.makeRGB`.
+
+    Parameters
+    ----------
+    images: array
+        images with shape (N, 3, ny, nx), the bands being mapped to red, green and blue in that
+        order.
+    minimum: float or list
+        intensity mapped to black, per band
+    data_range: float
+        range of intensities mapped to the full scale
+    q: float
+        asinh softening parameter
+
+    Returns
+    -------
+    rgb: array
+        uint8 images with shape (N, ny, nx, 3)
+    """
+    images = np.array(images, dtype=np.float64)
+    assert images.ndim == 4 and images.shape[1] == 3, "images should have shape (N, 3, ny, nx)."
+    images -= np.broadcast_to(minimum, 3)[None, :, None, None]
+
+    pixmax = 255.
+    q = 0.1 if abs(q) < 1. / 2 ** 23 else min(q, 1e10)
+    frac = 0.1
+    slope = frac * pixmax / np.arcsinh(frac * q)
+    soften = q / float(data_range)
+
+    intensity = np.mean(images, axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        factor = np.where(intensity <= 0, 0, np.arcsinh(intensity * soften) * slope / intensity)
+    images *= factor
+    images[images < 0] = 0
+
+    # Saturated pixels are scaled down by their brightest band, which keeps their colour
+    with np.errstate(invalid='ignore', divide='ignore'):
+        brightest = np.max(images, axis=1, keepdims=True)
+        images = np.where(brightest >= pixmax, images * pixmax / brightest, images)
+    images[images > pixmax] = pixmax
+    return np.moveaxis(images.astype(np.uint8), 1, -1)
+
+
+def tile(stamps, ncols=None, gap=2, fill=255):
+    """ Tiles a stack of RGB stamps into one image, row by row from the top left.
+    Stamps are flipped vertically, so that the mosaic shown with the default `origin='upper'` of
+    `imshow` has the same orientation as the stamps shown with `origin='lower'`.
+
+    Parameters
+    ----------
+    stamps: array
+        uint8 images with shape (N, ny, nx, 3)
+    ncols: int
+        number of columns. Defaults to a square mosaic.
+    gap: int
+        pixels between the stamps
+    fill: int
+        value of the pixels between the stamps
+
+    Returns
+    -------
+    mosaic: array
+        uint8 image of the mosaic
+    positions: array
+        (row, column) of the tile of each stamp
+    """
+    n, ny, nx, _ = stamps.shape
+    if ncols is None:
+        ncols = max(1, int(np.ceil(np.sqrt(n))))
+    nrows = max(1, int(np.ceil(n / ncols)))
+    rows, cols = np.divmod(np.arange(n), ncols)
+    # Stamps padded with the gap on their top and right, then arranged in (nrows, ny + gap, ncols,
+    # nx + gap) blocks
+    padded = np.full((nrows * ncols, ny + gap, nx + gap, 3), fill, dtype=np.uint8)
+    padded[:n, :ny, :nx] = stamps[:, ::-1]
+    mosaic = padded.reshape(nrows, ncols, ny + gap, nx + gap, 3).swapaxes(1, 2)
+    mosaic = mosaic.reshape(nrows * (ny + gap), ncols * (nx + gap), 3)[:-gap or None, :-gap or None]
+    return np.ascontiguousarray(mosaic), np.stack([rows, cols], axis=1)
+
+
+def render_mosaic(images, object_ids, ncols=None, per_page=None, path=None, minimum=0,
+                  data_range=2, q=8, gap=2):
+    """ Renders stacks of 3-band stamps as RGB mosaics, optionally written as png pages.
+
+    Parameters
+    ----------
+    images: array
+        images with shape (N, 3, ny, nx)
+    object_ids: array
+        objectId of each stamp
+    ncols: int
+        number of columns of the mosaics. Defaults to square pages.
+    per_page: int
+        number of stamps per mosaic. Defaults to a single mosaic.
+    path: str
+        format string of the png files, e.g. "mosaic_{page:03d}.png". Mosaics are returned instead
+        if None.
+    minimum, data_range, q:
+        parameters of the asinh stretch, see `asinh_rgb`
+    gap: int
+        pixels between the stamps
+
+    Returns
+    -------
+    mosaics: list
+        uint8 RGB images of the pages, empty if written to `path`
+    index: pandas DataFrame
+        "page", "row", "column" of the tile and pixel bounds "x0", "y0" of each objectId in its
+        mosaic
+    """
+    n = len(images)
+    per_page = per_page or max(n, 1)
+    mosaics = []
+    index = []
+    for page, start in enumerate(range(0, n, per_page)):
+        stamps = asinh_rgb(images[start:start + per_page], minimum=minimum, data_range=data_range,
+                           q=q)
+        mosaic, positions = tile(stamps, ncols=ncols, gap=gap)
+        ny, nx = stamps.shape[1:3]
+        index.append(pd.DataFrame({"objectId": np.asarray(object_ids[start:start + per_page]),
+                                   "page": page,
+                                   "row": positions[:, 0],
+                                   "column": positions[:, 1],
+                                   "x0": positions[:, 1] * (nx + gap),
+                                   "y0": positions[:, 0] * (ny + gap)}))
+        if path is None:
+            mosaics.append(mosaic)
+        else:
+            import matplotlib.pyplot as plt
+            plt.imsave(path.format(page=page), mosaic)
+    index = pd.concat(index, ignore_index=True) if index else pd.DataFrame(
+        columns=["objectId", "page", "row", "column", "x0", "y0"])
+    return mosaics, index
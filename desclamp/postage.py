@@ -1,23 +1,15 @@
 # A few common packages
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
-import copy
-# We will use astropy's WCS and ZScaleInterval for plotting
-from astropy.wcs import WCS
-# Also to convert sky coordinates
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import galsim
-# We will use several stack functions
-import lsst.geom
-import lsst.afw.display.rgb as rgb
-# Source injection
-from lsst.pipe.tasks.insertFakes import _add_fake_sources
+from .mosaic import render_mosaic
+from .instrumentation import timed
 
-# And also DESC packages to get the data path
-import GCRCatalogs
-from GCRCatalogs import GCRQuery
-import desc_dc2_dm_data
+# The LSST stack, galsim, GCRCatalogs and the DESC data packages are imported by the functions that
+# use them, so that this module can be imported, e.g. by pool workers, without them.
 
 
 def catalog_setup(dc2_data_version):
@@ -28,6 +20,9 @@ def catalog_setup(dc2_data_version):
         dc2_data_version: str
             data version of the catalog. This is used to instantiate the butler.
         """
+        import GCRCatalogs
+        import desc_dc2_dm_data
+
         # Fetch GCR catalogs
         GCRCatalogs.get_available_catalogs(names_only=True, name_contains=dc2_data_version)
         cat = GCRCatalogs.load_catalog("dc2_object_run"+dc2_data_version)
@@ -37,27 +32,433 @@ def catalog_setup(dc2_data_version):
 
         return cat, butler
 
+
+def _add_fake_sources(exposure, objects):
+    """ Source injection of `lsst.pipe.tasks.insertFakes`."""
+    from lsst.pipe.tasks.insertFakes import _add_fake_sources
+    return _add_fake_sources(exposure, objects)
+
+
+# Errors of butler reads that are worth retrying, TimeoutError included
+TRANSIENT_ERRORS = (OSError,)
+# I/O errors that a retry cannot fix, raised at once
+PERMANENT_ERRORS = (FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError)
+
+
+def exposure_nbytes(exposure):
+    """ Bytes of the image, mask and variance planes of an exposure."""
+    return sum(getattr(exposure, plane).array.nbytes for plane in ("image", "mask", "variance")
+               if hasattr(exposure, plane))
+
+
+@timed("butler_get", nbytes=exposure_nbytes)
+def butler_get(butler, *args, retries=3, backoff=0.5, **kwargs):
+    """ Butler read with retries and exponential backoff on transient I/O failures. Missing or
+    unreadable files are not retried.
+
+    Parameters
+    ----------
+    butler: Butler
+        butler to read from
+    retries: int
+        number of times a failed read is retried before the error is raised.
+    backoff: float
+        waiting time in seconds before the first retry. It doubles after each failure.
+    args, kwargs:
+        arguments of `butler.get`
+    """
+    for attempt in range(retries + 1):
+        try:
+            return butler.get(*args, **kwargs)
+        except PERMANENT_ERRORS:
+            raise
+        except TRANSIENT_ERRORS:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def sky_to_pixel(wcs, ra, dec):
+    """ Pixel coordinates of arrays of sky positions.
+
+    Parameters
+    ----------
+    wcs: lsst SkyWcs or astropy WCS
+        wcs of the tract
+    ra, dec: array
+        sky coordinates in degrees
+
+    Returns
+    -------
+    x, y: array
+        pixel coordinates
+    """
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    if hasattr(wcs, "skyToPixelArray"):
+        x, y = wcs.skyToPixelArray(ra, dec, degrees=True)
+    elif hasattr(wcs, "all_world2pix"):
+        x, y = wcs.all_world2pix(ra, dec, 0)
+    else:
+        import lsst.geom
+        centers = [wcs.skyToPixel(lsst.geom.SpherePoint(r, d, lsst.geom.degrees))
+                   for r, d in zip(ra, dec)]
+        x = np.array([c.x for c in centers])
+        y = np.array([c.y for c in centers])
+    return np.asarray(x), np.asarray(y)
+
+
+def pixel_scale(wcs, point):
+    """ Pixel size in arcseconds of a wcs at a pixel position.
+
+    Parameters
+    ----------
+    wcs: lsst SkyWcs or astropy WCS
+        wcs of the exposure
+    point: lsst.geom.Point2D or tuple
+        pixel position, see `_point2d`
+    """
+    if hasattr(wcs, "getPixelScale"):
+        return wcs.getPixelScale(point).asArcseconds()
+    from astropy.wcs.utils import proj_plane_pixel_scales
+    return float(np.sqrt(np.prod(proj_plane_pixel_scales(wcs)))) * 3600
+
+
+def cutout_plan(objects, skymap, cutout_size=100):
+    """ Computes the pixel positions and bounding boxes of the cutouts of a catalog.
+    Positions are computed with one call to the wcs of each tract.
+
+    Parameters
+    ----------
+    objects: pandas DataFrame
+        catalog with "ra" and "dec" columns in degrees. Objects are assigned to their "tract" if the
+        column exists, or to the tract found by the skymap otherwise.
+    skymap: SkyMap
+        skymap of the coadds. Tract wcs are accessed as `skymap[tract].getWcs()`, and may be astropy
+        WCS.
+    cutout_size: int
+        size of the cutouts in pixels
+
+    Returns
+    -------
+    plan: pandas DataFrame
+        table with the same index as `objects` and columns "tract", "x", "y" (pixel center) and
+        "min_x", "min_y" (lower corner of the cutout bounding box).
+    """
+    ra = objects["ra"].to_numpy(dtype=np.float64)
+    dec = objects["dec"].to_numpy(dtype=np.float64)
+    x = np.zeros(len(objects))
+    y = np.zeros(len(objects))
+    if "tract" in objects:
+        tracts = objects["tract"].to_numpy()
+        for tract in np.unique(tracts):
+            in_tract = tracts == tract
+            x[in_tract], y[in_tract] = sky_to_pixel(skymap[tract].getWcs(), ra[in_tract],
+                                                    dec[in_tract])
+    else:
+        tracts = np.zeros(len(objects), dtype=np.int64)
+        # The tract of the first unassigned object is found by the skymap, and all the unassigned
+        # objects that fall in its bounding box are assigned to it. Objects in the overlap of two
+        # tracts go to the first one found.
+        unassigned = np.arange(len(objects))
+        while len(unassigned) > 0:
+            tract_info = skymap.findTract(_sphere_point(ra[unassigned[0]], dec[unassigned[0]]))
+            tract_x, tract_y = sky_to_pixel(tract_info.getWcs(), ra[unassigned], dec[unassigned])
+            bbox = tract_info.getBBox()
+            inside = ((tract_x >= bbox.getMinX() - 0.5) & (tract_x < bbox.getMaxX() + 0.5) &
+                      (tract_y >= bbox.getMinY() - 0.5) & (tract_y < bbox.getMaxY() + 0.5))
+            inside[0] = True
+            tracts[unassigned[inside]] = tract_info.getId()
+            x[unassigned[inside]], y[unassigned[inside]] = tract_x[inside], tract_y[inside]
+            unassigned = unassigned[~inside]
+
+    # Lower corner rounded to the nearest pixel, as done by lsst.geom.Point2I
+    plan = pd.DataFrame({"tract": tracts,
+                         "x": x,
+                         "y": y,
+                         "min_x": np.floor(x - cutout_size * 0.5 + 0.5).astype(int),
+                         "min_y": np.floor(y - cutout_size * 0.5 + 0.5).astype(int)},
+                        index=objects.index)
+    return plan
+
+
+def _sphere_point(ra, dec):
+    """ `lsst.geom.SpherePoint` of a position in degrees, or a (ra, dec) tuple if the LSST stack is
+    not installed."""
+    try:
+        import lsst.geom
+    except ImportError:
+        return ra, dec
+    return lsst.geom.SpherePoint(ra, dec, lsst.geom.degrees)
+
+
+def _point2d(x, y):
+    """ `lsst.geom.Point2D` of a pixel position, or a (x, y) tuple if the LSST stack is not
+    installed."""
+    try:
+        import lsst.geom
+    except ImportError:
+        return x, y
+    return lsst.geom.Point2D(x, y)
+
+
+class PixelBox(namedtuple("PixelBox", ["min_x", "min_y", "width", "height"])):
+    """ Integer pixel box with the accessors of `lsst.geom.BoxI`, used in its place when the LSST
+    stack is not installed, e.g. with local stand-ins for the butler.
+    """
+    def getMinX(self):
+        return self.min_x
+
+    def getMinY(self):
+        return self.min_y
+
+    def getMaxX(self):
+        return self.min_x + self.width - 1
+
+    def getMaxY(self):
+        return self.min_y + self.height - 1
+
+    def getWidth(self):
+        return self.width
+
+    def getHeight(self):
+        return self.height
+
+
+def pixel_box(min_x, min_y, width, height):
+    """ `lsst.geom.BoxI` with a lower corner and a size, or a `PixelBox` if the LSST stack is not
+    installed.
+    """
+    try:
+        import lsst.geom
+    except ImportError:
+        return PixelBox(int(min_x), int(min_y), int(width), int(height))
+    return lsst.geom.BoxI(lsst.geom.Point2I(int(min_x), int(min_y)),
+                          lsst.geom.ExtentI(int(width), int(height)))
+
+
+def union_bbox(min_x, min_y, size):
+    """ Smallest box containing square boxes of the same size.
+
+    Parameters
+    ----------
+    min_x, min_y: array
+        lower corners of the boxes
+    size: int
+        size of the boxes
+    """
+    x0, y0 = np.min(min_x), np.min(min_y)
+    return pixel_box(x0, y0, np.max(min_x) - x0 + size, np.max(min_y) - y0 + size)
+
+
+def copy_pixels(exposure):
+    """ Copy of an exposure for source injection.
+    Only the image and mask planes, which are modified by the injection, are copied. The variance
+    plane, wcs, psf and metadata are shared with `exposure`.
+    """
+    new = exposure.Factory(exposure, deep=False)
+    masked = exposure.maskedImage
+    new.maskedImage = masked.Factory(masked.image.Factory(masked.image, deep=True),
+                                     masked.mask.Factory(masked.mask, deep=True),
+                                     masked.variance)
+    return new
+
+
+class ExposureCache:
+    """ Bounded LRU cache of the pixels of lazy `Cutout` objects.
+
+    Exposures are keyed by the fetch plan of the cutout. When the cache is full, the exposures of
+    the least recently used cutout are dropped and fetched again if that cutout is accessed later.
+    """
+    def __init__(self, maxsize=256):
+        """
+        Parameters
+        ----------
+        maxsize: int
+            maximum number of cutouts whose exposures are kept in memory
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._exposures = OrderedDict()
+
+    def __len__(self):
+        return len(self._exposures)
+
+    def __contains__(self, key):
+        return key in self._exposures
+
+    def get(self, key, load):
+        """ Exposures of a cutout, loaded with `load()` if they are not in the cache.
+        """
+        if key in self._exposures:
+            self.hits += 1
+            self._exposures.move_to_end(key)
+            return self._exposures[key]
+
+        self.misses += 1
+        exposure = load()
+        self._exposures[key] = exposure
+        while len(self._exposures) > self.maxsize:
+            self._exposures.popitem(last=False)
+        return exposure
+
+    def clear(self):
+        """ Empties the cache and resets the hit/miss counters.
+        """
+        self._exposures.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def info(self):
+        """ Dictionary with the cache statistics.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._exposures),
+                'maxsize': self.maxsize}
+
+
 class Cutout:
     """A class that describes cutout of lens candidates and all the catalog level
-    information necessary to identify thhe object as well as lensing-relatted inforrmation."""
-    def __init__(self, exposure, catalog):
-        self.exposure = exposure
-        self.catalog = catalog
+    information necessary to identify thhe object as well as lensing-relatted inforrmation.
 
-    def inject(self, lensed_source, spectra):
+    A lazy cutout only holds its catalog entry and fetch plan, and reads its exposures on the first
+    access to `exposure`."""
+    def __init__(self, exposure, catalog, lens=None, plan=None, loader=None, cache=None):
+        """
+        Parameters
+        ----------
+        exposure: list
+            list of per-band exposures of the cutout, None for a lazy cutout
+        catalog: pandas Series
+            catalog entry of the object
+        lens: dict
+            description of the lensed source injected in the cutout, None if the cutout has no
+            injected lens.
+        plan: dict
+            fetch plan of a lazy cutout: "min_x", "min_y" (lower corner of the bounding box),
+            "size", "tract", "patch" and "bands"
+        loader: callable
+            function of the plan that returns the list of exposures of a lazy cutout
+        cache: `ExposureCache`
+            cache holding the exposures of lazy cutouts. Without a cache, a lazy cutout keeps its
+            exposures once they are loaded.
+        """
+        assert exposure is not None or loader is not None, "Please provide exposures or a loader."
+        self._exposure = exposure
+        self.catalog = catalog
+        self.lens = lens
+        self.plan = plan
+        self._loader = loader
+        self._cache = cache
+        self._injector = None
+        self._center = None
+
+    @property
+    def key(self):
+        """ Key of the exposures of a lazy cutout in an `ExposureCache`."""
+        plan = self.plan
+        return (plan["tract"], plan["patch"], plan["min_x"], plan["min_y"], plan["size"],
+                plan["bands"])
+
+    @property
+    def loaded(self):
+        """ True if accessing `exposure` does not read from the butler."""
+        if self._exposure is not None:
+            return True
+        return self._cache is not None and self.key in self._cache
+
+    @property
+    def exposure(self):
+        if self._exposure is not None:
+            return self._exposure
+        if self._cache is not None:
+            return self._cache.get(self.key, lambda: self._loader(self.plan))
+        self._exposure = self._loader(self.plan)
+        return self._exposure
+
+    @exposure.setter
+    def exposure(self, exposure):
+        self._exposure = exposure
+
+    def injector(self):
+        """ `FFTInjector` with the PSF of each band at the position of the object. It is built once
+        per cutout.
+
+        Returns
+        -------
+        injector: `desclamp.injection.FFTInjector`
+        center: tuple
+            position (x, y) of the object in the pixels of the cutout
+        """
+        if self._injector is None:
+            from .injection import FFTInjector
+            exposure = self.exposure[0]
+            wcs = exposure.getWcs()
+            x, y = sky_to_pixel(wcs, [self.catalog["ra"]], [self.catalog["dec"]])
+            x, y = float(x[0]), float(y[0])
+            point = _point2d(x, y)
+            psfs = [e.getPsf().computeKernelImage(point).array for e in self.exposure]
+            # Kernels of all bands padded to the same size around their center
+            size = max(psf.shape[0] for psf in psfs)
+            psfs = [np.pad(psf, (size - psf.shape[0]) // 2) for psf in psfs]
+            self._injector = FFTInjector(psfs, exposure.image.array.shape,
+                                         pix=pixel_scale(wcs, point))
+            xy0 = exposure.getXY0()
+            self._center = (x - xy0.getX(), y - xy0.getY())
+        return self._injector, self._center
+
+    @timed("Cutout.inject")
+    def inject(self, lensed_source, spectra, inplace=False, backend='lsst'):
         """ A method to do synthetic injection of a lensed source in the cutout
         Parameters
         ----------
         lensed_source: a galsim object or an array
-            An image of a lensed source to inject.
+            An image of a lensed source to inject. When injecting the same source in many cutouts,
+            pass a `galsim.InterpolatedImage` built once to avoid rebuilding the interpolation at
+            each call. A cube with shape (bands, ny, nx) from `Lensing_frame.lens_cube` gives one
+            image per band, each scaled to the flux of its band.
+        spectra: list
+            flux of the source in each band of the cutout
+        inplace: bool
+            if True, the source is added to the exposures of this cutout, which is returned.
+            Otherwise, a new cutout is returned whose exposures own a copy of the image and mask
+            pixels but share the variance, wcs, psf and metadata with the exposures of this cutout.
+        backend: str
+            'lsst' draws the source in each band with `lsst.pipe.tasks.insertFakes`. 'numpy' renders
+            the source in all bands at once with an `FFTInjector` built from the PSFs of the cutout,
+            and does not set the FAKE mask plane.
         """
+        import galsim
         assert len(spectra)==len(self.exposure)
-        radec = lsst.geom.SpherePoint(self.catalog["ra"], self.catalog["dec"], lsst.geom.degrees)
-        new_exp = copy.deepcopy(self.exposure)
-        lensed_obj = galsim.InterpolatedImage(lensed_source, scale = 0.05)
-        for i,e in enumerate(new_exp):
-            _add_fake_sources(e, [(radec, lensed_obj.withFlux(spectra[i]))])
-
+        if inplace:
+            new_exp = self.exposure
+        else:
+            new_exp = [copy_pixels(e) for e in self.exposure]
+        if backend == 'numpy':
+            injector, center = self.injector()
+            if isinstance(lensed_source, galsim.Image):
+                lensed_source = lensed_source.array
+            lensed = injector.render(lensed_source, spectra, scale=0.05, center=center)
+            for e, l in zip(new_exp, lensed):
+                e.image.array += l.astype(e.image.array.dtype)
+        else:
+            radec = _sphere_point(self.catalog["ra"], self.catalog["dec"])
+            if isinstance(lensed_source, galsim.GSObject):
+                lensed_obj = [lensed_source] * len(new_exp)
+            elif np.ndim(lensed_source) == 3:
+                assert len(lensed_source) == len(new_exp), \
+                    "Please provide one image of the source per band."
+                lensed_obj = [galsim.InterpolatedImage(galsim.Image(np.ascontiguousarray(band)),
+                                                       scale = 0.05)
+                              for band in lensed_source]
+            else:
+                lensed_obj = [galsim.InterpolatedImage(lensed_source, scale = 0.05)] * len(new_exp)
+            for i,e in enumerate(new_exp):
+                _add_fake_sources(e, [(radec, lensed_obj[i].withFlux(spectra[i]))])
+
+        if inplace:
+            return self
         return Cutout(new_exp, self.catalog)
 
 
@@ -65,13 +466,26 @@ class Cutout:
 class Candidates:
     """ Class that handles catalog querries. Fetches postage stamps and light curves of samples of images and allows visualization """
 
-    def __init__(self, dc2_data_version, skymap='deepCoadd_skyMap'):
-
-        self.cat, self.butler = catalog_setup(dc2_data_version)
+    def __init__(self, dc2_data_version, skymap='deepCoadd_skyMap', cat=None, butler=None):
+        """
+        Parameters
+        ----------
+        dc2_data_version: str
+            data version of the catalog. This is used to instantiate the butler.
+        skymap: str
+            name of the skymap dataset
+        cat, butler: GCR catalog and butler
+            catalog and butler to use instead of the ones of `dc2_data_version`, e.g. local
+            stand-ins. Both have to be provided.
+        """
+        if cat is None or butler is None:
+            cat, butler = catalog_setup(dc2_data_version)
+        self.cat, self.butler = cat, butler
         self.skymap = self.butler.get(skymap)
 
 
-    def catalog_query(self, query, columns = None, tracts = None):
+    @timed("Candidates.catalog_query")
+    def catalog_query(self, query, columns = None, tracts = None, cache = None):
         """ Submits a query and a selection to the catalog. Extract relevant information from catalogs.
 
         Parameters
@@ -80,6 +494,10 @@ class Candidates:
             a set of selection criteria to select galaxy objects
         tracts: list
             list of tract numbers. Used to restrict the search to a small number of tracts.
+        cache: `desclamp.catalog_cache.CatalogCache`
+            local columnar cache of the catalog. The quantities used by the query and the returned
+            columns are read from the catalog for the tracts where they are not cached yet, and the
+            query is then evaluated on the cache. Requires `tracts`.
         """
         # The minimum set of infomation needed about objects in the catalog
         # This will need to included lensing information att some point.
@@ -91,19 +509,45 @@ class Candidates:
 
         assert self.cat.has_quantities(columns_to_get)
 
+        if cache is not None:
+            assert tracts is not None, "Please provide the tracts to cache."
+            return self._cached_query(query, list(columns_to_get), tracts, cache)
+
         # Submit the query and get catalog of objects
+        filters = None
         if tracts is not None:
             filters = f"(tract == {tracts[0]})"
             for t in tracts[1:]:
                 filters +=  f" | (tract == {t})"
-        objects = self.cat.get_quantities(columns_to_get, filters=GCRQuery(*query), native_filters=filters)
+        # GCR catalogs combine a list of filters with AND, as a GCRQuery of them
+        objects = self.cat.get_quantities(columns_to_get, filters=list(query),
+                                          native_filters=filters)
 
         # make it a pandas data frame for the ease of manipulation.
         # Objects are nont made attributes of the class in case the user wants postage stamps for a smaller set of objects
         objects = pd.DataFrame(objects)
         return objects
 
-    def make_postage_stamps(self, objects, cutout_size=100, bands = 'irg'):
+    def _cached_query(self, query, columns, tracts, cache):
+        """ Evaluates a query on the local cache, filling it from the catalog where needed.
+        """
+        from .catalog_cache import query_mask, query_quantities
+        needed = list(dict.fromkeys(columns + query_quantities(query)))
+        for tract, missing in cache.missing(tracts, needed).items():
+            # Whole tracts are cached, without the selection, so that later queries can use other
+            # cuts. objectId is always read, so that new columns are aligned with the cached ones.
+            quantities = list(dict.fromkeys(["objectId"] + missing))
+            cache.write(tract, self.cat.get_quantities(quantities,
+                                                       native_filters=f"(tract == {tract})"))
+
+        table = cache.read(tracts, needed)
+        mask = query_mask(query, table)
+        return pd.DataFrame({c: table[c][mask] for c in columns})
+
+    @timed("Candidates.make_postage_stamps")
+    def make_postage_stamps(self, objects, cutout_size=100, bands = 'irg', n_threads=1, retries=3,
+                            backoff=0.5, completion_order=False, by_patch=False, whole_patch=False,
+                            copy_cutouts=True, lazy=False, cache=None):
         """ Extracts a coadd postage stamp of an object from the catalog
 
         Parameters
@@ -114,56 +558,204 @@ class Candidates:
             size of the postage stamp to extract in pixels
         bands: str
             spectral for which patches have to extracted. Default is 'irg'.
-
+        n_threads: int
+            number of concurrent butler reads. Cutouts are returned in the order of `objects` unless
+            `completion_order` is set.
+        retries: int
+            number of retries of a butler read that fails with a transient I/O error.
+        backoff: float
+            waiting time in seconds before the first retry, doubled at each subsequent retry.
+        completion_order: bool
+            if True, returns a generator that yields the cutouts as soon as all their bands are
+            read.
+        by_patch: bool
+            if True, objects are grouped by tract and patch and each patch is read once per band, as
+            the smallest box containing all the cutouts of the patch. Cutouts are then sliced from
+            it.
+        whole_patch: bool
+            with `by_patch`, reads the full patch exposure ("deepCoadd") instead of the box around
+            the cutouts.
+        copy_cutouts: bool
+            with `by_patch`, cutouts are copied from the patch exposure once all of them are sliced,
+            so that the patch can be freed. If False, cutouts are views of the patch exposure.
+        lazy: bool
+            if True, no pixels are read: cutouts hold their fetch plan and read their exposures when
+            first accessed.
+        cache: `ExposureCache`
+            with `lazy`, bounded cache of the exposures of the cutouts.
+
+        Returns
+        -------
+        cutouts: list or generator of `Cutout` objects
         """
-
-        cutout_extent = lsst.geom.ExtentI(cutout_size, cutout_size)
-        cutouts = []
-        for (_, object_this) in objects.iterrows():
-            radec = lsst.geom.SpherePoint(object_this["ra"], object_this["dec"], lsst.geom.degrees)
-
-            center = self.skymap.findTract(radec).getWcs().skyToPixel(radec)
-            bbox = lsst.geom.BoxI(lsst.geom.Point2I((center.x - cutout_size*0.5, center.y - cutout_size*0.5)), cutout_extent)
-
-            exposure = [self.butler.get("deepCoadd_sub",
-                              bbox=bbox,
-                              tract=object_this["tract"],
-                              patch=object_this["patch"],
-                              filter=band
-                             ) for band in bands]
-
-            new_cutout = Cutout(exposure, object_this)
-            cutouts.append(new_cutout)
-
+        plan = cutout_plan(objects, self.skymap, cutout_size)
+        min_x = plan["min_x"].to_numpy()
+        min_y = plan["min_y"].to_numpy()
+        tracts = plan["tract"].tolist()
+        patches = objects["patch"].tolist()
+
+        def fetch_plan(i):
+            return {"min_x": int(min_x[i]), "min_y": int(min_y[i]), "size": cutout_size,
+                    "tract": tracts[i], "patch": patches[i], "bands": bands}
+
+        def fetch_exposures(plan):
+            # Boxes are only built when the pixels are read
+            bbox = pixel_box(plan["min_x"], plan["min_y"], plan["size"], plan["size"])
+            return [butler_get(self.butler,
+                               "deepCoadd_sub",
+                               bbox=bbox,
+                               tract=plan["tract"],
+                               patch=plan["patch"],
+                               filter=band,
+                               retries=retries,
+                               backoff=backoff
+                               ) for band in plan["bands"]]
+
+        def fetch(i):
+            return Cutout(fetch_exposures(fetch_plan(i)), objects.iloc[i])
+
+        indices = range(len(objects))
+        if lazy:
+            assert not by_patch and not completion_order, \
+                "Lazy cutouts are read one by one when accessed."
+            return [Cutout(None, objects.iloc[i], plan=fetch_plan(i), loader=fetch_exposures,
+                           cache=cache)
+                    for i in indices]
+        if by_patch:
+            assert not completion_order, \
+                "Patch grouped extraction returns cutouts in the order of the objects."
+            return self._make_postage_stamps_by_patch(objects, min_x, min_y, tracts, patches,
+                                                      cutout_size, bands, n_threads, retries,
+                                                      backoff, whole_patch, copy_cutouts)
+        if completion_order:
+            return self._fetch_as_completed(fetch, indices, n_threads)
+        if n_threads == 1:
+            return [fetch(i) for i in indices]
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            cutouts = list(executor.map(fetch, indices))
         return cutouts
 
-    def display_cutouts(self, cutouts, figsize=(10,10), data_range = 2, q = 8):
-        """ Displays RGB image of cutouts on a mosaic
-        """
-        n = len(cutouts)
+    def stored_postage_stamps(self, objects, store, planes=("image", "mask", "variance"), **kwargs):
+        """ Postage stamps served from an on-disk `StampStore`.
+        Stamps of objects missing from the store are extracted with `make_postage_stamps` and
+        written to it first, the butler is not accessed if all objects are in the store.
 
-        fig = plt.figure(figsize=figsize, dpi=100)
-        if int(np.sqrt(n))**2 == int(n):
-            l = int(np.sqrt(n))
+        Parameters
+        ----------
+        objects: pandas DataFrame
+            catalog of the objects
+        store: `desclamp.stamp_store.StampStore`
+            store of the stamps. Its cutout size and bands are used for the extraction.
+        planes: tuple
+            planes to read among "image", "mask" and "variance"
+        kwargs:
+            extra arguments of `make_postage_stamps`
+
+        Returns
+        -------
+        stamps: dict
+            (N, bands, size, size) arrays for each plane, see `StampStore.read`.
+        """
+        missing = objects[objects["objectId"].isin(store.missing(objects["objectId"]))]
+        if len(missing) > 0:
+            assert not store.readonly, "Stamps missing from a read only store."
+            store.write(self.make_postage_stamps(missing, cutout_size=store.cutout_size,
+                                                 bands=store.bands, **kwargs))
+        return store.read(objects["objectId"], planes=planes)
+
+    def _make_postage_stamps_by_patch(self, objects, min_x, min_y, tracts, patches, cutout_size,
+                                      bands, n_threads, retries, backoff, whole_patch,
+                                      copy_cutouts):
+        """ Cutout extraction with one read per patch and band. See `make_postage_stamps`.
+        """
+        groups = {}
+        for i, key in enumerate(zip(tracts, patches)):
+            groups.setdefault(key, []).append(i)
+
+        def fetch_patch(indices):
+            if whole_patch:
+                dataset, read_kwargs = "deepCoadd", {}
+            else:
+                bbox = union_bbox(min_x[indices], min_y[indices], cutout_size)
+                dataset, read_kwargs = "deepCoadd_sub", {"bbox": bbox}
+            exposures = [butler_get(self.butler,
+                                    dataset,
+                                    tract=tracts[indices[0]],
+                                    patch=patches[indices[0]],
+                                    filter=band,
+                                    retries=retries,
+                                    backoff=backoff,
+                                    **read_kwargs
+                                    ) for band in bands]
+            # Views on the patch exposures
+            cutouts = []
+            for i in indices:
+                bbox = pixel_box(min_x[i], min_y[i], cutout_size, cutout_size)
+                exposure = [patch[bbox] for patch in exposures]
+                if copy_cutouts:
+                    exposure = [e.clone() for e in exposure]
+                cutouts.append(Cutout(exposure, objects.iloc[i]))
+            return cutouts
+
+        tasks = [groups[key] for key in sorted(groups)]
+        if n_threads == 1:
+            results = map(fetch_patch, tasks)
         else:
-            l = int(np.sqrt(n)+1)
-
-        gs = plt.GridSpec(l, l, fig)
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                results = list(executor.map(fetch_patch, tasks))
 
-        for i in range(n):
-            cutout = cutouts[i]
-            image = cutout.exposure
-            image_rgb = rgb.makeRGB(*image, dataRange = data_range, Q=q)
+        cutouts = [None] * len(objects)
+        for indices, patch_cutouts in zip(tasks, results):
+            for i, cutout in zip(indices, patch_cutouts):
+                cutouts[i] = cutout
+        return cutouts
 
-            ax = plt.subplot(gs[i],
-                             #projection=WCS(cutout.exposure[0].getWcs().getFitsMetadata()),
-                             label=str(cutout.catalog["objectId"])
-                            )
-            ax.imshow(image_rgb, origin='lower')
-            del image_rgb  # let gc save some memory for us
+    @staticmethod
+    def _fetch_as_completed(fetch, indices, n_threads):
+        """ Generator of fetched cutouts in completion order.
+        """
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            futures = [executor.submit(fetch, i) for i in indices]
+            for future in as_completed(futures):
+                yield future.result()
 
-            for c in ax.coords:
-                c.set_ticklabel(exclude_overlapping=True, size=10)
-                c.set_axislabel('', size=0)
+    def display_cutouts(self, cutouts, figsize=(10,10), data_range = 2, q = 8, ncols=None,
+                        per_page=None, path=None):
+        """ Displays RGB image of cutouts on a mosaic
+        The asinh stretch of `lsst.afw.display.rgb.makeRGB` is applied to all cutouts at once, and
+        the cutouts are tiled into a single image shown with one `imshow`, or written to png pages.
 
-        pass
\ No newline at end of file
+        Parameters
+        ----------
+        cutouts: list
+            list of `Cutout` objects with three bands, mapped to red, green and blue in that order.
+        figsize: tuple
+            size of the figure
+        data_range, q:
+            parameters of the asinh stretch
+        ncols: int
+            number of columns of the mosaic. Defaults to a square mosaic.
+        per_page: int
+            number of cutouts per png page, with `path`
+        path: str
+            format string of png files, e.g. "mosaic_{page:03d}.png". The mosaic is shown if None.
+
+        Returns
+        -------
+        index: pandas DataFrame
+            page, row and column of the tile of each objectId, see `desclamp.mosaic.render_mosaic`
+        """
+        if len(cutouts) == 0:
+            raise ValueError("No cutouts to display.")
+        images = np.array([[e.image.array for e in cutout.exposure] for cutout in cutouts])
+        object_ids = np.array([cutout.catalog["objectId"] for cutout in cutouts])
+        mosaics, index = render_mosaic(images, object_ids, ncols=ncols,
+                                       per_page=per_page if path else None, path=path,
+                                       data_range=data_range, q=q)
+        if path is None:
+            import matplotlib.pyplot as plt
+            fig = plt.figure(figsize=figsize, dpi=100)
+            ax = fig.add_subplot(111)
+            ax.imshow(mosaics[0], interpolation='nearest')
+            ax.set_axis_off()
+        return index
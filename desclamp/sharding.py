@@ -0,0 +1,305 @@
+""" Sharded generation of training sets.
+
+The objects of a catalog query are split into shards of whole patches, each shard is generated
+independently by a `TrainSet` and written to its own directory, one file per batch. A manifest per
+shard records the completed batches, so that an interrupted shard resumes where it stopped, and the
+shards are merged once they are all complete into `output`/merged.h5, a file of
+`desclamp.training_file.TrainingSetWriter` read by `TrainingSetReader`.
+The objects of the query are saved in the output directory by `launch`, or by the first shards that
+run, and read back by the shards that start later. Only `launch` guarantees a single catalog query:
+shards started together by another launcher may each query the catalog once.
+
+Shards can be run by hand, by any launcher, or all together on the local machine::
+
+    python -m desclamp.sharding run --shard 3 --n-shards 16 --output out --query clean ...
+    python -m desclamp.sharding launch --n-shards 16 --processes 4 --output out --query clean ...
+    python -m desclamp.sharding merge --output out
+"""
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+def partition_objects(objects, n_shards):
+    """ Deterministic split of objects into shards of whole patches.
+    Objects are sorted by tract, patch and objectId, and consecutive patches are grouped into shards
+    of about the same number of objects, so that each shard reads as few patches as possible.
+
+    Parameters
+    ----------
+    objects: pandas DataFrame
+        catalog with "objectId", "tract" and "patch" columns
+    n_shards: int
+        number of shards
+
+    Returns
+    -------
+    shards: list
+        `n_shards` DataFrames. Shards can be empty when there are fewer patches than shards.
+    """
+    objects = objects.sort_values(["tract", "patch", "objectId"], kind="mergesort")
+    objects = objects.reset_index(drop=True)
+    patch = objects["tract"].astype(str) + "/" + objects["patch"].astype(str)
+    first = np.flatnonzero(np.r_[True, patch.values[1:] != patch.values[:-1]])
+    sizes = np.diff(np.r_[first, len(objects)])
+    # Each patch goes to the shard of its middle object, so that shards hold about
+    # len(objects) / n_shards objects
+    patch_shard = ((2 * first + sizes) * n_shards) // (2 * max(len(objects), 1))
+    shard = np.repeat(patch_shard, sizes)
+    return [objects[shard == k].reset_index(drop=True) for k in range(n_shards)]
+
+
+def shard_samples(n_samples, sizes):
+    """ Number of samples of each shard, proportional to its number of objects and summing to
+    `n_samples`.
+    """
+    sizes = np.asarray(sizes)
+    bounds = (np.r_[0, np.cumsum(sizes)] * n_samples) // max(np.sum(sizes), 1)
+    return np.diff(bounds).astype(int)
+
+
+def shard_seed(seed, shard, n_shards):
+    """ Seed of the random draws of a shard, derived from the master seed.
+    """
+    return int(np.random.SeedSequence(seed).spawn(n_shards)[shard].generate_state(1)[0])
+
+
+def _write_json(data, file):
+    """ Writes a json file atomically."""
+    with open(file + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(file + ".tmp", file)
+
+
+def _manifest_file(output, shard):
+    return os.path.join(output, f"shard{shard:04d}.json")
+
+
+def generate_shard(train, objects, shard, n_shards, output, n_samples=None):
+    """ Generates one shard of a training set, resuming from its manifest if it exists.
+
+    Parameters
+    ----------
+    train: `desclamp.train_set.TrainSet`
+        training set whose `n_samples`, `seed` and catalog queries are the ones of the full set. Its
+        `objects`, `n` and `seed` are set to the ones of the shard.
+    objects: pandas DataFrame
+        objects of the full training set, partitioned with `partition_objects`
+    shard: int
+        index of the shard
+    n_shards: int
+        number of shards
+    output: str
+        output directory, shared by all shards
+    n_samples: int
+        number of samples of the full set. Defaults to `train.n`.
+
+    Returns
+    -------
+    manifest: dict
+        manifest of the shard
+    """
+    from .training_file import batch_arrays
+    assert 0 <= shard < n_shards, f"Shard {shard} out of range for {n_shards} shards."
+    if n_samples is None:
+        n_samples = train.n
+    parts = partition_objects(objects, n_shards)
+    n_shard = int(shard_samples(n_samples, [len(p) for p in parts])[shard])
+    config = {"shard": shard, "n_shards": n_shards, "n_samples": n_samples,
+              "n_shard_samples": n_shard, "batchsize": train.batchsize, "seed": train.seed,
+              "lens_fraction": train.lens_fraction, "cutout_size": train.cutout_size,
+              "bands": train.bands, "n_objects": len(objects)}
+
+    os.makedirs(os.path.join(output, f"shard{shard:04d}"), exist_ok=True)
+    manifest_file = _manifest_file(output, shard)
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        assert manifest["config"] == config, \
+            f"{manifest_file} was written with a different configuration."
+    else:
+        manifest = {"config": config, "batches": {}, "complete": False}
+
+    train.objects = [parts[shard]]
+    train.n = n_shard
+    train.seed = shard_seed(config["seed"], shard, n_shards)
+    for start in range(0, n_shard, train.batchsize):
+        name = f"shard{shard:04d}/batch{start // train.batchsize:06d}.npz"
+        if name in manifest["batches"]:
+            continue
+        arrays = batch_arrays(train.make_batch(parts[shard], start))
+        file = os.path.join(output, name)
+        np.savez(file[:-len(".npz")] + ".tmp.npz", **arrays)
+        os.replace(file[:-len(".npz")] + ".tmp.npz", file)
+        manifest["batches"][name] = len(arrays["labels"])
+        _write_json(manifest, manifest_file)
+    manifest["complete"] = True
+    _write_json(manifest, manifest_file)
+    return manifest
+
+
+def merge_shards(output):
+    """ Concatenates complete shards in order into `output`/merged.h5, with `TrainingSetWriter`. The
+    datasets are contiguous, so that `TrainingSetReader` memory maps the images. The configuration
+    of the shards is saved in `output`/merged.json.
+
+    Returns
+    -------
+    path: str
+        path of the merged training set
+    """
+    from .training_file import TrainingSetWriter
+    manifests = []
+    names = sorted(f for f in os.listdir(output) if f.startswith("shard") and f.endswith(".json"))
+    for name in names:
+        with open(os.path.join(output, name)) as f:
+            manifests.append(json.load(f))
+    assert len(manifests) > 0, f"No shards in {output}."
+    n_shards = manifests[0]["config"]["n_shards"]
+    assert [m["config"]["shard"] for m in manifests] == list(range(n_shards)), \
+        "Some shards have not been started."
+    incomplete = [m["config"]["shard"] for m in manifests if not m["complete"]]
+    assert len(incomplete) == 0, f"Shards {incomplete} are not complete."
+
+    config = manifests[0]["config"]
+    batches = [name for m in manifests for name in sorted(m["batches"])]
+    n = sum(m["batches"][name] for m in manifests for name in m["batches"])
+    path = os.path.join(output, "merged.h5")
+    with TrainingSetWriter(path, bands=config["bands"], cutout_size=config["cutout_size"],
+                           n_samples=n, compression=None) as writer:
+        for name in batches:
+            with np.load(os.path.join(output, name)) as batch:
+                writer.write_arrays({key: batch[key] for key in batch.files})
+    _write_json({"n_samples": n, "n_shards": n_shards, "config": config},
+                os.path.join(output, "merged.json"))
+    return path
+
+
+def _load_sampler(name):
+    """ Imports a lens sampler given as "module:function"."""
+    if name is None:
+        return None
+    module, function = name.split(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def _objects_file(output):
+    return os.path.join(output, "objects.pkl")
+
+
+def _query_objects(train, args):
+    """ Objects of the catalog query of the training set, read from the output directory if they
+    were saved by `launch` or another shard, queried from the catalog and saved otherwise. Shards
+    that query the catalog at the same time write their own temporary file, and the last one
+    replaces the saved objects with the same rows.
+    """
+    file = _objects_file(args.output)
+    query = {"data_version": args.data_version, "query": list(args.query), "tracts": args.tracts}
+    if os.path.exists(file):
+        saved = pd.read_pickle(file)
+        assert saved["query"] == query, f"{file} was written for a different query."
+        train.objects.append(saved["objects"])
+        return saved["objects"]
+
+    objects = train.catalog_query(tuple(args.query), tracts=args.tracts)
+    os.makedirs(args.output, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(suffix=".tmp", dir=args.output)
+    with os.fdopen(descriptor, "wb") as f:
+        pd.to_pickle({"query": query, "objects": objects}, f)
+    os.replace(temporary, file)
+    return objects
+
+
+def _train_set(args):
+    from .train_set import TrainSet
+    train = TrainSet(args.data_version, args.n_samples, batchsize=args.batchsize,
+                     lens_fraction=args.lens_fraction,
+                     lens_sampler=_load_sampler(args.lens_sampler), prefetch=0, seed=args.seed,
+                     cutout_size=args.cutout_size, bands=args.bands)
+    return train, _query_objects(train, args)
+
+
+def _shard_arguments(args):
+    """ Command line of `run` for a shard, forwarding the options of `launch`."""
+    command = [sys.executable, "-m", "desclamp.sharding", "run", "--shard", None,
+               "--n-shards", str(args.n_shards), "--output", args.output,
+               "--data-version", args.data_version, "--n-samples", str(args.n_samples),
+               "--batchsize", str(args.batchsize), "--lens-fraction", str(args.lens_fraction),
+               "--seed", str(args.seed), "--cutout-size", str(args.cutout_size),
+               "--bands", args.bands]
+    command += ["--query"] + list(args.query)
+    if args.tracts is not None:
+        command += ["--tracts"] + [str(t) for t in args.tracts]
+    if args.lens_sampler is not None:
+        command += ["--lens-sampler", args.lens_sampler]
+    return command
+
+
+def launch(args):
+    """ Runs all the shards on the local machine as subprocesses, `args.processes` at a time.
+
+    Returns
+    -------
+    failed: list
+        shards whose process failed
+    """
+    command = _shard_arguments(args)
+    # The shards read the objects queried here
+    _train_set(args)
+
+    def run(shard):
+        return subprocess.run(command[:5] + [str(shard)] + command[6:]).returncode
+
+    with ThreadPoolExecutor(max_workers=args.processes) as executor:
+        codes = list(executor.map(run, range(args.n_shards)))
+    return [shard for shard, code in enumerate(codes) if code != 0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Sharded generation of training sets with lensed sources.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="generate one shard")
+    launch_parser = commands.add_parser("launch", help="generate all shards with local processes")
+    merge_parser = commands.add_parser("merge", help="merge complete shards")
+    for sub in (run_parser, launch_parser):
+        sub.add_argument("--n-shards", type=int, required=True)
+        sub.add_argument("--output", required=True)
+        sub.add_argument("--data-version", required=True,
+                         help="DC2 data version of the catalog and butler")
+        sub.add_argument("--query", nargs="+", required=True, help="GCR selection criteria")
+        sub.add_argument("--tracts", nargs="+", type=int)
+        sub.add_argument("--n-samples", type=int, required=True,
+                         help="number of samples of the full set")
+        sub.add_argument("--batchsize", type=int, default=8)
+        sub.add_argument("--lens-fraction", type=float, default=0.2)
+        sub.add_argument("--lens-sampler", help="lens sampler given as module:function")
+        sub.add_argument("--seed", type=int, default=0)
+        sub.add_argument("--cutout-size", type=int, default=100)
+        sub.add_argument("--bands", default="irg")
+    run_parser.add_argument("--shard", type=int, required=True)
+    launch_parser.add_argument("--processes", type=int, default=os.cpu_count())
+    merge_parser.add_argument("--output", required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        train, objects = _train_set(args)
+        generate_shard(train, objects, args.shard, args.n_shards, args.output)
+    elif args.command == "launch":
+        failed = launch(args)
+        if failed:
+            sys.exit(f"Shards {failed} failed, run them again to resume.")
+        merge_shards(args.output)
+    else:
+        merge_shards(args.output)
+
+
+if __name__ == "__main__":
+    main()
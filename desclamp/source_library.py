@@ -0,0 +1,232 @@
+import os
+import json
+import numpy as np
+from scipy import ndimage
+
+# galsim is imported by the methods that draw profiles, so that importing this module stays fast
+
+
+class SourceLibrary:
+    """ Bank of pre-rendered unit flux source profiles.
+
+    Profiles are rendered once on a grid of indices (Sersic n or Spergel nu) and half-light radii. A
+    source is then produced by interpolating linearly between the profiles of the neighbouring
+    indices, and resampling the result with one affine transform that applies the radius, shear and
+    shift. Radii are interpolated in log space between the two neighbouring grid radii, each
+    rescaled to the requested radius.
+    """
+    profiles = ('Sersic', 'Spergel')
+
+    def __init__(self, bank, profile, indices, radii, shape, pix, hr_factor, padding, oversampling):
+        """ Use `SourceLibrary.build` or `SourceLibrary.load` to create a library.
+        Parameters
+        ----------
+        bank: `array`
+            images of the profiles with shape (len(indices), len(radii), ny, nx)
+        profile: `str`
+            galsim profile, 'Sersic' or 'Spergel'
+        indices: `array`
+            Sersic n or Spergel nu of the grid
+        radii: `array`
+            half-light radii of the grid in arcseconds
+        shape: `tuple`
+            Shape of the image patch of the sources
+        pix: `float`
+            pixel size in arcseconds.
+        hr_factor: `int`
+            the high resolution factor between source and lens plane
+        padding: `int`
+            number of pixels added on each side of the source images in the bank, so that rescaled,
+            sheared and shifted sources are not truncated.
+        oversampling: `int`
+            resolution of the bank relative to the sources. Sources are resampled at this resolution
+            and binned, which reduces the errors due to the integration of the profiles over the
+            pixels.
+        """
+        self.bank = bank
+        self.profile = profile
+        self.indices = np.asarray(indices, dtype=np.float64)
+        self.radii = np.asarray(radii, dtype=np.float64)
+        self.shape = tuple(shape)
+        self.pix = pix
+        self.hr_factor = hr_factor
+        self.padding = padding
+        self.oversampling = oversampling
+        self.scale = pix / hr_factor
+
+    @classmethod
+    def build(cls, profile='Spergel', indices=np.linspace(-0.5, 2, 11),
+              radii=np.geomspace(0.05, 2, 17), shape=(100, 100), pix=0.2, hr_factor=1, padding=None,
+              oversampling=2, path=None):
+        """ Renders the bank of profiles.
+        Parameters
+        ----------
+        profile: `str`
+            galsim profile, 'Sersic' or 'Spergel'
+        indices: `array`
+            Sersic n or Spergel nu of the grid
+        radii: `array`
+            half-light radii of the grid in arcseconds
+        shape, pix, hr_factor:
+            geometry of the `Lensing_frame` the sources are made for
+        padding: `int`
+            pixels of the sources added on each side of the images of the bank. Defaults to a
+            quarter of the image size.
+        oversampling: `int`
+            resolution of the bank relative to the sources
+        path: `str`
+            directory where the bank is saved and memory mapped from. The bank is kept in memory if
+            None.
+        """
+        assert profile in cls.profiles, \
+            f"Not a valid profile. Please use one of {list(cls.profiles)}."
+        ny, nx = shape[1] * hr_factor, shape[0] * hr_factor
+        if padding is None:
+            padding = max(ny, nx) // 4
+        bank_shape = (len(indices), len(radii), (ny + 2 * padding) * oversampling,
+                      (nx + 2 * padding) * oversampling)
+
+        if path is None:
+            bank = np.zeros(bank_shape)
+        else:
+            os.makedirs(path, exist_ok=True)
+            bank = np.lib.format.open_memmap(os.path.join(path, "bank.npy"), mode="w+",
+                                             dtype=np.float64, shape=bank_shape)
+        for i, index in enumerate(indices):
+            for j, radius in enumerate(radii):
+                gso = cls.gsobject(profile, index, radius)
+                bank[i, j] = gso.drawImage(nx=bank_shape[3],
+                                           ny=bank_shape[2],
+                                           use_true_center=True,
+                                           method='real_space',
+                                           scale=pix / hr_factor / oversampling,
+                                           dtype=np.float64).array
+
+        library = cls(bank, profile, indices, radii, shape, pix, hr_factor, padding, oversampling)
+        if path is not None:
+            bank.flush()
+            with open(os.path.join(path, "library.json"), "w") as f:
+                json.dump(library.meta, f)
+            library.bank = np.load(os.path.join(path, "bank.npy"), mmap_mode="r")
+        return library
+
+    @staticmethod
+    def gsobject(profile, index, half_light_radius):
+        """ galsim object of a profile of the grid, 'Sersic' or 'Spergel'.
+        """
+        import galsim
+        return getattr(galsim, profile)(index, half_light_radius=half_light_radius)
+
+    @classmethod
+    def load(cls, path):
+        """ Memory maps a bank saved by `build`.
+        """
+        with open(os.path.join(path, "library.json")) as f:
+            meta = json.load(f)
+        bank = np.load(os.path.join(path, "bank.npy"), mmap_mode="r")
+        return cls(bank, **meta)
+
+    @property
+    def meta(self):
+        return {'profile': self.profile, 'indices': self.indices.tolist(),
+                'radii': self.radii.tolist(), 'shape': list(self.shape), 'pix': self.pix,
+                'hr_factor': self.hr_factor, 'padding': self.padding,
+                'oversampling': self.oversampling}
+
+    @staticmethod
+    def _bracket(grid, value):
+        """ Indices and weights of the grid points around a value."""
+        assert grid[0] <= value <= grid[-1], \
+            f"{value} is outside of the range of the library [{grid[0]}, {grid[-1]}]"
+        i = int(np.clip(np.searchsorted(grid, value) - 1, 0, len(grid) - 2))
+        weight = (value - grid[i]) / (grid[i + 1] - grid[i])
+        return i, weight
+
+    def draw(self, index, half_light_radius, shift=(0, 0), shear=(0, 0)):
+        """ Image of a unit flux source, on the same grid as `Lensing_frame.from_galsim_parametric`.
+        Parameters
+        ----------
+        index: `float`
+            Sersic n or Spergel nu
+        half_light_radius: `float`
+            half-light radius in arcseconds
+        shift: `tuple`
+            shift of the source in arcseconds
+        shear: `tuple`
+            reduced shear (g1, g2) of the source
+
+        Returns
+        -------
+        source: `array`
+            image of the source
+        """
+        i, wi = self._bracket(self.indices, index)
+        j, wj = self._bracket(np.log(self.radii), np.log(half_light_radius))
+
+        ny, nx = self.shape[1] * self.hr_factor, self.shape[0] * self.hr_factor
+        # Sources are resampled at the resolution of the bank, then binned to their pixels
+        over = self.oversampling
+        center_out = np.array([ny * over - 1, nx * over - 1]) / 2.
+        center_in = (np.array(self.bank.shape[2:]) - 1) / 2.
+        # Inverse shear, in (row, column) order
+        import galsim
+        inverse = np.linalg.inv(galsim.Shear(g1=shear[0], g2=shear[1]).getMatrix())[::-1, ::-1]
+        offset = np.array([shift[1], shift[0]]) / self.scale * over
+
+        source = np.zeros((ny * over, nx * over))
+        for jj, weight in [(j, 1 - wj), (j + 1, wj)]:
+            if weight == 0:
+                continue
+            profile = (1 - wi) * self.bank[i, jj] + wi * self.bank[i + 1, jj]
+            # Input pixel = center_in + M (output - center_out - offset)
+            matrix = inverse * self.radii[jj] / half_light_radius
+            resampled = ndimage.affine_transform(profile, matrix,
+                                                 offset=center_in - matrix @ (center_out + offset),
+                                                 output_shape=source.shape, order=3,
+                                                 mode='constant', cval=0.)
+            # Surface brightness scales with the inverse of the area
+            source += weight * resampled * (self.radii[jj] / half_light_radius) ** 2
+        source = source.reshape(ny, over, nx, over).sum(axis=(1, 3))
+        return source
+
+    def accuracy(self, n_samples=20, seed=0, max_shift=0.2, max_shear=0.2):
+        """ Compares sources from the library to direct drawing with galsim at random points of the
+        grid.
+        Parameters
+        ----------
+        n_samples: `int`
+            number of random sources
+        seed: `int`
+            seed of the random parameters
+        max_shift: `float`
+            maximum shift in arcseconds
+        max_shear: `float`
+            maximum amplitude of each shear component
+
+        Returns
+        -------
+        report: `dict`
+            largest and median residuals relative to the peak of the source ("max_residual",
+            "median_residual") and largest flux error ("max_flux_error").
+        """
+        rng = np.random.default_rng(seed)
+        residuals = []
+        flux_errors = []
+        for _ in range(n_samples):
+            index = rng.uniform(self.indices[0], self.indices[-1])
+            radius = np.exp(rng.uniform(np.log(self.radii[0]), np.log(self.radii[-1])))
+            shift = rng.uniform(-max_shift, max_shift, 2)
+            shear = rng.uniform(-max_shear, max_shear, 2)
+            gso = self.gsobject(self.profile, index, radius)
+            gso = gso.shear(g1=shear[0], g2=shear[1]).shift(dx=shift[0], dy=shift[1])
+            direct = gso.drawImage(nx=self.shape[0] * self.hr_factor,
+                                   ny=self.shape[1] * self.hr_factor,
+                                   use_true_center=True,
+                                   method='real_space',
+                                   scale=self.scale,
+                                   dtype=np.float64).array
+            source = self.draw(index, radius, shift=shift, shear=shear)
+            residuals.append(np.max(np.abs(source - direct)) / np.max(direct))
+            flux_errors.append(np.abs(np.sum(source) - np.sum(direct)) / np.sum(direct))
+        return {'max_residual': np.max(residuals), 'median_residual': np.median(residuals),
+                'max_flux_error': np.max(flux_errors)}
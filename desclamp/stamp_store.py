@@ -0,0 +1,170 @@
+import os
+import json
+import numpy as np
+
+
+class StampStore:
+    """ On-disk store of postage stamps, served by memory map.
+
+    Stamps of a given data version and cutout size are stored in a directory as chunks of (N, bands,
+    size, size) arrays for the image, mask and variance planes, each with an index of the objectIds
+    it contains. Chunks are written once and never modified, so that a store can be read by many
+    processes at a time. A store has a single writer.
+    """
+    planes = {"image": np.float32, "mask": np.int32, "variance": np.float32}
+
+    def __init__(self, root, data_version, cutout_size=100, bands='irg', readonly=False):
+        """
+        Parameters
+        ----------
+        root: str
+            directory of the store
+        data_version: str
+            data version of the catalog the stamps are extracted from
+        cutout_size: int
+            size of the postage stamps in pixels
+        bands: str
+            bands stored for each object
+        readonly: bool
+            opens an existing store for reading only
+        """
+        self.path = os.path.join(root, str(data_version), f"size{cutout_size}")
+        self.data_version = data_version
+        self.cutout_size = cutout_size
+        self.bands = bands
+        self.readonly = readonly
+
+        meta_file = os.path.join(self.path, "store.json")
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            assert meta["bands"] == bands, \
+                f"The store at {self.path} contains bands {meta['bands']}."
+        else:
+            assert not readonly, f"No stamp store at {self.path}."
+            os.makedirs(self.path, exist_ok=True)
+            with open(meta_file, "w") as f:
+                json.dump({"data_version": str(data_version), "cutout_size": cutout_size,
+                           "bands": bands}, f)
+
+        self._chunks = []
+        self._rows = {}
+        self.refresh()
+
+    def refresh(self):
+        """ Loads the chunks written since the store was opened.
+        """
+        # A chunk is complete once its index is written
+        names = sorted(f[:-len("_index.npy")] for f in os.listdir(self.path)
+                       if f.endswith("_index.npy"))
+        for name in names[len(self._chunks):]:
+            chunk = {"index": np.load(os.path.join(self.path, name + "_index.npy"))}
+            for plane in self.planes:
+                chunk[plane] = np.load(os.path.join(self.path, f"{name}_{plane}.npy"),
+                                       mmap_mode="r")
+            for row, object_id in enumerate(chunk["index"]["objectId"]):
+                self._rows[int(object_id)] = (len(self._chunks), row)
+            self._chunks.append(chunk)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, object_id):
+        return int(object_id) in self._rows
+
+    def missing(self, object_ids):
+        """ objectIds that are not in the store.
+        """
+        return [object_id for object_id in object_ids if object_id not in self]
+
+    def write(self, cutouts):
+        """ Appends the stamps of a list of cutouts to the store as a new chunk.
+        Cutouts of objects already in the store are skipped.
+
+        Parameters
+        ----------
+        cutouts: list
+            list of `Cutout` objects with one exposure per band of the store.
+
+        Returns
+        -------
+        n: int
+            number of stamps written
+        """
+        assert not self.readonly, "The store is read only."
+        cutouts = [c for c in cutouts if c.catalog["objectId"] not in self]
+        # objectIds repeated in the list are written once
+        cutouts = list({int(c.catalog["objectId"]): c for c in cutouts}.values())
+        if len(cutouts) == 0:
+            return 0
+
+        name = os.path.join(self.path, f"{len(self._chunks):06d}")
+        shape = (len(cutouts), len(self.bands), self.cutout_size, self.cutout_size)
+        for plane, dtype in self.planes.items():
+            array = np.lib.format.open_memmap(f"{name}_{plane}.npy", mode="w+", dtype=dtype,
+                                              shape=shape)
+            for i, cutout in enumerate(cutouts):
+                assert len(cutout.exposure) == len(self.bands)
+                for b, exposure in enumerate(cutout.exposure):
+                    array[i, b] = getattr(exposure.maskedImage, plane).array
+            array.flush()
+            del array
+
+        index = np.zeros(len(cutouts),
+                         dtype=[("objectId", np.int64), ("x0", np.int64), ("y0", np.int64)])
+        for i, cutout in enumerate(cutouts):
+            xy0 = cutout.exposure[0].getXY0()
+            index[i] = (cutout.catalog["objectId"], xy0.getX(), xy0.getY())
+        np.save(f"{name}_index.tmp.npy", index)
+        os.replace(f"{name}_index.tmp.npy", f"{name}_index.npy")
+
+        self.refresh()
+        return len(cutouts)
+
+    def read(self, object_ids, bands=None, planes=("image", "mask", "variance")):
+        """ Reads the stamps of a list of objects.
+
+        Parameters
+        ----------
+        object_ids: list
+            objectIds of the stamps to read. They all have to be in the store.
+        bands: str
+            bands to read, a subset of the bands of the store. Defaults to all of them.
+        planes: tuple
+            planes to read among "image", "mask" and "variance"
+
+        Returns
+        -------
+        stamps: dict
+            dictionary of (N, bands, size, size) arrays for each plane, and "x0", "y0" the lower
+            corner of each stamp in the pixel frame of its tract. Stamps stored next to each other
+            in one chunk, e.g. all the stamps of a chunk in the order they were written, are
+            returned as read only views of the memory maps of the chunk. Other selections are
+            gathered into new arrays.
+        """
+        if bands is None:
+            bands = self.bands
+        band_index = [self.bands.index(band) for band in bands]
+        rows = [self._rows[int(object_id)] for object_id in object_ids]
+
+        if len(rows) > 0 and len(band_index) > 0:
+            chunk, first = rows[0]
+            if (rows == [(chunk, first + i) for i in range(len(rows))] and
+                    band_index == list(range(band_index[0], band_index[0] + len(band_index)))):
+                chunk = self._chunks[chunk]
+                window = np.s_[first:first + len(rows), band_index[0]:band_index[-1] + 1]
+                stamps = {plane: chunk[plane][window] for plane in planes}
+                stamps["x0"] = np.array(chunk["index"]["x0"][first:first + len(rows)])
+                stamps["y0"] = np.array(chunk["index"]["y0"][first:first + len(rows)])
+                return stamps
+
+        shape = (len(rows), len(bands), self.cutout_size, self.cutout_size)
+        stamps = {plane: np.zeros(shape, dtype=self.planes[plane]) for plane in planes}
+        stamps["x0"] = np.zeros(len(rows), dtype=np.int64)
+        stamps["y0"] = np.zeros(len(rows), dtype=np.int64)
+        for i, (chunk, row) in enumerate(rows):
+            for plane in planes:
+                stamps[plane][i] = self._chunks[chunk][plane][row, band_index]
+            stamps["x0"][i] = self._chunks[chunk]["index"]["x0"][row]
+            stamps["y0"][i] = self._chunks[chunk]["index"]["y0"][row]
+        return stamps
@@ -1,5 +1,8 @@
 from .postage import Candidates
+import queue
+import threading
 import numpy as np
+import pandas as pd
 
 class TrainSet(Candidates):
     """ Generates training sets for strong gravitational lens images.
@@ -7,6 +10,10 @@ class TrainSet(Candidates):
     TODO: lensed sources have to be matched to the characteristic of the
     lens galaxy to obtain realistic images.
 
+    Iterating over a `TrainSet` yields batches of `Cutout` objects, a fraction `lens_fraction` of
+    which have a lensed source injected. Batches are fetched and injected ahead of time by a
+    background thread.
+
     Parameters
     ----------
     dc2_data_version: str
@@ -17,38 +24,150 @@ class TrainSet(Candidates):
         number of images generated at once in a given batch.
     lens_fraction: float
         the fraction of images that contain lensed-injected features.
+    lens_sampler: callable
+        function that takes a `numpy.random.Generator` and returns a tuple (lensed_source, spectra,
+        params) where `lensed_source` and `spectra` are passed to `Cutout.inject` and `params` is a
+        dictionary describing the lens. Required if `lens_fraction` > 0.
+    prefetch: int
+        number of batches prepared in advance. At most `prefetch` + 2 batches are held in memory at
+        any time: the queued ones, the one being prepared and the one being consumed. With 0,
+        batches are prepared when requested.
+    seed: int
+        seed of the random draws of lensed images, for reproducible training sets.
+    cutout_size: int
+        size of the postage stamps in pixels
+    bands: str
+        bands of the postage stamps
+    cat, butler:
+        catalog and butler to use instead of the ones of `dc2_data_version`.
     """
 
     def __init__(self,
                  dc2_data_version,
                  n_samples,
                  batchsize=8,
-                 lens_fraction=0.2
+                 lens_fraction=0.2,
+                 lens_sampler=None,
+                 prefetch=2,
+                 seed=0,
+                 cutout_size=100,
+                 bands='irg',
+                 cat=None,
+                 butler=None
                 ):
-
+        assert lens_sampler is not None or lens_fraction == 0, \
+            "Please provide a lens_sampler to inject lenses, or set lens_fraction to 0."
         self.objects = []
         self.n = n_samples
         self.batchsize = batchsize
         self.index = 0
         self.lens_fraction = lens_fraction
-        super().__init__(self, dc2_data_version)
+        self.lens_sampler = lens_sampler
+        self.prefetch = prefetch
+        self.seed = seed
+        self.cutout_size = cutout_size
+        self.bands = bands
+        self._objects = None
+        self._queue = None
+        self._producer = None
+        self._stop = threading.Event()
+        super().__init__(dc2_data_version, cat=cat, butler=butler)
 
-    def catalog_query(self, query, columns = None, tracts = None):
-        objects = super().catalog_query(query, columns = columns, tracts = tracts)
+    def catalog_query(self, query, columns = None, tracts = None, cache = None):
+        objects = super().catalog_query(query, columns = columns, tracts = tracts, cache = cache)
         self.objects.append(objects)
         return objects
 
-    def __iter__(self):
-        return self
+    def __len__(self):
+        return int(np.ceil(self.n / self.batchsize))
 
-    def __next__(self):
-        if self.num >= self.batchsize:
-            raise StopIteration()
-        new_index = np.max([self.index+self.batch_size, self.n_samples])
-        cutouts = self.make_postage_stamps(self.objects[self.index, new_index],
-                                      cutout_size=100,
-                                      bands = 'irg')
+    def make_batch(self, objects, start):
+        """ Fetches the cutouts of a batch and injects lensed sources in a random subset of them.
+        Parameters
+        ----------
+        objects: pandas DataFrame
+            catalog of the objects to sample from. Objects are cycled through if `n_samples` exceeds
+            their number.
+        start: int
+            index of the first sample of the batch
+
+        Returns
+        -------
+        cutouts: list
+            list of `Cutout` objects. Cutouts with an injected lens have their `lens` attribute set.
+        """
+        stop = np.min([start + self.batchsize, self.n])
+        rows = objects.iloc[np.arange(start, stop) % len(objects)]
+        cutouts = self.make_postage_stamps(rows, cutout_size=self.cutout_size, bands=self.bands)
+
+        rng = np.random.default_rng([self.seed, start])
+        lensed = rng.random(len(cutouts)) < self.lens_fraction
+        for i in np.where(lensed)[0]:
+            lensed_source, spectra, params = self.lens_sampler(rng)
+            cutouts[i] = cutouts[i].inject(lensed_source, spectra)
+            cutouts[i].lens = dict(params, spectra=spectra)
         return cutouts
 
+    def _produce(self, objects):
+        """ Fills the prefetch queue. Runs in a background thread.
+        """
+        try:
+            for start in range(self.index, self.n, self.batchsize):
+                batch = self.make_batch(objects, start)
+                while not self._stop.is_set():
+                    try:
+                        self._queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if self._stop.is_set():
+                    return
+        except Exception as error:
+            batch = error
+        else:
+            batch = StopIteration()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(batch, timeout=0.1)
+                return
+            except queue.Full:
+                continue
 
+    def close(self):
+        """ Stops the background prefetching.
+        """
+        self._stop.set()
+        if self._producer is not None:
+            self._producer.join()
+        self._producer = None
+        self._queue = None
 
+    def __iter__(self):
+        self.close()
+        self.index = 0
+        assert len(self.objects) > 0, \
+            "No objects to make a training set from. Please run a catalog query first."
+        self._objects = pd.concat(self.objects, ignore_index=True)
+        if self.prefetch > 0:
+            self._stop = threading.Event()
+            self._queue = queue.Queue(maxsize=self.prefetch)
+            self._producer = threading.Thread(target=self._produce, args=(self._objects,),
+                                              daemon=True)
+            self._producer.start()
+        return self
+
+    def __next__(self):
+        if self._objects is None:
+            self.__iter__()
+        if self.index >= self.n:
+            self.close()
+            raise StopIteration()
+        if self._queue is not None:
+            batch = self._queue.get()
+            if isinstance(batch, BaseException):
+                self.close()
+                raise batch
+        else:
+            batch = self.make_batch(self._objects, self.index)
+        self.index += self.batchsize
+        return batch
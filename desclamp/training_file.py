@@ -0,0 +1,226 @@
+import json
+import numpy as np
+
+# h5py is imported by the writer and reader, so that batches can be converted without it
+
+
+def _json_default(value):
+    """ json encoding of numpy scalars and arrays in the lens parameters."""
+    return np.asarray(value).tolist()
+
+
+def batch_arrays(cutouts):
+    """ Images and labels of a batch of cutouts.
+
+    Parameters
+    ----------
+    cutouts: list
+        list of `Cutout` objects, e.g. a batch of a `TrainSet`
+
+    Returns
+    -------
+    arrays: dict
+        "images" (N, bands, size, size), "labels" 1 for cutouts with a lensed source, "objectId",
+        "spectra" (N, bands) the injected flux in each band (nan without a lensed source) and
+        "params" the json description of the lens and source of each cutout.
+    """
+    n_bands = len(cutouts[0].exposure) if len(cutouts) > 0 else 0
+    spectra = np.full((len(cutouts), n_bands), np.nan, dtype=np.float32)
+    params = []
+    for i, cutout in enumerate(cutouts):
+        lens = dict(cutout.lens) if cutout.lens is not None else None
+        if lens is not None and "spectra" in lens:
+            spectra[i] = lens.pop("spectra")
+        params.append(json.dumps(lens, default=_json_default))
+    return {"images": np.array([[e.image.array for e in c.exposure] for c in cutouts],
+                               dtype=np.float32),
+            "labels": np.array([c.lens is not None for c in cutouts], dtype=np.int8),
+            "objectId": np.array([c.catalog["objectId"] for c in cutouts], dtype=np.int64),
+            "spectra": spectra,
+            "params": np.array(params)}
+
+
+class TrainingSetWriter:
+    """ Streams batches of cutouts to an HDF5 file of fixed-shape float32 images and their labels.
+
+    Images are stored in a (N, bands, size, size) dataset, along with the objectId, label, injected
+    spectra and the json description of the lens of each image. By default datasets are chunked
+    along the samples and compressed, and grow with each batch. When the number of samples is known
+    in advance and compression is disabled, datasets are contiguous and `TrainingSetReader` memory
+    maps them.
+    """
+    def __init__(self, path, bands='irg', cutout_size=100, n_samples=None, chunk=64,
+                 compression='gzip'):
+        """
+        Parameters
+        ----------
+        path: str
+            path of the HDF5 file. An existing file is overwritten.
+        bands: str
+            bands of the images
+        cutout_size: int
+            size of the images in pixels
+        n_samples: int
+            number of samples, if known in advance
+        chunk: int
+            number of samples per chunk of compressed datasets
+        compression: str
+            HDF5 compression filter, or None
+        """
+        import h5py
+        self.path = path
+        self.bands = bands
+        self.cutout_size = cutout_size
+        self.n = 0
+        self._file = h5py.File(path, "w")
+        self._file.attrs["bands"] = bands
+        self._file.attrs["cutout_size"] = cutout_size
+
+        contiguous = n_samples is not None and compression is None
+        shapes = {"images": (len(bands), cutout_size, cutout_size), "labels": (), "objectId": (),
+                  "spectra": (len(bands),), "params": ()}
+        dtypes = {"images": np.float32, "labels": np.int8, "objectId": np.int64,
+                  "spectra": np.float32, "params": h5py.string_dtype()}
+        for name, shape in shapes.items():
+            if contiguous:
+                self._file.create_dataset(name, shape=(n_samples,) + shape, dtype=dtypes[name])
+            else:
+                self._file.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape,
+                                          dtype=dtypes[name], chunks=(chunk,) + shape,
+                                          compression=compression)
+        self._capacity = n_samples
+
+    def write(self, cutouts):
+        """ Appends a batch of cutouts.
+
+        Parameters
+        ----------
+        cutouts: list
+            list of `Cutout` objects with one exposure per band
+        """
+        self.write_arrays(batch_arrays(cutouts))
+
+    def write_arrays(self, arrays):
+        """ Appends a batch given as the arrays of `batch_arrays`, e.g. a batch of a sharded
+        training set.
+        """
+        assert arrays["images"].shape[1:] == self._file["images"].shape[1:], \
+            "Cutouts do not match the file."
+        size = len(arrays["labels"])
+        if self._capacity is not None:
+            assert self.n + size <= self._capacity, \
+                f"More than the {self._capacity} samples of the file."
+        for name, values in arrays.items():
+            dataset = self._file[name]
+            if dataset.maxshape[0] is None:
+                dataset.resize(self.n + size, axis=0)
+            dataset[self.n:self.n + size] = values
+        self.n += size
+
+    def write_train_set(self, train):
+        """ Streams all the batches of a `TrainSet`.
+        """
+        for batch in train:
+            self.write(batch)
+        return self
+
+    def close(self):
+        if self._file:
+            self._file.attrs["n_samples"] = self.n
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TrainingSetReader:
+    """ Random access to the samples of a file written by `TrainingSetWriter`.
+
+    Contiguous uncompressed images are memory mapped, compressed ones are read chunk by chunk
+    through HDF5.
+    """
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path: str
+            path of the HDF5 file
+        """
+        import h5py
+        self.path = path
+        self._file = h5py.File(path, "r")
+        self.bands = self._file.attrs["bands"]
+        self.cutout_size = int(self._file.attrs["cutout_size"])
+        self.n = int(self._file.attrs.get("n_samples", len(self._file["labels"])))
+
+        images = self._file["images"]
+        offset = images.id.get_offset()
+        if images.chunks is None and offset is not None:
+            self.images = np.memmap(path, mode="r", dtype=images.dtype, offset=offset,
+                                    shape=images.shape)
+        else:
+            self.images = images
+        # Labels and metadata are small, they are kept in memory
+        self.labels = self._file["labels"][:self.n]
+        self.object_ids = self._file["objectId"][:self.n]
+        self.spectra = self._file["spectra"][:self.n]
+
+    @property
+    def memory_mapped(self):
+        return isinstance(self.images, np.memmap)
+
+    def __len__(self):
+        return self.n
+
+    def params(self, index):
+        """ Lens and source parameters of a sample, None for samples without a lens.
+        """
+        return json.loads(self._file["params"][index])
+
+    def __getitem__(self, index):
+        """ Images and labels of a sample or of an array of samples, in the order of `index`.
+
+        Returns
+        -------
+        sample: dict
+            "images", "labels", "objectId" and "spectra"
+        """
+        if np.ndim(index) == 0:
+            images = self.images[index]
+        else:
+            # HDF5 reads need strictly increasing indices
+            index = np.asarray(index)
+            unique, inverse = np.unique(index, return_inverse=True)
+            images = self.images[unique][inverse]
+        return {"images": np.asarray(images), "labels": self.labels[index],
+                "objectId": self.object_ids[index], "spectra": self.spectra[index]}
+
+    def batches(self, batchsize, shuffle=False, seed=0):
+        """ Iterates over the samples in batches.
+
+        Parameters
+        ----------
+        batchsize: int
+            number of samples per batch
+        shuffle: bool
+            if True, samples are drawn in a random order
+        seed: int
+            seed of the random order
+        """
+        order = np.arange(self.n)
+        if shuffle:
+            order = np.random.default_rng(seed).permutation(self.n)
+        for start in range(0, self.n, batchsize):
+            yield self[order[start:start + batchsize]]
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
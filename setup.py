@@ -23,4 +23,11 @@ setuptools.setup(
     package_dir={"": "./"},
     packages=setuptools.find_packages(where="./"),
     python_requires=">=3.6",
+    extras_require={
+        # Compiled lensing kernels of desclamp.kernels
+        "numba": ["numba"],
+    },
+    entry_points={
+        "console_scripts": ["desclamp-shards=desclamp.sharding:main"],
+    },
 )
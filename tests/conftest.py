@@ -0,0 +1,12 @@
+import pytest
+from mocks import MockButler, MockCatalog
+
+
+@pytest.fixture
+def mock_catalog():
+    return MockCatalog()
+
+
+@pytest.fixture
+def mock_butler():
+    return MockButler()
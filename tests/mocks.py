@@ -0,0 +1,228 @@
+""" Local stand-ins for the catalog, butler, skymap and exposures of the LSST stack, shared by the
+tests and the benchmarks."""
+import threading
+import time
+import numpy as np
+import pandas as pd
+from astropy.wcs import WCS
+from desclamp.postage import Cutout, pixel_box
+
+
+class MockCatalog(object):
+    """ Stand-in for a GCR object catalog"""
+    def __init__(self, n=20):
+        self.n = n
+        self.n_queries = 0
+
+    def has_quantities(self, quantities):
+        return True
+
+    def get_quantities(self, quantities, filters=None, native_filters=None):
+        """ Quantities of the objects that pass all the `filters`, given as a list of
+        expressions."""
+        self.n_queries += 1
+        data = pd.DataFrame({"objectId": np.arange(self.n),
+                             "ra": 57 + np.arange(self.n) * 1e-3,
+                             "dec": -31 + np.arange(self.n) * 1e-3,
+                             "tract": np.full(self.n, 4639),
+                             "patch": np.full(self.n, "1,1"),
+                             "clean": np.ones(self.n, dtype=bool)})
+        if filters:
+            data = data[np.logical_and.reduce([data.eval(f) for f in filters])]
+        return {q: data[q].to_numpy() for q in quantities}
+
+
+class MockImage(object):
+    """ Stand-in for an afw image plane"""
+    def __init__(self, array):
+        self.array = array
+
+    @staticmethod
+    def Factory(image, deep=False):
+        return MockImage(image.array.copy() if deep else image.array)
+
+
+class MockMaskedImage(object):
+    """ Stand-in for an afw masked image"""
+    def __init__(self, image, mask, variance):
+        self.image = image
+        self.mask = mask
+        self.variance = variance
+
+    @staticmethod
+    def Factory(image, mask, variance):
+        return MockMaskedImage(image, mask, variance)
+
+
+class MockPoint(object):
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+    def getX(self):
+        return self.x
+
+    def getY(self):
+        return self.y
+
+
+class MockPsf(object):
+    """ Stand-in for an afw PSF, a Gaussian with the same kernel everywhere"""
+    def __init__(self, sigma=1.5, size=21):
+        self.sigma, self.size = sigma, size
+
+    def computeKernelImage(self, point):
+        y, x = np.mgrid[:self.size, :self.size] - self.size // 2
+        kernel = np.exp(-(x ** 2 + y ** 2) / (2 * self.sigma ** 2))
+        return MockImage(kernel / np.sum(kernel))
+
+
+class MockExposure(object):
+    """ Stand-in for an afw exposure, with image, mask and variance planes, a parent bounding box,
+    metadata and the wcs and PSF of the mock tract.
+    Image pixels are set to x + 10000 * y in parent coordinates to make slicing errors visible.
+    """
+    def __init__(self, x0, y0, image, mask, variance, metadata=None):
+        self.x0, self.y0 = x0, y0
+        self.maskedImage = MockMaskedImage(MockImage(image), MockImage(mask), MockImage(variance))
+        self.metadata = metadata if metadata is not None else {}
+
+    @classmethod
+    def from_bbox(cls, x0, y0, width, height):
+        y, x = np.mgrid[y0:y0 + height, x0:x0 + width]
+        image = (x + 10000. * y).astype(np.float32)
+        return cls(x0, y0, image, np.zeros(image.shape, dtype=np.int32),
+                   np.ones(image.shape, dtype=np.float32))
+
+    @staticmethod
+    def Factory(exposure, deep=False):
+        if deep:
+            return exposure.clone()
+        masked = exposure.maskedImage
+        return MockExposure(exposure.x0, exposure.y0, masked.image.array, masked.mask.array,
+                            masked.variance.array, exposure.metadata)
+
+    @property
+    def image(self):
+        return self.maskedImage.image
+
+    @property
+    def mask(self):
+        return self.maskedImage.mask
+
+    @property
+    def variance(self):
+        return self.maskedImage.variance
+
+    def getXY0(self):
+        return MockPoint(self.x0, self.y0)
+
+    def getWcs(self):
+        return mock_wcs()
+
+    def getPsf(self):
+        return MockPsf()
+
+    def getBBox(self):
+        height, width = self.image.array.shape
+        return pixel_box(self.x0, self.y0, width, height)
+
+    def __getitem__(self, bbox):
+        """ View of the exposure in a sub-box given in parent coordinates"""
+        x = bbox.getMinX() - self.x0
+        y = bbox.getMinY() - self.y0
+        assert x >= 0 and y >= 0, "Bounding box outside of the exposure"
+        window = np.s_[y:y + bbox.getHeight(), x:x + bbox.getWidth()]
+        return MockExposure(bbox.getMinX(), bbox.getMinY(), self.image.array[window],
+                            self.mask.array[window], self.variance.array[window], self.metadata)
+
+    def clone(self):
+        return MockExposure(self.x0, self.y0, self.image.array.copy(), self.mask.array.copy(),
+                            self.variance.array.copy(), dict(self.metadata))
+
+
+def mock_wcs():
+    """ Tangent plane wcs with 0.2 arcsec pixels, centered on the mock catalog"""
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval = [57, -31]
+    wcs.wcs.crpix = [501, 501]
+    wcs.wcs.cdelt = [-0.2 / 3600, 0.2 / 3600]
+    return wcs
+
+
+class MockTract(object):
+    def getId(self):
+        return 4639
+
+    def getWcs(self):
+        return mock_wcs()
+
+    def getBBox(self):
+        return pixel_box(0, 0, 1000, 1000)
+
+
+class MockSkyMap(object):
+    def __init__(self):
+        self.n_find = 0
+
+    def findTract(self, radec):
+        self.n_find += 1
+        return MockTract()
+
+    def __getitem__(self, tract):
+        return MockTract()
+
+
+class MockButler(object):
+    """ Stand-in for a butler that serves `MockExposure` objects from patches of size `patch_size`.
+
+    Parameters
+    ----------
+    latency: float
+        time in seconds spent in each read
+    failures: int
+        number of reads that fail with `error` before reads succeed
+    error: type
+        exception raised by the failed reads, an `OSError` by default
+    """
+    patch_size = 1500
+
+    def __init__(self, latency=0, failures=0, error=OSError):
+        self.latency = latency
+        self.failures = failures
+        self.error = error
+        self.n_reads = 0
+        self.n_pixels = 0
+        self._lock = threading.Lock()
+
+    def get(self, dataset, bbox=None, **kwargs):
+        if dataset == "deepCoadd_skyMap":
+            return MockSkyMap()
+        time.sleep(self.latency)
+        with self._lock:
+            self.n_reads += 1
+            if self.failures > 0:
+                self.failures -= 1
+                raise self.error("Read failure")
+        if bbox is None:
+            exposure = MockExposure.from_bbox(0, 0, self.patch_size, self.patch_size)
+        else:
+            exposure = MockExposure.from_bbox(bbox.getMinX(), bbox.getMinY(), bbox.getWidth(),
+                                              bbox.getHeight())
+        with self._lock:
+            self.n_pixels += exposure.image.array.size
+        return exposure
+
+
+def lens_sampler(rng):
+    """ Lens sampler of a `TrainSet` with a flat 10x10 source."""
+    return np.ones((10, 10)), (1, 2, 3), {"theta_E": rng.uniform(0.5, 1.5)}
+
+
+def mock_inject(self, lensed_source, spectra):
+    """ Stand-in for `Cutout.inject` that adds the source to the corner of each band, without the
+    LSST stack."""
+    exposure = [e.clone() for e in self.exposure]
+    for e, s in zip(exposure, spectra):
+        e.image.array[:10, :10] += lensed_source * s
+    return Cutout(exposure, self.catalog)
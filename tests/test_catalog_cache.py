@@ -0,0 +1,71 @@
+import numpy.testing as npt
+import numpy as np
+import pytest
+from desclamp.catalog_cache import CatalogCache, query_mask, query_quantities
+
+
+class TestCatalogCache(object):
+
+    def setup_method(self):
+        self.data = {4639: {"objectId": np.arange(5), "ra": np.linspace(57, 58, 5),
+                            "patch": np.array(["1,1", "1,2", "1,1", "2,2", "0,0"], dtype=object)},
+                     4640: {"objectId": np.arange(5, 8), "ra": np.linspace(58, 59, 3),
+                            "patch": np.array(["0,1"] * 3, dtype=object)}}
+
+    def test_write_read(self, tmp_path):
+        cache = CatalogCache(str(tmp_path), "mock")
+        for tract, data in self.data.items():
+            cache.write(tract, data)
+        assert cache.tracts() == [4639, 4640]
+        assert cache.columns(4640) == ["objectId", "patch", "ra"]
+
+        # Projection and selection by tract
+        table = cache.read([4640, 4639], ["objectId", "patch"])
+        assert set(table) == {"objectId", "patch"}
+        npt.assert_array_equal(table["objectId"], [5, 6, 7, 0, 1, 2, 3, 4])
+        assert list(table["patch"][:4]) == ["0,1", "0,1", "0,1", "1,1"]
+
+        # The cache persists across instances
+        reopened = CatalogCache(str(tmp_path), "mock")
+        npt.assert_array_equal(reopened.read([4639], ["ra"])["ra"], self.data[4639]["ra"])
+
+    def test_missing(self, tmp_path):
+        cache = CatalogCache(str(tmp_path), "mock")
+        cache.write(4639, {"objectId": np.arange(5)})
+        assert cache.missing([4639, 4640], ["objectId", "ra"]) == {4639: ["ra"],
+                                                                   4640: ["objectId", "ra"]}
+        with pytest.raises(AssertionError):
+            cache.read([4639], ["ra"])
+        cache.write(4639, {"ra": self.data[4639]["ra"]})
+        assert cache.missing([4639], ["objectId", "ra"]) == {}
+
+    def test_alignment(self, tmp_path):
+        cache = CatalogCache(str(tmp_path), "mock")
+        cache.write(4639, {"objectId": self.data[4639]["objectId"], "ra": self.data[4639]["ra"]})
+        # Columns read later in another order are aligned on objectId
+        order = [3, 0, 4, 2, 1]
+        cache.write(4639, {"objectId": self.data[4639]["objectId"][order],
+                           "patch": self.data[4639]["patch"][order]})
+        table = cache.read([4639], ["objectId", "patch"])
+        npt.assert_array_equal(table["objectId"], np.arange(5))
+        assert list(table["patch"]) == list(self.data[4639]["patch"])
+        # Columns of other objects are rejected
+        with pytest.raises(AssertionError):
+            cache.write(4639, {"dec": np.zeros(4)})
+        with pytest.raises(AssertionError):
+            cache.write(4639, {"objectId": np.arange(1, 6), "dec": np.zeros(5)})
+        files = [f.name for f in (tmp_path / "mock" / "tract4639").iterdir()]
+        assert [name for name in files if "tmp" in name] == []
+
+    def test_query(self):
+        table = {"ra": np.array([57., 57.5, 58., np.nan]), "mag_g": np.array([21., 23., 24., 20.]),
+                 "mag_r": np.array([20., 22.5, 22., 19.])}
+        query = ("mag_g - mag_r > 0.4", "log10(abs(ra)) < 1.76", (np.isfinite, "ra"))
+        assert query_quantities(query) == ["mag_g", "mag_r", "ra"]
+        # Cuts are combined with AND
+        npt.assert_array_equal(query_mask(query, table), [True, True, False, False])
+        npt.assert_array_equal(query_mask(("mag_g > 20",), table), [True, True, True, False])
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,33 @@
+import json
+import subprocess
+import sys
+import pytest
+
+# Backends that should only be imported by the code paths that use them
+HEAVY = ("lsst", "GCRCatalogs", "desc_dc2_dm_data", "galsim", "lenstronomy", "matplotlib",
+         "astropy")
+
+
+def import_module(module):
+    """ Time to import a module in a fresh interpreter, and the top-level packages it imports."""
+    code = ("import json, sys, time; start = time.perf_counter(); import {}; "
+            "print(json.dumps([time.perf_counter() - start, "
+            "sorted({{m.split('.')[0] for m in sys.modules}})]))")
+    output = subprocess.run([sys.executable, "-c", code.format(module)], capture_output=True,
+                            text=True, check=True)
+    return json.loads(output.stdout)
+
+
+class TestImports(object):
+
+    @pytest.mark.parametrize("module", ["desclamp.lens_sources", "desclamp.postage",
+                                        "desclamp.train_set", "desclamp.source_library"])
+    def test_lazy_backends(self, module):
+        _, modules = import_module(module)
+        assert not set(HEAVY) & set(modules)
+
+    def test_import_time(self):
+        # Lensing workers start without the imaging and catalog stacks
+        seconds, _ = min((import_module("desclamp.lens_sources") for _ in range(3)),
+                         key=lambda r: r[0])
+        assert seconds < 0.5
@@ -0,0 +1,79 @@
+import numpy.testing as npt
+import numpy as np
+import pytest
+from scipy import signal
+from desclamp import injection
+
+
+def gaussian_psf(sigma, size=21):
+    y, x = np.mgrid[:size, :size] - size // 2
+    return np.exp(-(x ** 2 + y ** 2) / (2 * sigma ** 2))
+
+
+class TestInjection(object):
+
+    def setup_method(self):
+        psfs = [gaussian_psf(s) for s in (1.5, 2., 2.5)]
+        self.injector = injection.FFTInjector(psfs, (100, 100), pix=0.2)
+
+    def test_flux_conservation(self):
+        # Same source and fluxes as test_postage.py::test_inject
+        lensed = np.zeros((10, 10))
+        lensed[4, 4] = 1
+        spectra = (100, 200, 300)
+        images = np.random.default_rng(0).normal(size=(3, 100, 100))
+        injected = self.injector.inject(images, lensed, spectra, scale=0.05)
+        for i in range(3):
+            npt.assert_almost_equal(np.sum(injected[i] - images[i]), np.sum(lensed) * spectra[i], 4)
+
+        self.injector.inject(images, lensed, spectra, scale=0.05, inplace=True)
+        npt.assert_array_equal(images, injected)
+
+    def test_convolution(self):
+        lensed = np.random.default_rng(1).random((40, 40))
+        rendered = self.injector.render(lensed, (1, 1, 1), scale=0.05, center=(29.5, 59.5))
+        binned, _ = self.injector.rebin(lensed, 0.05)
+        canvas = np.zeros((100, 100))
+        canvas[55:65, 25:35] = binned / np.sum(binned)
+        for i in range(3):
+            direct = signal.fftconvolve(canvas, self.injector.psfs[i], mode='same')
+            npt.assert_allclose(rendered[i], direct, atol=1e-12)
+
+    def test_cube(self):
+        rng = np.random.default_rng(2)
+        cube = rng.random((3, 40, 40))
+        spectra = (1, 2, 3)
+        rendered = self.injector.render(cube, spectra, scale=0.05, center=(40.25, 55.7))
+        for i in range(3):
+            band = self.injector.render(cube[i], spectra, scale=0.05, center=(40.25, 55.7))
+            npt.assert_allclose(rendered[i], band[i], atol=1e-12)
+
+    def test_subpixel_center(self):
+        lensed = gaussian_psf(3., size=41)
+        for center in [(49.5, 49.5), (40.25, 55.7)]:
+            rendered = self.injector.render(lensed, (1, 1, 1), scale=0.05, center=center)
+            y, x = np.mgrid[:100, :100]
+            npt.assert_almost_equal(np.sum(rendered[0] * x), center[0], 4)
+            npt.assert_almost_equal(np.sum(rendered[0] * y), center[1], 4)
+
+    def test_rectangular_source(self):
+        y, x = np.mgrid[:41, :81] - np.array([20, 40])[:, None, None]
+        lensed = np.exp(-(x ** 2 / 200. + y ** 2 / 50.))
+        rendered = self.injector.render(lensed, (1, 1, 1), scale=0.05, center=(40.25, 55.7))
+        y, x = np.mgrid[:100, :100]
+        npt.assert_almost_equal(np.sum(rendered[0]), 1, 6)
+        npt.assert_almost_equal(np.sum(rendered[0] * x), 40.25, 4)
+        npt.assert_almost_equal(np.sum(rendered[0] * y), 55.7, 4)
+
+    def test_empty_source(self):
+        images = np.ones((3, 100, 100))
+        injected = self.injector.inject(images, np.zeros((10, 10)), (100, 200, 300), scale=0.05)
+        npt.assert_array_equal(injected, images)
+
+    def test_pixel_multiple(self):
+        with pytest.raises(AssertionError):
+            self.injector.rebin(np.ones((10, 10)), 0.03)
+
+
+if __name__ == '__main__':
+    pytest.main()
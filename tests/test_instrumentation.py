@@ -0,0 +1,78 @@
+import json
+import tracemalloc
+import numpy as np
+from desclamp import instrumentation
+from desclamp.instrumentation import timed
+from desclamp.lens_sources import Lensing_frame
+
+
+@timed("allocate", nbytes=lambda array: array.nbytes)
+def allocate(n):
+    return np.ones(n)
+
+
+@timed("outer")
+def outer(n):
+    allocate(n)
+    return allocate(n // 2)
+
+
+class TestInstrumentation(object):
+
+    def setup_method(self):
+        Lensing_frame.deflection_cache.clear()
+        self.lens_args = [{'theta_E': 1., 'e1': 0.1, 'e2': -0.05, 'center_x': 0.05, 'center_y': 0},
+                          {'gamma1': 0.02, 'gamma2': 0.01, 'ra_0': 0, 'dec_0': 0}]
+
+    def test_disabled(self):
+        assert not instrumentation.enabled()
+        with instrumentation.profile() as report:
+            assert instrumentation.enabled()
+        allocate(10)
+        assert not instrumentation.enabled() and report.stats == {}
+
+    def test_stages(self):
+        frame = Lensing_frame(shape=(40, 40), pix=0.2, hr_factor=2)
+        with instrumentation.profile() as report:
+            frame.from_galsim_parametric(1., profile='Spergel', half_light_radius=0.4)
+            for _ in range(3):
+                frame.lens_source(['SIE', 'SHEAR'], self.lens_args)
+        assert report.stats["Lensing_frame.lens_source"]["calls"] == 3
+        assert report.stats["Lensing_frame.lens_cube"]["calls"] == 3
+        assert report.stats["Lensing_frame.from_galsim_parametric"]["calls"] == 1
+        # Times are inclusive of the nested stages
+        stats = report.stats
+        assert stats["Lensing_frame.lens_source"]["seconds"] >= \
+            stats["Lensing_frame.lens_cube"]["seconds"]
+
+    def test_memory(self):
+        with instrumentation.profile(memory=True) as report:
+            outer(100000)
+        assert report.stats["allocate"]["calls"] == 2
+        assert report.stats["allocate"]["bytes_read"] == 1200000
+        assert report.stats["allocate"]["peak_bytes"] >= 800000
+        # The first array is freed on return, the second one is kept
+        assert 400000 <= report.stats["outer"]["allocated_bytes"] < 800000
+        assert report.stats["outer"]["peak_bytes"] >= 800000
+
+    def test_memory_python38(self, monkeypatch):
+        # tracemalloc.reset_peak is not available before Python 3.9
+        monkeypatch.delattr(tracemalloc, "reset_peak", raising=False)
+        with instrumentation.profile(memory=True) as report:
+            outer(100000)
+            outer(100000)
+        assert report.stats["outer"]["calls"] == 2
+        assert 400000 <= report.stats["outer"]["allocated_bytes"] < 1600000
+        assert report.stats["outer"]["peak_bytes"] >= 800000
+
+    def test_export(self, tmp_path):
+        with instrumentation.profile() as report:
+            allocate(10)
+        exported = json.loads(report.to_json(str(tmp_path / "run.json")))
+        assert exported["allocate"]["bytes_read"] == 80
+        with open(tmp_path / "run.json") as f:
+            assert json.load(f) == report.stats
+        text = report.to_prometheus(labels={"run": "test"})
+        assert "# TYPE desclamp_calls_total counter" in text
+        assert 'desclamp_calls_total{stage="allocate",run="test"} 1' in text
+        assert 'desclamp_read_bytes_total{stage="allocate",run="test"} 80' in text
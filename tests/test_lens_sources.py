@@ -0,0 +1,348 @@
+import numpy.testing as npt
+import numpy as np
+import pytest
+import galsim
+from desclamp import lens_sources
+from desclamp import source_library
+
+
+def image_model(size, pix, hr_factor, lens_models):
+    """ lenstronomy `ImageModel` of a square frame, the reference of the lensing of
+    `Lensing_frame`"""
+    from lenstronomy.Data.imaging_data import ImageData
+    from lenstronomy.Data.psf import PSF
+    from lenstronomy.ImSim.image_model import ImageModel
+    from lenstronomy.LensModel.lens_model import LensModel
+    from lenstronomy.LightModel.light_model import LightModel
+    import lenstronomy.Util.simulation_util as sim_util
+    return ImageModel(data_class=ImageData(**sim_util.data_configure_simple(size, pix)),
+                      lens_model_class=LensModel(lens_models),
+                      source_model_class=LightModel(light_model_list=['INTERPOL']),
+                      psf_class=PSF(psf_type='NONE'),
+                      kwargs_numerics={'supersampling_factor': hr_factor,
+                                       'supersampling_convolution': False})
+
+
+def random_lens(rng):
+    """ Sampler of source and lens parameters used to test the parallel generator"""
+    source_kwargs = {'profile': 'Spergel', 'half_light_radius': rng.uniform(0.2, 0.5),
+                     'shift': tuple(rng.normal(0, 0.2, 2))}
+    lens_args = [{'theta_E': rng.uniform(0.5, 1.5), 'e1': 0.05, 'e2': 0, 'center_x': 0,
+                  'center_y': 0}]
+    return (rng.uniform(0.5, 2),), source_kwargs, ['SIE'], lens_args
+
+
+def test_deflection_cache_default():
+    # Frames do not cache the deflections of lenses unless asked to
+    assert lens_sources.Lensing_frame.deflection_cache.info['maxbytes'] == 0
+
+
+class TestLensSources(object):
+
+    @pytest.fixture(autouse=True)
+    def deflection_cache(self, monkeypatch):
+        monkeypatch.setattr(lens_sources.Lensing_frame, "deflection_cache",
+                            lens_sources.DeflectionCache())
+
+    def setup_method(self):
+        self.lens_models = ['SIE', 'SHEAR']
+        self.lens_args = [{'theta_E': 1., 'e1': 0.1, 'e2': -0.05, 'center_x': 0.05, 'center_y': 0},
+                          {'gamma1': 0.02, 'gamma2': 0.01, 'ra_0': 0, 'dec_0': 0}]
+        lens_sources.Lensing_frame.frame_cache.clear()
+        lens_sources.Lensing_frame.deflection_cache.clear()
+        self.frame = lens_sources.Lensing_frame(shape=(40, 40), pix=0.2, hr_factor=2)
+        self.frame.from_galsim_parametric(1., profile='Spergel', half_light_radius=0.3,
+                                          shift=(0.1, 0))
+
+    def test_frame_cache(self):
+        cache = lens_sources.Lensing_frame.frame_cache
+        first = self.frame.lens_source(self.lens_models, self.lens_args)
+        # The coordinates of the frame and the lens model are built by the first call only
+        assert cache.info == {'hits': 0, 'misses': 2, 'size': 2, 'maxsize': 16}
+        second = self.frame.lens_source(self.lens_models, self.lens_args)
+        npt.assert_array_equal(first, second)
+        assert cache.info == {'hits': 2, 'misses': 2, 'size': 2, 'maxsize': 16}
+        new_frame = lens_sources.Lensing_frame(shape=(40, 40), pix=0.2, hr_factor=2)
+        new_frame.lens_cube(self.frame.source[None], ['SIE'], self.lens_args[:1])
+        assert cache.hits == 3 and cache.misses == 3
+
+        # Coordinates are those of the supersampled lenstronomy grid
+        imageModel = image_model(40, 0.2, 2, self.lens_models)
+        npt.assert_allclose(cache.coordinates((40, 40), 0.2, 2),
+                            imageModel.ImageNumerics.coordinates_evaluate, rtol=0, atol=1e-12)
+        assert cache.hits == 4 and cache.misses == 3
+
+        # A new source on the same frame must not reuse the previous interpolation
+        other = lens_sources.Lensing_frame(shape=(40, 40), pix=0.2, hr_factor=2)
+        other.from_galsim_parametric(1., profile='Spergel', half_light_radius=0.3,
+                                     shift=(-0.3, 0.2))
+        lensed = other.lens_source(self.lens_models, self.lens_args)
+        assert not np.allclose(lensed, first)
+
+    def test_frame_cache_eviction(self):
+        cache = lens_sources.FrameCache(maxsize=2)
+        cache.coordinates((40, 40), 0.2, 1)
+        cache.coordinates((40, 24), 0.2, 1)
+        cache.coordinates((40, 40), 0.2, 1)
+        cache.lens_model(['SIE'])
+        # Coordinates and lens models share the bound
+        assert len(cache) == 2
+        assert ('coordinates',) + cache.key((40, 24), 0.2, 1) not in cache._entries
+        assert cache.info == {'hits': 1, 'misses': 3, 'size': 2, 'maxsize': 2}
+        for size in range(10, 50):
+            cache.coordinates((size, 20), 0.2, 2)
+        assert cache.info['size'] == 2
+
+    def test_deflection_cache(self, tmp_path):
+        cache = lens_sources.Lensing_frame.deflection_cache
+        first = self.frame.lens_source(self.lens_models, self.lens_args)
+        # Same as lenstronomy's INTERPOL profile
+        imageModel = image_model(40, 0.2, 2, self.lens_models)
+        npt.assert_allclose(first, imageModel.image(self.lens_args, self.frame.source_args),
+                            rtol=0, atol=1e-12 * np.max(first))
+
+        self.frame.from_galsim_parametric(1., profile='Spergel', half_light_radius=0.3,
+                                          shift=(-0.3, 0.2))
+        second = self.frame.lens_source(self.lens_models, self.lens_args)
+        assert cache.info['misses'] == 1 and cache.info['hits'] == 1
+        assert not np.allclose(first, second)
+        # Keyword arguments are hashed by value
+        self.frame.lens_source(self.lens_models,
+                               [dict(reversed(list(a.items()))) for a in self.lens_args])
+        assert cache.hits == 2
+
+        # Eviction is bounded by bytes, one map is 2 * 80 * 80 floats
+        small = lens_sources.DeflectionCache(maxbytes=2 * 2 * 80 * 80 * 8, path=str(tmp_path))
+        lensModel = imageModel.LensModel
+        coordinates = imageModel.ImageNumerics.coordinates_evaluate
+        for theta_E in (1., 1.1, 1.2, 1.):
+            args = [dict(self.lens_args[0], theta_E=theta_E), self.lens_args[1]]
+            beta = small.get(lensModel, coordinates, (40, 40), 0.2, 2, args)
+        assert len(small) == 2 and small.nbytes == beta.nbytes * 2
+        assert small.misses == 4
+        # Maps persisted to disk are memory mapped by a new cache
+        persisted = lens_sources.DeflectionCache(path=str(tmp_path))
+        npt.assert_array_equal(persisted.get(lensModel, coordinates, (40, 40), 0.2, 2, args), beta)
+        assert len(list(tmp_path.glob("*.npy"))) == 3
+
+    def test_deflection_cache_arrays(self):
+        cache = lens_sources.Lensing_frame.deflection_cache
+        lens_models = ['SIS', 'SHAPELETS_CART']
+        lens_args = [{'theta_E': 1., 'center_x': 0, 'center_y': 0},
+                     {'coeffs': [0.1, 0.02, -0.01], 'beta': 1., 'center_x': 0, 'center_y': 0}]
+        first = self.frame.lens_source(lens_models, lens_args)
+        coeffs = np.array([0.1, 0.02, -0.01])
+        self.frame.lens_source(lens_models, [lens_args[0], dict(lens_args[1], coeffs=coeffs)])
+        assert cache.info['misses'] == 1 and cache.info['hits'] == 1
+        other_args = [lens_args[0], dict(lens_args[1], coeffs=[0.1, 0.05, -0.01])]
+        other = self.frame.lens_source(lens_models, other_args)
+        assert cache.misses == 2
+        assert not np.allclose(first, other)
+
+        # Disabled cache
+        disabled = lens_sources.DeflectionCache(maxbytes=0)
+        lensModel = lens_sources.Lensing_frame.frame_cache.lens_model(lens_models)
+        coordinates = lens_sources.Lensing_frame.frame_cache.coordinates((40, 40), 0.2, 2)
+        for _ in range(2):
+            disabled.get(lensModel, coordinates, (40, 40), 0.2, 2, lens_args)
+        assert disabled.info == {'hits': 0, 'misses': 2, 'size': 0, 'nbytes': 0, 'maxbytes': 0}
+
+    def test_rectangular_frame(self):
+        shift = (0.3, 0.1)
+        square = lens_sources.Lensing_frame(shape=(40, 40), pix=0.2, hr_factor=2)
+        square.from_galsim_parametric(1., profile='Spergel', half_light_radius=0.3, shift=shift)
+        rectangle = lens_sources.Lensing_frame(shape=(40, 24), pix=0.2, hr_factor=2)
+        rectangle.from_galsim_parametric(1., profile='Spergel', half_light_radius=0.3, shift=shift)
+        assert rectangle.source.shape == (48, 80)
+        npt.assert_allclose(rectangle.source, square.source[16:64], rtol=0,
+                            atol=1e-6 * np.max(square.source))
+
+        lensed = rectangle.lens_source(self.lens_models, self.lens_args)
+        assert lensed.shape == (24, 40)
+        # Same as the central rows of a square frame, away from the edges of the source images
+        reference = square.lens_source(self.lens_models, self.lens_args)[8:32]
+        npt.assert_allclose(lensed, reference, rtol=0, atol=1e-4 * np.max(reference))
+        batch = rectangle.lens_batch(np.array([rectangle.source] * 2), self.lens_models,
+                                     [self.lens_args] * 2)
+        assert batch.shape == (2, 24, 40)
+
+    def test_lens_batch(self):
+        sources = []
+        lens_args = []
+        single = []
+        for shift, theta_E in [((0.1, 0), 1.), ((-0.2, 0.3), 0.7), ((0, -0.1), 1.3)]:
+            self.frame.from_galsim_parametric(1.5, profile='Spergel', half_light_radius=0.4,
+                                              shift=shift)
+            args = [dict(self.lens_args[0], theta_E=theta_E), self.lens_args[1]]
+            sources.append(self.frame.source)
+            lens_args.append(args)
+            single.append(self.frame.lens_source(self.lens_models, args))
+
+        batch = self.frame.lens_batch(np.array(sources), self.lens_models, lens_args)
+        assert batch.shape == (3, 40, 40)
+        npt.assert_allclose(batch, np.array(single), rtol=0, atol=1e-12 * np.max(single))
+
+    def test_lens_cube(self):
+        bulge = galsim.Spergel(nu=-0.5, half_light_radius=0.2)
+        disk = galsim.Spergel(nu=1.5, half_light_radius=0.6).shear(g1=0.2, g2=0)
+        gsobjects = [bulge + disk, 0.3 * bulge + disk, disk]
+        self.frame.from_gsobjects(gsobjects)
+        assert self.frame.source.shape == (3, 80, 80)
+        cube = self.frame.lens_source(self.lens_models, self.lens_args)
+        assert cube.shape == (3, 40, 40)
+
+        for gso, lensed in zip(gsobjects, cube):
+            self.frame.from_gsobject(gso)
+            single = self.frame.lens_source(self.lens_models, self.lens_args)
+            npt.assert_allclose(lensed, single, rtol=0, atol=1e-12 * np.max(single))
+
+    def test_numba_kernel(self):
+        kernels = pytest.importorskip("desclamp.kernels")
+        from lenstronomy.LensModel.lens_model import LensModel
+        rng = np.random.default_rng(1)
+        x, y = rng.uniform(-4, 4, (2, 1000))
+        x[0], y[0] = 0.3, 0.1
+        lenses = [(['SIS'], [{'theta_E': 1.2, 'center_x': 0.3, 'center_y': 0.1}]),
+                  (['SIE'], [{'theta_E': 0.8, 'e1': 0, 'e2': 0}]),
+                  (['SIE', 'SIS', 'SHEAR'],
+                   [{'theta_E': 1.5, 'e1': -0.3, 'e2': 0.2, 'center_x': 0.3, 'center_y': 0.1},
+                    {'theta_E': 0.2, 'center_x': 2, 'center_y': 1}, self.lens_args[1]])]
+        for lens_models, lens_args in lenses:
+            npt.assert_allclose(kernels.ray_shoot(x, y, lens_models, lens_args),
+                                LensModel(lens_models).ray_shooting(x, y, lens_args),
+                                rtol=0, atol=1e-12)
+
+        for shape, hr_factor in [((40, 24), 2), ((30, 30), 3)]:
+            frames = [lens_sources.Lensing_frame(shape=shape, pix=0.2, hr_factor=hr_factor,
+                                                 kernel=kernel)
+                      for kernel in ('lenstronomy', 'numba')]
+            for frame in frames:
+                frame.from_gsobjects([galsim.Spergel(nu=nu, half_light_radius=0.4)
+                                      for nu in (-0.5, 0.5, 1.5)])
+            results = []
+            for frame in frames:
+                lens_sources.Lensing_frame.deflection_cache.clear()
+                results.append((frame.lens_source(self.lens_models, self.lens_args),
+                                frame.lens_batch(frame.source, self.lens_models,
+                                                 [self.lens_args] * 3)))
+            for reference, lensed in zip(*results):
+                npt.assert_allclose(lensed, reference, rtol=0, atol=1e-12 * np.max(reference))
+
+        # Other lens models fall back to lenstronomy
+        frame = lens_sources.Lensing_frame(shape=(40, 40), pix=0.2, hr_factor=2, kernel='numba')
+        assert frame._kernels(['EPL']) is None and frame._kernels(self.lens_models) is kernels
+        frame.source = self.frame.source
+        epl = [{'theta_E': 1., 'gamma': 2.1, 'e1': 0.1, 'e2': 0, 'center_x': 0, 'center_y': 0}]
+        npt.assert_array_equal(frame.lens_source(['EPL'], epl),
+                               self.frame.lens_source(['EPL'], epl))
+
+        # Workers are not forked from this process, whose kernel threads have started
+        images, _ = lens_sources.LensedSourceGenerator(shape=(30, 30), hr_factor=2, n_workers=1,
+                                                       seed=42).generate(random_lens, 4)
+        generator = lens_sources.LensedSourceGenerator(shape=(30, 30), hr_factor=2, n_workers=2,
+                                                       seed=42, kernel='numba')
+        compiled, _ = generator.generate(random_lens, 4, chunksize=1)
+        npt.assert_allclose(compiled, images, rtol=0, atol=1e-12 * np.max(images))
+
+    def test_adaptive_supersampling(self):
+        lens_sources.Lensing_frame.mask_cache.clear()
+        # Supersampling all pixels is the same as uniform supersampling
+        uniform = lens_sources.Lensing_frame(shape=(40, 24), pix=0.2, hr_factor=3)
+        everywhere = lens_sources.Lensing_frame(shape=(40, 24), pix=0.2, hr_factor=3,
+                                                supersampling='adaptive', magnification_threshold=0)
+        for frame in (uniform, everywhere):
+            frame.from_gsobjects([galsim.Spergel(nu=nu, half_light_radius=0.4)
+                                  for nu in (-0.5, 1.5)])
+        reference = uniform.lens_source(self.lens_models, self.lens_args)
+        npt.assert_allclose(everywhere.lens_source(self.lens_models, self.lens_args), reference,
+                            rtol=0, atol=1e-12 * np.max(reference))
+
+        # Flux error bound of the default thresholds
+        rng = np.random.default_rng(3)
+        for hr_factor in (4, 8):
+            uniform = lens_sources.Lensing_frame(shape=(64, 64), pix=0.2, hr_factor=hr_factor,
+                                                 method='fft')
+            adaptive = lens_sources.Lensing_frame(shape=(64, 64), pix=0.2, hr_factor=hr_factor,
+                                                  supersampling='adaptive')
+            for _ in range(3):
+                source = dict(half_light_radius=rng.uniform(0.1, 0.5),
+                              shift=tuple(rng.normal(0, 0.3, 2)))
+                lens_args = [dict(self.lens_args[0], theta_E=rng.uniform(0.8, 1.5),
+                                  e1=rng.normal(0, 0.1)),
+                             self.lens_args[1]]
+                uniform.from_galsim_parametric(rng.uniform(-0.5, 1.5), profile='Spergel', **source)
+                adaptive.source = uniform.source
+                reference = uniform.lens_source(self.lens_models, lens_args)
+                lensed = adaptive.lens_source(self.lens_models, lens_args)
+                assert abs(np.sum(lensed) / np.sum(reference) - 1) < 1e-3
+                npt.assert_allclose(lensed, reference, rtol=0, atol=1e-3 * np.max(reference))
+
+        # Masks are computed once per lens
+        misses = lens_sources.Lensing_frame.mask_cache.misses
+        adaptive.lens_batch(np.array([adaptive.source] * 2), self.lens_models, [lens_args] * 2)
+        assert lens_sources.Lensing_frame.mask_cache.misses == misses
+        assert np.mean(adaptive.magnification_mask(self.lens_models, lens_args)) < 0.1
+
+    def test_generator(self):
+        serial = lens_sources.LensedSourceGenerator(shape=(30, 30), hr_factor=2, n_workers=1,
+                                                    seed=42)
+        images, params = serial.generate(random_lens, 6)
+        assert images.shape == (6, 30, 30)
+        assert serial.stats['n_images'] == 6
+        # Workers do not cache the deflections of random lenses
+        assert lens_sources._worker_frame.deflection_cache.info['size'] == 0
+        assert len(lens_sources.Lensing_frame.deflection_cache) == 0
+
+        parallel = lens_sources.LensedSourceGenerator(shape=(30, 30), hr_factor=2, n_workers=2,
+                                                      seed=42)
+        images_parallel, params_parallel = parallel.generate(random_lens, 6, chunksize=1)
+        npt.assert_array_equal(images, images_parallel)
+        assert params == params_parallel
+        assert sum(w['n_images'] for w in parallel.stats['workers'].values()) == 6
+
+        frame = lens_sources.Lensing_frame(shape=(30, 30), hr_factor=2)
+        frame.from_galsim_parametric(*params[3]['source_args'], **params[3]['source_kwargs'])
+        npt.assert_array_equal(images[3], frame.lens_source(['SIE'], params[3]['lens_args']))
+
+    def test_drawing_methods(self):
+        frame = lens_sources.Lensing_frame(shape=(40, 40), pix=0.2, hr_factor=2, method='fft',
+                                           dtype=np.float32, reuse_buffer=True)
+        first = frame.from_galsim_parametric(1., profile='Spergel', half_light_radius=0.3,
+                                             shift=(0.1, 0)).source
+        assert first.dtype == np.float32
+        npt.assert_allclose(first, self.frame.source, atol=5e-3 * np.max(self.frame.source))
+
+        # The buffer is drawn into in place
+        second = frame.from_gsobject(galsim.Exponential(half_light_radius=0.5)).source
+        assert second is first
+        npt.assert_almost_equal(np.sum(second), 1, 3)
+
+        photons = lens_sources.Lensing_frame(shape=(40, 40), pix=0.2, hr_factor=2, method='phot',
+                                             draw_kwargs={'rng': galsim.BaseDeviate(1),
+                                                          'n_photons': 1e5})
+        photons.from_galsim_parametric(1., profile='Spergel', half_light_radius=0.3, shift=(0.1, 0))
+        npt.assert_almost_equal(np.sum(photons.source), np.sum(self.frame.source), 2)
+
+    def test_source_library(self, tmp_path):
+        library = source_library.SourceLibrary.build('Spergel', indices=[0, 0.5, 1],
+                                                     radii=[0.3, 0.45, 0.6], shape=(10, 10),
+                                                     pix=0.2, hr_factor=1, path=tmp_path)
+        library = source_library.SourceLibrary.load(tmp_path)
+        assert isinstance(library.bank, np.memmap)
+
+        frame = lens_sources.Lensing_frame(shape=(10, 10), pix=0.2, hr_factor=1)
+        frame.from_library(library, 0.5, 0.45, shift=(0.1, -0.1), shear=(0.1, 0.05))
+        direct = frame.from_galsim_parametric(0.5, profile='Spergel', half_light_radius=0.45,
+                                              shift=(0.1, -0.1), shear=(0.1, 0.05)).source
+        npt.assert_allclose(library.draw(0.5, 0.45, shift=(0.1, -0.1), shear=(0.1, 0.05)), direct,
+                            atol=0.01 * np.max(direct))
+
+        report = library.accuracy(n_samples=5, max_shift=0.1, max_shear=0.1)
+        assert report['median_residual'] < 0.02
+        assert report['max_flux_error'] < 0.01
+        with pytest.raises(AssertionError):
+            library.draw(2, 0.45)
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,46 @@
+import numpy.testing as npt
+import numpy as np
+import pytest
+from astropy.visualization import make_lupton_rgb
+from desclamp import mosaic
+
+
+class TestMosaic(object):
+
+    def setup_method(self):
+        rng = np.random.default_rng(0)
+        self.images = rng.normal(0, 1, (7, 3, 20, 16)) * np.array([1, 3, 30])[None, :, None, None]
+
+    def test_asinh_rgb(self):
+        rgb = mosaic.asinh_rgb(self.images, data_range=2, q=8)
+        assert rgb.shape == (7, 20, 16, 3) and rgb.dtype == np.uint8
+        for image, stretched in zip(self.images, rgb):
+            # Same stretch as makeRGB, up to rounding of saturated pixels
+            reference = make_lupton_rgb(*image, minimum=0, stretch=2, Q=8)
+            npt.assert_allclose(stretched, reference, atol=1)
+
+    def test_tile(self):
+        stamps = mosaic.asinh_rgb(self.images)
+        tiled, positions = mosaic.tile(stamps, ncols=3, gap=2)
+        assert tiled.shape == (3 * 22 - 2, 3 * 18 - 2, 3)
+        npt.assert_array_equal(positions[4], (1, 1))
+        npt.assert_array_equal(tiled[22:42, 18:34], stamps[4, ::-1])
+        assert np.all(tiled[20:22] == 255)
+
+    def test_pages(self, tmp_path):
+        object_ids = np.arange(7) + 100
+        pages, index = mosaic.render_mosaic(self.images, object_ids, per_page=4, ncols=2)
+        assert len(pages) == 2 and pages[0].shape == (42, 34, 3)
+        row = index.set_index("objectId").loc[105]
+        assert (row["page"], row["row"], row["column"]) == (1, 0, 1)
+        tile = pages[1][row["y0"]:row["y0"] + 20, row["x0"]:row["x0"] + 16]
+        npt.assert_array_equal(tile, mosaic.asinh_rgb(self.images[5:6])[0, ::-1])
+
+        _, written = mosaic.render_mosaic(self.images, object_ids, per_page=4,
+                                          path=str(tmp_path / "page{page}.png"))
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["page0.png", "page1.png"]
+        assert written.equals(mosaic.render_mosaic(self.images, object_ids, per_page=4)[1])
+
+
+if __name__ == '__main__':
+    pytest.main()
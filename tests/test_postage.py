@@ -2,12 +2,36 @@ import numpy.testing as npt
 import numpy as np
 import pytest
 import galsim
+import copy
+import importlib.util
+import tracemalloc
 from desclamp import postage
 
+# The live data tests need the LSST stack and the DESC catalogs
+requires_stack = pytest.mark.skipif(any(importlib.util.find_spec(m) is None
+                                        for m in ("lsst", "GCRCatalogs")),
+                                    reason="requires the LSST stack and GCRCatalogs")
 
+
+def mock_add_fake_sources(exposure, objects):
+    for radec, obj in objects:
+        exposure.image.array[0, 0] += obj.flux
+        exposure.mask.array[0, 0] |= 1
+
+
+def peak_allocation(function):
+    """ Peak memory allocated by a function call, in bytes"""
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+@requires_stack
 class TestPostage(object):
     
-    def setup(self):
+    def setup_method(self):
         self.candidates = postage.Candidates("2.2i_dr6")
         bright_galaxy_query = ("clean",
             "extendedness == 1",
@@ -52,9 +76,211 @@ class TestPostage(object):
             # 1% flux error is quite high but it seems to be the number for now. I need to investigate this
             npt.assert_almost_equal(np.sum(injected-image), np.sum(lensed)*spectra[i], -1)
         
+    def test_inject_numpy(self):
+
+        lensed = np.zeros((10,10))
+        lensed[4,4]=1
+        spectra = (100,200,300)
+        injected = self.cutouts[0].inject(lensed, spectra, backend='numpy')
+        for i in range(3):
+            image = self.cutouts[0].exposure[i].maskedImage.image.array
+            npt.assert_almost_equal(np.sum(injected.exposure[i].maskedImage.image.array-image),
+                                    np.sum(lensed)*spectra[i], -1)
+
     def tetst_display(self):
         
         self.candidates.display_cutouts(self.cutouts, cutout_size=100, data_range = 2, q = 8)
-        
+
+
+class TestMockPostage(object):
+    """ Postage stamp extraction against a local stand-in for the butler"""
+
+    @pytest.fixture(autouse=True)
+    def setup_mock(self, mock_catalog, mock_butler):
+        self.butler = mock_butler
+        self.butler.latency = 0.01
+        self.candidates = postage.Candidates("mock", cat=mock_catalog, butler=mock_butler)
+        self.objects = self.candidates.catalog_query(("clean",), tracts=[4639])
+
+    def test_concurrent_stamps(self):
+        serial = self.candidates.make_postage_stamps(self.objects, cutout_size=10)
+        concurrent = self.candidates.make_postage_stamps(self.objects, cutout_size=10, n_threads=8)
+        assert [c.catalog["objectId"] for c in concurrent] == \
+            [c.catalog["objectId"] for c in serial]
+        assert self.butler.n_reads == 2 * 3 * len(self.objects)
+
+        completed = list(self.candidates.make_postage_stamps(self.objects, cutout_size=10,
+                                                             n_threads=8, completion_order=True))
+        assert sorted(c.catalog["objectId"] for c in completed) == list(self.objects["objectId"])
+
+    def test_display_empty(self):
+        with pytest.raises(ValueError, match="No cutouts"):
+            self.candidates.display_cutouts([])
+
+    def test_cached_query(self, tmp_path):
+        from desclamp.catalog_cache import CatalogCache
+        cache = CatalogCache(str(tmp_path), "mock")
+        cat = self.candidates.cat
+        n_queries = cat.n_queries
+        first = self.candidates.catalog_query(("ra > 57.0055",), tracts=[4639], cache=cache)
+        assert cat.n_queries == n_queries + 1
+        npt.assert_array_equal(first["objectId"], np.arange(6, 20))
+
+        # Other cuts on cached quantities do not query the catalog
+        query = ("ra < 57.0025", "dec > -30.9985")
+        second = self.candidates.catalog_query(query, tracts=[4639], cache=cache)
+        assert cat.n_queries == n_queries + 1
+        npt.assert_array_equal(second["objectId"], [2])
+        assert list(second["patch"]) == ["1,1"]
+
+        # Same rows as the query of the catalog
+        for cut in [query, ("ra < 57.0025", "dec > -31.0015"), ("abs(ra - 57.01) < 0.004",)]:
+            cached = self.candidates.catalog_query(cut, tracts=[4639], cache=cache)
+            direct = self.candidates.catalog_query(cut, tracts=[4639])
+            assert list(cached.columns) == list(direct.columns)
+            for column in cached.columns:
+                assert list(cached[column]) == list(direct[column])
+
+    def test_lazy_cutouts(self):
+        self.butler.latency = 0
+        eager = self.candidates.make_postage_stamps(self.objects, cutout_size=10)
+        self.butler.n_reads = 0
+        lazy = self.candidates.make_postage_stamps(self.objects, cutout_size=10, lazy=True)
+        assert self.butler.n_reads == 0
+        assert not lazy[3].loaded
+        npt.assert_array_equal(lazy[3].exposure[1].image.array, eager[3].exposure[1].image.array)
+        lazy[3].exposure
+        assert self.butler.n_reads == 3 and lazy[3].loaded
+
+        # Least recently used pixels are dropped from a bounded cache
+        cache = postage.ExposureCache(maxsize=2)
+        lazy = self.candidates.make_postage_stamps(self.objects, cutout_size=10, lazy=True,
+                                                   cache=cache)
+        for i in [0, 1, 0, 2, 1]:
+            lazy[i].exposure
+        assert cache.info == {'hits': 1, 'misses': 4, 'size': 2, 'maxsize': 2}
+        assert not lazy[0].loaded and lazy[1].loaded and lazy[2].loaded
+        assert self.butler.n_reads == 3 + 4 * 3
+
+    def test_stamps_by_patch(self):
+        self.butler.latency = 0
+        shuffled = self.objects.sample(frac=1, random_state=1)
+        single = self.candidates.make_postage_stamps(shuffled, cutout_size=10)
+        for kwargs in [{}, {"whole_patch": True}, {"copy_cutouts": False, "n_threads": 2}]:
+            self.butler.n_reads = 0
+            grouped = self.candidates.make_postage_stamps(shuffled, cutout_size=10, by_patch=True,
+                                                          **kwargs)
+            # One read per band
+            assert self.butler.n_reads == 3
+            for c_single, c_grouped in zip(single, grouped):
+                assert c_single.catalog["objectId"] == c_grouped.catalog["objectId"]
+                for e_single, e_grouped in zip(c_single.exposure, c_grouped.exposure):
+                    npt.assert_array_equal(e_single.image.array, e_grouped.image.array)
+            copied = grouped[0].exposure[0].image.array.base is None
+            assert copied == kwargs.get("copy_cutouts", True)
+
+    def test_cutout_plan(self):
+        plan = postage.cutout_plan(self.objects, self.candidates.skymap, cutout_size=10)
+        assert list(plan.index) == list(self.objects.index)
+
+        wcs = self.candidates.skymap[4639].getWcs()
+        for i, object_this in self.objects.iterrows():
+            x, y = wcs.world_to_pixel_values(object_this["ra"], object_this["dec"])
+            npt.assert_almost_equal(plan.loc[i, "x"], x)
+            npt.assert_almost_equal(plan.loc[i, "y"], y)
+            assert plan.loc[i, "min_x"] == int(np.floor(x - 4.5))
+            assert plan.loc[i, "min_y"] == int(np.floor(y - 4.5))
+
+        # Tracts are found from the skymap if not in the catalog, once per tract
+        untracted = postage.cutout_plan(self.objects.drop(columns="tract"), self.candidates.skymap,
+                                        cutout_size=10)
+        npt.assert_array_equal(untracted.to_numpy(), plan.to_numpy())
+        assert self.candidates.skymap.n_find == 1
+
+    def test_stored_stamps(self, tmp_path):
+        from desclamp.stamp_store import StampStore
+        store = StampStore(tmp_path, "mock", cutout_size=10, bands='irg')
+        stamps = self.candidates.stored_postage_stamps(self.objects.loc[:9], store)
+        assert self.butler.n_reads == 30
+        stamps = self.candidates.stored_postage_stamps(self.objects, store)
+        assert self.butler.n_reads == 60
+        cutouts = self.candidates.make_postage_stamps(self.objects.loc[[4, 15]], cutout_size=10)
+        npt.assert_array_equal(stamps["image"][[4, 15], 1],
+                               [c.exposure[1].image.array for c in cutouts])
+
+        reads = self.butler.n_reads
+        readonly = StampStore(tmp_path, "mock", cutout_size=10, bands='irg', readonly=True)
+        stamps = self.candidates.stored_postage_stamps(self.objects, readonly, planes=("image",))
+        assert self.butler.n_reads == reads
+        assert set(stamps) == {"image", "x0", "y0"}
+
+    def test_inject_allocations(self, monkeypatch):
+        monkeypatch.setattr(postage, "_add_fake_sources", mock_add_fake_sources)
+        cutout = self.candidates.make_postage_stamps(self.objects.loc[:0], cutout_size=200)[0]
+        source = galsim.InterpolatedImage(galsim.Image(np.ones((10, 10))), scale=0.05)
+        spectra = (100, 200, 300)
+
+        injected = cutout.inject(source, spectra)
+        for i in range(3):
+            npt.assert_almost_equal(injected.exposure[i].image.array[0, 0]
+                                    - cutout.exposure[i].image.array[0, 0], spectra[i])
+            assert cutout.exposure[i].mask.array[0, 0] == 0
+            assert injected.exposure[i].variance is cutout.exposure[i].variance
+            assert injected.exposure[i].metadata is cutout.exposure[i].metadata
+
+        deep = peak_allocation(lambda: copy.deepcopy(cutout.exposure))
+        copied = peak_allocation(lambda: cutout.inject(source, spectra))
+        inplace = peak_allocation(lambda: cutout.inject(source, spectra, inplace=True))
+        # Image and mask are copied but not the variance
+        assert copied < 0.75 * deep
+        assert inplace < 0.05 * deep
+        assert cutout.exposure[0].mask.array[0, 0] == 1
+
+    def test_inject_numpy(self):
+        cutout = self.candidates.make_postage_stamps(self.objects.loc[:0], cutout_size=60)[0]
+        # Blank images, the float32 pixels of the stand-in are too large to resolve the source
+        for e in cutout.exposure:
+            e.image.array[:] = 0
+        lensed = np.zeros((10, 10))
+        lensed[4, 4] = 1
+        spectra = (100, 200, 300)
+        injected = cutout.inject(lensed, spectra, backend='numpy')
+        wcs = self.candidates.skymap[4639].getWcs()
+        x0, y0 = wcs.world_to_pixel_values(self.objects.loc[0, "ra"], self.objects.loc[0, "dec"])
+        y, x = np.mgrid[:60, :60]
+        for i in range(3):
+            difference = injected.exposure[i].image.array - cutout.exposure[i].image.array
+            npt.assert_almost_equal(np.sum(difference), spectra[i], 1)
+            # Injected at the position of the object
+            npt.assert_almost_equal(np.sum(difference * x) / spectra[i],
+                                    x0 - cutout.exposure[i].x0, 1)
+            npt.assert_almost_equal(np.sum(difference * y) / spectra[i],
+                                    y0 - cutout.exposure[i].y0, 1)
+
+        # A source without flux leaves the cutout unchanged
+        empty = cutout.inject(np.zeros((10, 10)), spectra, backend='numpy')
+        npt.assert_array_equal(empty.exposure[0].image.array, cutout.exposure[0].image.array)
+
+    def test_retries(self):
+        self.butler.failures = 2
+        cutouts = self.candidates.make_postage_stamps(self.objects.loc[:0], cutout_size=10,
+                                                      backoff=0)
+        assert len(cutouts[0].exposure) == 3
+        assert self.butler.n_reads == 5
+
+        self.butler.failures = 2
+        with pytest.raises(OSError):
+            self.candidates.make_postage_stamps(self.objects.loc[:0], cutout_size=10, retries=1,
+                                                backoff=0)
+
+    def test_missing_patch(self):
+        # Missing files are not retried
+        self.butler.failures = 3
+        self.butler.error = FileNotFoundError
+        with pytest.raises(FileNotFoundError):
+            self.candidates.make_postage_stamps(self.objects.loc[:0], cutout_size=10, backoff=10)
+        assert self.butler.n_reads == 1
+
+
 if __name__ == '__main__':
     pytest.main()
\ No newline at end of file
@@ -0,0 +1,97 @@
+import numpy.testing as npt
+import numpy as np
+import pandas as pd
+import pytest
+from desclamp import postage, sharding, train_set
+from desclamp.training_file import TrainingSetReader
+from mocks import lens_sampler, mock_inject
+
+
+class TestSharding(object):
+
+    def setup_method(self):
+        rng = np.random.default_rng(0)
+        n = 100
+        self.objects = pd.DataFrame({"objectId": rng.permutation(n),
+                                     "tract": rng.choice([4639, 4640], n),
+                                     "patch": rng.choice(["0,0", "0,1", "1,1", "2,1"], n)})
+
+    def test_partition(self):
+        shards = sharding.partition_objects(self.objects, 3)
+        assert sum(len(s) for s in shards) == len(self.objects)
+        assert sorted(pd.concat(shards)["objectId"]) == list(range(100))
+        # Patches are not split between shards
+        patches = [set(zip(s["tract"], s["patch"])) for s in shards]
+        for i in range(3):
+            for j in range(i + 1, 3):
+                assert len(patches[i] & patches[j]) == 0
+        # Deterministic, whatever the order of the objects
+        shuffled = sharding.partition_objects(self.objects.sample(frac=1, random_state=3), 3)
+        for s, t in zip(shards, shuffled):
+            pd.testing.assert_frame_equal(s, t)
+
+    def test_shard_samples(self):
+        npt.assert_array_equal(sharding.shard_samples(10, [30, 30, 40]), [3, 3, 4])
+        assert sum(sharding.shard_samples(1001, [7, 0, 13, 5])) == 1001
+
+    def test_generate_resume_merge(self, tmp_path, monkeypatch, mock_catalog, mock_butler):
+        monkeypatch.setattr(postage.Cutout, "inject", mock_inject)
+
+        def make_train():
+            train = train_set.TrainSet("mock", n_samples=30, batchsize=4, lens_fraction=0.5,
+                                       lens_sampler=lens_sampler, prefetch=0, cutout_size=10,
+                                       cat=mock_catalog, butler=mock_butler)
+            objects = train.catalog_query(("clean",), tracts=[4639])
+            objects["patch"] = np.where(objects["objectId"] < 8, "0,0", "1,1")
+            return train, objects
+
+        output = str(tmp_path)
+        for shard in range(2):
+            sharding.generate_shard(*make_train(), shard, 2, output)
+        with TrainingSetReader(sharding.merge_shards(output)) as reader:
+            assert reader.memory_mapped
+            merged = reader[np.arange(30)]
+            params = [reader.params(i) for i in range(30)]
+        assert merged["images"].shape == (30, 3, 10, 10)
+        assert 0 < np.sum(merged["labels"]) < 30
+        assert [p is not None for p in params] == list(merged["labels"] == 1)
+
+        # An interrupted shard resumes from its manifest
+        reads = mock_butler.n_reads
+        manifest = sharding.generate_shard(*make_train(), 1, 2, output)
+        assert mock_butler.n_reads == reads
+        del manifest["batches"]["shard0001/batch000001.npz"]
+        manifest["complete"] = False
+        sharding._write_json(manifest, sharding._manifest_file(output, 1))
+        with pytest.raises(AssertionError):
+            sharding.merge_shards(output)
+        sharding.generate_shard(*make_train(), 1, 2, output)
+        assert mock_butler.n_reads == reads + 4 * 3
+        with TrainingSetReader(sharding.merge_shards(output)) as reader:
+            npt.assert_array_equal(reader[np.arange(30)]["images"], merged["images"])
+            assert [reader.params(i) for i in range(30)] == params
+
+    def test_command_line(self, tmp_path, monkeypatch, mock_catalog, mock_butler):
+        monkeypatch.setattr(postage, "catalog_setup", lambda version: (mock_catalog, mock_butler))
+        arguments = ["--n-shards", "2", "--output", str(tmp_path), "--data-version", "mock",
+                     "--query", "clean", "--tracts", "4639", "--n-samples", "12",
+                     "--batchsize", "4", "--lens-fraction", "0", "--cutout-size", "10"]
+        for shard in range(2):
+            sharding.main(["run", "--shard", str(shard)] + arguments)
+        # Only the first shard queries the catalog
+        assert mock_catalog.n_queries == 1
+        sharding.main(["merge", "--output", str(tmp_path)])
+        with TrainingSetReader(str(tmp_path / "merged.h5")) as reader:
+            assert len(reader) == 12 and reader[0]["images"].shape == (3, 10, 10)
+
+    def test_command_line_all_tracts(self, tmp_path, monkeypatch, mock_catalog, mock_butler):
+        monkeypatch.setattr(postage, "catalog_setup", lambda version: (mock_catalog, mock_butler))
+        sharding.main(["run", "--shard", "0", "--n-shards", "1", "--output", str(tmp_path),
+                       "--data-version", "mock", "--query", "clean", "--n-samples", "4",
+                       "--lens-fraction", "0", "--cutout-size", "10"])
+        assert mock_catalog.n_queries == 1
+        assert [f for f in tmp_path.iterdir() if f.name.endswith(".tmp")] == []
+
+
+if __name__ == '__main__':
+    pytest.main()
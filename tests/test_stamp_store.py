@@ -0,0 +1,56 @@
+import numpy.testing as npt
+import numpy as np
+import pytest
+from types import SimpleNamespace
+from mocks import MockExposure
+from desclamp import stamp_store
+
+
+def mock_cutout(object_id, bands=3, size=10):
+    exposure = [MockExposure.from_bbox(20 * object_id, 10 * b, size, size) for b in range(bands)]
+    return SimpleNamespace(exposure=exposure, catalog={"objectId": object_id})
+
+
+class TestStampStore(object):
+
+    def test_write_read(self, tmp_path):
+        store = stamp_store.StampStore(tmp_path, "2.2i_dr6", cutout_size=10, bands='irg')
+        assert store.write([mock_cutout(i) for i in range(5)]) == 5
+        # Stamps already in the store are not written again
+        assert store.write([mock_cutout(i) for i in range(3, 8)]) == 3
+        assert len(store) == 8
+        assert store.missing([1, 7, 12]) == [12]
+
+        readonly = stamp_store.StampStore(tmp_path, "2.2i_dr6", cutout_size=10, bands='irg',
+                                          readonly=True)
+        stamps = readonly.read([6, 2], bands='gi')
+        assert stamps["image"].shape == (2, 2, 10, 10)
+        npt.assert_array_equal(stamps["image"][0, 0], mock_cutout(6).exposure[2].image.array)
+        npt.assert_array_equal(stamps["image"][1, 1], mock_cutout(2).exposure[0].image.array)
+        npt.assert_array_equal(stamps["variance"], 1)
+        npt.assert_array_equal(stamps["x0"], [120, 40])
+        with pytest.raises(AssertionError):
+            readonly.write([mock_cutout(10)])
+
+    def test_memory_map(self, tmp_path):
+        store = stamp_store.StampStore(tmp_path, "2.2i_dr6", cutout_size=10, bands='irg')
+        store.write([mock_cutout(i) for i in range(5)])
+        store.write([mock_cutout(i) for i in range(5, 8)])
+        # Consecutive stamps of a chunk are views of its memory maps
+        stamps = store.read([1, 2, 3], bands='rg')
+        for plane in ("image", "mask", "variance"):
+            assert isinstance(stamps[plane], np.memmap) and not stamps[plane].flags.writeable
+        npt.assert_array_equal(stamps["image"][2, 1], mock_cutout(3).exposure[2].image.array)
+        npt.assert_array_equal(stamps["x0"], [20, 40, 60])
+        # Other selections are copied
+        copied = store.read([3, 6])
+        assert not isinstance(copied["image"], np.memmap)
+        npt.assert_array_equal(copied["image"][1, 0], mock_cutout(6).exposure[0].image.array)
+
+    def test_missing_store(self, tmp_path):
+        with pytest.raises(AssertionError):
+            stamp_store.StampStore(tmp_path, "2.2i_dr6", readonly=True)
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -1,13 +1,67 @@
 import numpy.testing as npt
 import numpy as np
 import pytest
+from desclamp import postage, train_set
+from mocks import lens_sampler, mock_inject
 
-from desclamp import train_set
 
-    
-    
-    
-    
+class TestTrainSet(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self, mock_catalog, mock_butler):
+        self.butler = mock_butler
+        self.train = train_set.TrainSet("mock", n_samples=30, batchsize=8, lens_fraction=0.5,
+                                        lens_sampler=lens_sampler, cutout_size=10,
+                                        cat=mock_catalog, butler=mock_butler)
+        self.train.catalog_query(("clean",), tracts=[4639])
+
+    def test_iteration(self, monkeypatch):
+        monkeypatch.setattr(postage.Cutout, "inject", mock_inject)
+        batches = list(self.train)
+        assert len(batches) == len(self.train) == 4
+        assert [len(b) for b in batches] == [8, 8, 8, 6]
+        assert self.butler.n_reads == 30 * 3
+
+        # Objects are cycled through
+        ids = [c.catalog["objectId"] for b in batches for c in b]
+        npt.assert_array_equal(ids, np.arange(30) % 20)
+
+        n_lensed = 0
+        for cutout in (c for b in batches for c in b):
+            exposure = cutout.exposure[2]
+            excess = exposure.image.array[0, 0] - (exposure.x0 + 10000. * exposure.y0)
+            if cutout.lens is None:
+                assert excess == 0
+            else:
+                n_lensed += 1
+                assert cutout.lens["spectra"] == (1, 2, 3)
+                assert excess == 3
+        assert 0 < n_lensed < 30
+
+    def test_prefetch_reproducible(self, monkeypatch):
+        monkeypatch.setattr(postage.Cutout, "inject", mock_inject)
+        self.train.prefetch = 0
+        synchronous = [[c.lens for c in b] for b in self.train]
+        self.train.prefetch = 3
+        prefetched = [[c.lens for c in b] for b in self.train]
+        assert synchronous == prefetched
+
+    def test_prefetch_bounded(self):
+        self.train.lens_fraction = 0
+        self.train.prefetch = 1
+        iterator = iter(self.train)
+        next(iterator)
+        self.train._producer.join(timeout=0.5)
+        # one batch consumed, one queued and one waiting to be queued
+        assert self.butler.n_reads == 3 * 8 * 3
+        self.train.close()
+
+    def test_lens_sampler_required(self, mock_catalog, mock_butler):
+        with pytest.raises(AssertionError, match="lens_sampler"):
+            train_set.TrainSet("mock", n_samples=8, cat=mock_catalog, butler=mock_butler)
+        train_set.TrainSet("mock", n_samples=8, lens_fraction=0, cat=mock_catalog,
+                           butler=mock_butler)
+
 
 if __name__ == '__main__':
-    pytest.main()
\ No newline at end of file
+    pytest.main()
@@ -0,0 +1,63 @@
+import json
+import numpy.testing as npt
+import numpy as np
+import pytest
+from desclamp.training_file import TrainingSetWriter, TrainingSetReader, batch_arrays
+from mocks import MockExposure
+
+
+class MockCutout(object):
+    def __init__(self, object_id, lens=None):
+        self.exposure = [MockExposure.from_bbox(object_id, b, 10, 10) for b in range(3)]
+        self.catalog = {"objectId": object_id}
+        self.lens = lens
+
+
+def batches():
+    for start in range(0, 20, 8):
+        yield [MockCutout(i, lens={"theta_E": i / 10., "spectra": (1, 2, 3)} if i % 3 == 0
+                          else None)
+               for i in range(start, min(start + 8, 20))]
+
+
+class TestTrainingFile(object):
+
+    @pytest.mark.parametrize("kwargs", [{}, {"n_samples": 20, "compression": None}])
+    def test_write_read(self, tmp_path, kwargs):
+        path = str(tmp_path / "train.h5")
+        with TrainingSetWriter(path, cutout_size=10, chunk=4, **kwargs) as writer:
+            for batch in batches():
+                writer.write(batch)
+
+        with TrainingSetReader(path) as reader:
+            assert len(reader) == 20
+            assert reader.memory_mapped == ("n_samples" in kwargs)
+            sample = reader[7]
+            assert sample["images"].shape == (3, 10, 10) and sample["images"].dtype == np.float32
+            npt.assert_array_equal(sample["images"][1],
+                                   MockExposure.from_bbox(7, 1, 10, 10).image.array)
+            assert sample["objectId"] == 7 and sample["labels"] == 0
+            npt.assert_array_equal(reader.labels, np.arange(20) % 3 == 0)
+            npt.assert_array_equal(reader.spectra[3], (1, 2, 3))
+            assert np.all(np.isnan(reader.spectra[4]))
+            assert reader.params(6) == {"theta_E": 0.6}
+            assert reader.params(4) is None
+
+            # Random access in any order, with repeats
+            index = [12, 3, 12, 0]
+            batch = reader[index]
+            npt.assert_array_equal(batch["objectId"], index)
+            npt.assert_array_equal(batch["images"][:, 0, 0, 0], index)
+
+            shuffled = list(reader.batches(6, shuffle=True, seed=1))
+            assert [len(b["labels"]) for b in shuffled] == [6, 6, 6, 2]
+            assert sorted(np.concatenate([b["objectId"] for b in shuffled])) == list(range(20))
+
+    def test_array_params(self):
+        lens = {"theta_E": np.float32(1.5), "coeffs": np.array([1., 2.]), "spectra": (1, 2, 3)}
+        arrays = batch_arrays([MockCutout(0, lens=lens)])
+        assert json.loads(arrays["params"][0]) == {"theta_E": 1.5, "coeffs": [1., 2.]}
+
+
+if __name__ == '__main__':
+    pytest.main()